@@ -1,6 +1,7 @@
 import os
 import time
 import csv
+import json
 from azure.storage.blob import BlobServiceClient
 from langchain_openai import AzureChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
@@ -69,21 +70,56 @@ while(retries):
 print(f"Discovering files in {source_folder}...")
 
 # Index file
-index_exists = False
 index_file_name = "index.csv"
 index_file_path = os.path.join(source_folder, index_file_name)
-for root, dirs, files in os.walk(source_folder):
-    for file in files:
-        if file == index_file_name:
-            print("Index file already provided.")
-            index_exists = True
-            break
+index_exists = os.path.exists(index_file_path)
+if index_exists:
+    print("Index file already provided.")
+else:
     # Create index.csv if it was not provided
     print("Index file not provided. Proceeding to create one...")
     with open(index_file_path, mode="w", newline="", encoding="utf-8") as file:
         writer = csv.writer(file)
         writer.writerow(["FILE_NAME", "SUMMARY"])
 
+# Column profiles of every file, stored next to the index
+profiles_file_name = "index.profiles.json"
+profiles_file_path = os.path.join(source_folder, profiles_file_name)
+profiles = {}
+top_values = 5
+max_value_chars = 50
+
+def to_value(value):
+    # Plain JSON values, long texts shortened
+    if hasattr(value, "item"):
+        value = value.item()
+    if isinstance(value, float):
+        return round(value, 4)
+    if isinstance(value, str) and len(value) > max_value_chars:
+        return value[:max_value_chars] + "..."
+    return value
+
+def get_column_profile(series):
+    values = series.dropna()
+    profile = {
+        "name": str(series.name),
+        "dtype": str(series.dtype),
+        "null_rate": round(float(series.isna().mean()), 4) if len(series) else 0,
+        "distinct": int(values.nunique())
+    }
+    numeric = pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series)
+    if numeric and len(values):
+        profile.update({"min": to_value(values.min()), "max": to_value(values.max()), "mean": to_value(values.mean()), "sum": to_value(values.sum())})
+    # Most frequent values, for text columns and numbers with few distinct values
+    if not numeric or profile["distinct"] <= 20:
+        profile["top"] = [[to_value(value), int(count)] for value, count in values.value_counts().head(top_values).items()]
+    return profile
+
+def get_file_profile(filepath, filename):
+    print(f"Getting profile for {filename}")
+    df = pd.read_csv(filepath)
+    profiles[filename] = {"rows": len(df), "columns": [get_column_profile(df[column]) for column in df.columns]}
+
 # Function to summarize file using LLM model
 def get_file_summary(filepath, filename):
     print(f"Getting summary for {filename}")
@@ -102,6 +138,7 @@ for root, dirs, files in os.walk(source_folder):
         if file.endswith('.csv') and file != index_file_name:
             if index_exists == False:
                 get_file_summary(file_path, file)
+            get_file_profile(file_path, file)
             blob_client = container_client.get_blob_client(file)
             print(f"Uploading {file}...")
             with open(file_path, "rb") as data:
@@ -113,4 +150,13 @@ print(f"Uploading {index_file_name}...")
 blob_client = container_client.get_blob_client(index_file_name)
 with open(index_file_path, "rb") as data:
     blob_client.upload_blob(data, overwrite=True)
-print(f"{index_file_name} uploaded successfully.")
\ No newline at end of file
+print(f"{index_file_name} uploaded successfully.")
+
+# And the column profiles
+with open(profiles_file_path, mode="w", encoding="utf-8") as file:
+    json.dump({"version": 1, "files": profiles}, file, separators=(",", ":"))
+print(f"Uploading {profiles_file_name}...")
+blob_client = container_client.get_blob_client(profiles_file_name)
+with open(profiles_file_path, "rb") as data:
+    blob_client.upload_blob(data, overwrite=True)
+print(f"{profiles_file_name} uploaded successfully.")
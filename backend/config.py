@@ -1,21 +1,47 @@
 import os
+import tempfile
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# When enabled, agents open their remote connections on first use instead of at startup
+lazy_connect = os.getenv("LAZY_CONNECT", "true").lower() == "true"
+
+# When enabled, agents start fetching their context while the entry point decides whether they need it
+prefetch = os.getenv("AGENT_PREFETCH", "true").lower() == "true"
+
+# Maximum size of a query / code / API result in the answer prompt
+result_token_budget = int(os.getenv("RESULT_TOKEN_BUDGET", 2000))
+
 rag_config = {
     "agent_id": "rag",
     "agent_directive": "You are able to answer questions related to Fabian's final project for his master degree in AI.",
     "azure_search_endpoint": os.getenv("AZURE_SEARCH_URI"),
     "azure_search_key": os.getenv("AZURE_SEARCH_KEY"),
     "index_name": os.getenv("RAG_INDEX"),
-    "embeddings": os.getenv("EMBEDDINGS_MODEL")
+    "embeddings": os.getenv("EMBEDDINGS_MODEL"),
+    "lazy_connect": lazy_connect,
+    "prefetch": prefetch
 }
 
 sql_config = {
     "agent_id": "sql",
     "agent_directive": "You are able to answer questions related to AdventureWorks database, which contains sample data for e-commerce scenarios, showcasing sales and product management.",
-    "connection_string": f"mssql+pyodbc://{os.getenv('SQL_USERNAME')}:{os.getenv('SQL_PASSWORD')}@{os.getenv('SQL_SERVER')}:1433/{os.getenv('SQL_DATABASE')}?driver=ODBC+Driver+18+for+SQL+Server"
+    "connection_string": f"mssql+pyodbc://{os.getenv('SQL_USERNAME')}:{os.getenv('SQL_PASSWORD')}@{os.getenv('SQL_SERVER')}:1433/{os.getenv('SQL_DATABASE')}?driver=ODBC+Driver+18+for+SQL+Server",
+    "schema_ttl": int(os.getenv("SQL_SCHEMA_TTL", 300)),
+    "plan_cache_path": os.getenv("SQL_PLAN_CACHE_PATH", os.path.join(tempfile.gettempdir(), "sql-plan-cache", "plans.json")),
+    "plan_cache_size": 500,
+    "result_cache_ttl": int(os.getenv("SQL_RESULT_CACHE_TTL", 300)),
+    "result_cache_size": 256,
+    "pool_size": int(os.getenv("SQL_POOL_SIZE", 5)),
+    "pool_recycle": 1800,
+    "query_timeout": int(os.getenv("SQL_QUERY_TIMEOUT", 30)),
+    "max_rows": int(os.getenv("SQL_MAX_ROWS", 200)),
+    "max_result_bytes": 50000,
+    "max_query_cost": float(os.getenv("SQL_MAX_QUERY_COST", 100)),
+    "result_token_budget": result_token_budget,
+    "lazy_connect": lazy_connect,
+    "prefetch": prefetch
 }
 
 csv_config = {
@@ -23,7 +49,16 @@ csv_config = {
     "agent_directive": "You are able to answer questions related to a collection of CSV files, which contains data from DC and Marvel characters.",
     "connection_string": os.getenv("AZURE_STORAGE_CONNECTION_STRING"),
     "container_name": os.getenv("CSV_CONTAINER"),
-    "index_file_name": "index.csv"
+    "index_file_name": "index.csv",
+    "profiles_file_name": "index.profiles.json",
+    "frame_cache_bytes": int(os.getenv("CSV_FRAME_CACHE_MB", 256)) * 1024 * 1024,
+    "frame_downcast": os.getenv("CSV_FRAME_DOWNCAST", "false").lower() == "true",
+    "max_files": 3,
+    "file_score_ratio": 0.5,
+    "index_embeddings": os.getenv("CSV_INDEX_EMBEDDINGS"),
+    "result_token_budget": result_token_budget,
+    "lazy_connect": lazy_connect,
+    "prefetch": prefetch
 }
 
 api_config = {
@@ -31,5 +66,95 @@ api_config = {
     "agent_directive": "You are able to answer questions related to GitHub repositories and users.",
     "spec_url": os.getenv("API_SPEC_URL"),
     "spec_format": os.getenv("API_SPEC_FORMAT"),
-    "endpoint_filter": ["/users/{username}"]
+    "endpoint_filter": ["/users/{username}"],
+    "mode": os.getenv("API_AGENT_MODE", "planner"),
+    "spec_cache_dir": os.getenv("API_SPEC_CACHE_DIR", os.path.join(tempfile.gettempdir(), "api-spec-cache")),
+    "http_pool_size": 10,
+    "http_cache_entries": 256,
+    "result_token_budget": result_token_budget,
+    # Keys dropped from results over the token budget, GitHub payloads are full of links to other resources
+    "result_excluded_keys": [r".*_url$", r"^url$", r"^node_id$", r"^gravatar_id$"],
+    "lazy_connect": lazy_connect,
+    "prefetch": prefetch
+}
+
+# Deployments for the answers and summaries, and for the short routing, selection and review steps
+large_deployment = os.getenv("LLM_LARGE_DEPLOYMENT", "gpt-4o")
+small_deployment = os.getenv("LLM_SMALL_DEPLOYMENT", "gpt-4o-mini")
+
+# Deployment, output token cap and scheduling priority of each chain
+llm_chains = {
+    "supervisor_chain": { "deployment": small_deployment, "max_tokens": 100, "priority": "routing" },
+    "entry_point_chain": { "deployment": small_deployment, "max_tokens": 500, "priority": "routing" },
+    "endpoint_selector_chain": { "deployment": small_deployment, "max_tokens": 200, "priority": "routing" },
+    "file_selector_chain": { "deployment": small_deployment, "max_tokens": 200, "priority": "routing" },
+    "query_reviewer_chain": { "deployment": small_deployment, "max_tokens": 500, "priority": "answer" },
+    "code_reviewer_chain": { "deployment": small_deployment, "max_tokens": 1500, "priority": "answer" },
+    "query_generator_chain": { "deployment": large_deployment, "max_tokens": 500, "priority": "answer" },
+    "code_generator_chain": { "deployment": large_deployment, "max_tokens": 1500, "priority": "answer" },
+    "plan_generator_chain": { "deployment": large_deployment, "max_tokens": 500, "priority": "answer" },
+    "answer_generator_chain": { "deployment": large_deployment, "max_tokens": 800, "priority": "answer" },
+    "summarizer_chain": { "deployment": large_deployment, "max_tokens": 1000, "priority": "summarizer" },
+    "history_summarizer_chain": { "deployment": large_deployment, "max_tokens": 400, "priority": "background" },
+    "greeter_chain": { "deployment": small_deployment, "max_tokens": 300, "priority": "greeting" }
+}
+
+# Shared HTTP client of every LLM call: connection pool, retries and calls in flight per deployment
+llm_config = {
+    "api_version": "2023-06-01-preview",
+    "max_connections": int(os.getenv("LLM_MAX_CONNECTIONS", 50)),
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 30,
+    "timeout": float(os.getenv("LLM_TIMEOUT", 60)),
+    "http2": True,
+    "max_retries": int(os.getenv("LLM_MAX_RETRIES", 4)),
+    "backoff_base": 0.5,
+    "backoff_max": 20,
+    "max_concurrency": int(os.getenv("LLM_MAX_CONCURRENCY", 16)),
+    "concurrency": {},
+    "tokens_per_minute": int(os.getenv("LLM_TOKENS_PER_MINUTE", 0)),
+    "requests_per_minute": int(os.getenv("LLM_REQUESTS_PER_MINUTE", 0)),
+    "reserve": {"greeting": 0.3, "background": 0.5},
+    "queue_timeout": float(os.getenv("LLM_QUEUE_TIMEOUT", 60)),
+    "completion_tokens": 500,
+    "deployment": large_deployment,
+    "chains": llm_chains
+}
+
+history_config = {
+    "max_entries": int(os.getenv("HISTORY_MAX_ENTRIES", 4)),
+    "max_tokens": int(os.getenv("HISTORY_MAX_TOKENS", 1500)),
+    "max_entry_tokens": int(os.getenv("HISTORY_MAX_ENTRY_TOKENS", 400)),
+    "supervisor_tokens": 1000
+}
+
+# State shared by the workers: 'memory' keeps it in each process, 'redis' in the Redis server at REDIS_URL
+state_config = {
+    "backend": os.getenv("STATE_BACKEND", "memory"),
+    "redis_url": os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+    "prefix": "chatbot:"
+}
+
+ask_config = {
+    "idempotency_ttl": int(os.getenv("IDEMPOTENCY_TTL", 600)),
+    "idempotency_entries": 10000
+}
+
+greeter_config = {
+    "pool_size": int(os.getenv("GREETER_POOL_SIZE", 3)),
+    "refresh_interval": int(os.getenv("GREETER_REFRESH_INTERVAL", 3600))
+}
+
+health_config = {
+    "ttl": int(os.getenv("HEALTH_TTL", 30)),
+    "timeout": float(os.getenv("HEALTH_TIMEOUT", 5)),
+    "probe_interval": int(os.getenv("HEALTH_PROBE_INTERVAL", 0))
+}
+
+logging_config = {
+    "level": os.getenv("LOG_LEVEL", "INFO"),
+    "format": os.getenv("LOG_FORMAT", "json"),
+    "max_chars": int(os.getenv("LOG_MAX_CHARS", 2000)),
+    "debug_sample_rate": float(os.getenv("LOG_DEBUG_SAMPLE_RATE", 1.0)),
+    "queue_size": 10000
 }
\ No newline at end of file
@@ -0,0 +1,427 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import socket
+import asyncio
+import argparse
+import threading
+from datetime import datetime, timezone
+from dataclasses import dataclass
+
+# The harness prints its own report, the backend only logs warnings and errors unless told otherwise
+if __name__ == "__main__":
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+import anyio
+import httpx
+import uvicorn
+from langchain_core.documents import Document
+from config import rag_config, sql_config, csv_config, api_config, history_config, llm_config, greeter_config, health_config, ask_config
+from modules.agent_rag import AgentRag
+from modules.supervisor import Supervisor
+from modules.summarizer import Summarizer
+from modules.greeter import Greeter
+from modules.graph import Graph
+from modules.llm import setup_llm
+from modules.state import setup_state, get_backend
+from modules.health import HealthMonitor
+from modules.history import HistorySummarizer
+from modules.cache import TTLCache
+from modules.coalescing import SingleFlight
+
+# Conversations run by the virtual users, a new session each time
+SCENARIOS = {
+    # Opens the chat, asks a couple of questions, reads the history back and rates the answer
+    "chat": ["greetings", "ask", "ask", "history", "feedback"],
+    # Comes back to an existing conversation with one more question
+    "question": ["history", "ask"],
+    # Looks at the agents status and the feedback counters
+    "status": ["agents", "feedback_count"],
+}
+DEFAULT_MIX = "chat=6,question=3,status=1"
+
+QUESTIONS = (
+    "What was the final project of the master degree about?",
+    "Which products sold the most last year?",
+    "Who is the strongest Marvel character?",
+    "How many public repositories does the user octocat have?",
+    "Can you summarize the previous answer?",
+)
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+class LatencyModel:
+    # Log-normal latencies: most calls close to the median and a long tail of slow ones
+
+    def __init__(self, median, sigma=0.5, maximum=60):
+        self.median = median
+        self.sigma = sigma
+        self.maximum = maximum
+
+    def sample(self):
+        if self.median <= 0:
+            return 0
+        return min(self.maximum, self.median * math.exp(random.gauss(0, self.sigma)))
+
+
+class SimulatedOpenAITransport(httpx.BaseTransport):
+    # Answers the Azure OpenAI chat completion calls after a sampled latency, with replies the components
+    # can parse: agent names for the supervisor, 'CONTINUE' or a short answer for the entry points.
+    # A share of the calls can be throttled to exercise the retries and the scheduler.
+
+    def __init__(self, latency, error_rate=0.0, history_answer_rate=0.2):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.history_answer_rate = history_answer_rate
+
+    def get_reply(self, messages):
+        system = next((message["content"] for message in messages if message["role"] == "system"), "")
+        if system.startswith("You are a supervisor"):
+            agents = re.findall(r"'agent_name': '([^']+)'", system)
+            return ", ".join(random.sample(agents, min(len(agents), random.randint(1, 2))))
+        if "answer with 'CONTINUE'" in system and random.random() >= self.history_answer_rate:
+            return "CONTINUE"
+        return "This is a simulated answer. " * random.randint(1, 5)
+
+    def handle_request(self, request):
+        time.sleep(self.latency.sample())
+        if random.random() < self.error_rate:
+            return httpx.Response(429, headers={"retry-after-ms": "100"}, json={"error": {"code": "429", "message": "Simulated throttling"}})
+
+        body = json.loads(request.read() or b"{}")
+        content = self.get_reply(body.get("messages", []))
+        prompt_tokens = math.ceil(len(request.content) / 4)
+        completion_tokens = math.ceil(len(content) / 4)
+        return httpx.Response(200, json={
+            "id": uuid.uuid4().hex, "object": "chat.completion", "created": int(time.time()), "model": body.get("model", "simulated"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        })
+
+
+class SimulatedVectorStore:
+    # Stands for Azure AI Search behind the agents
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def similarity_search(self, query, k=4):
+        time.sleep(self.latency.sample())
+        return [Document(page_content=f"Simulated document {i} about: {query}") for i in range(k)]
+
+
+class TableEntity(dict):
+    # Entities come back from the table with their metadata, like the Azure SDK ones
+
+    def __init__(self, entity, timestamp):
+        super().__init__(entity)
+        self.metadata = {"timestamp": timestamp}
+
+
+class InMemoryTable:
+    # The part of the Azure Tables client used by the backend, kept in memory
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.partitions = {}
+
+    def create_entity(self, entity):
+        with self.lock:
+            partition = self.partitions.setdefault(entity["PartitionKey"], {})
+            if entity["RowKey"] in partition:
+                raise ValueError(f"Entity {entity['PartitionKey']}/{entity['RowKey']} already exists")
+            partition[entity["RowKey"]] = TableEntity(entity, datetime.now(timezone.utc))
+
+    def upsert_entity(self, entity):
+        with self.lock:
+            self.partitions.setdefault(entity["PartitionKey"], {})[entity["RowKey"]] = TableEntity(entity, datetime.now(timezone.utc))
+
+    def delete_entity(self, partition_key, row_key):
+        with self.lock:
+            self.partitions.get(partition_key, {}).pop(row_key, None)
+
+    def query_entities(self, query_filter):
+        # Only the filters the backend sends: partition keys joined with 'or'
+        keys = re.findall(r"PartitionKey eq '([^']*)'", query_filter)
+        with self.lock:
+            return [TableEntity(entity, entity.metadata["timestamp"]) for key in keys for entity in self.partitions.get(key, {}).values()]
+
+
+def build_setup(options):
+    # The same components as the real setup, with the model, the documents and the tables simulated
+    os.environ.setdefault("AZURE_OPENAI_API_KEY", "simulated")
+    os.environ.setdefault("AZURE_OPENAI_ENDPOINT", "https://simulated.openai.azure.com")
+    setup_state({"backend": "memory"})
+    setup_llm(llm_config, SimulatedOpenAITransport(LatencyModel(options.llm_latency, options.llm_sigma), options.llm_error_rate, options.history_answer_rate))
+
+    # Every agent follows the RAG flow (entry point, search, answer) with the name and skills of a real one
+    agents = []
+    for config in (rag_config, sql_config, csv_config, api_config):
+        agent = AgentRag({ "agent_id": config["agent_id"], "agent_directive": config["agent_directive"], "lazy_connect": True, "prefetch": config["prefetch"] })
+        agent.vstore = SimulatedVectorStore(LatencyModel(options.fetch_latency, options.fetch_sigma))
+        agents.append(agent)
+
+    supervisor = Supervisor(agents, history_config["supervisor_tokens"])
+    graph = Graph(supervisor, Summarizer(), agents)
+    history_table = InMemoryTable()
+    greeter = Greeter(agents, greeter_config)
+    greeter.start()
+    health = HealthMonitor(agents, health_config)
+    health.start()
+
+    return {
+        "graph": graph, "feedback_table": InMemoryTable(), "history_table": history_table,
+        "history_summarizer": HistorySummarizer(history_table, history_config), "agents": agents, "greeter": greeter, "health": health,
+        "single_flight": SingleFlight("ask", get_backend()),
+        "idempotency_cache": TTLCache(maxsize=ask_config["idempotency_entries"], ttl=ask_config["idempotency_ttl"], name="idempotency", backend=get_backend())
+    }
+
+
+class Server:
+    # Serves the backend with uvicorn in a background thread, on its own event loop, so the worker
+    # threads of the sync endpoints can be sampled while the load runs
+
+    def __init__(self, app, threads=None):
+        self.app = app
+        self.threads = threads
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning", access_log=False))
+        self.loop = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def serve(self):
+        if self.threads:
+            anyio.to_thread.current_default_thread_limiter().total_tokens = self.threads
+        await self.server.serve()
+
+    def start(self, timeout=60):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_until_complete, args=(self.serve(),), name="loadtest-server", daemon=True)
+        self.thread.start()
+        deadline = time.monotonic() + timeout
+        while not self.server.started:
+            if not self.thread.is_alive() or time.monotonic() > deadline:
+                raise RuntimeError("The server did not start")
+            time.sleep(0.05)
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join()
+        self.loop.close()
+
+    async def get_workers(self):
+        # Busy and total worker threads, read on the server loop where the limiter lives
+        async def read():
+            limiter = anyio.to_thread.current_default_thread_limiter()
+            return limiter.borrowed_tokens, limiter.total_tokens
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(read(), self.loop))
+
+
+@dataclass
+class Sample:
+    endpoint: str
+    start: float
+    latency: float
+    status: object
+    ok: bool
+
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name.strip() not in SCENARIOS:
+            raise ValueError(f"Unknown scenario '{name.strip()}', choose from {', '.join(SCENARIOS)}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+def build_request(step, session):
+    if step == "greetings":
+        return "GET", "/api/greetings", None
+    if step == "ask":
+        return "POST", "/api/ask", {"session_id": session["id"], "question": random.choice(QUESTIONS)}
+    if step == "history":
+        return "GET", f"/api/history/{session['id']}", None
+    if step == "feedback":
+        last = session.get("last") or {"question": random.choice(QUESTIONS), "answer": "No answer yet"}
+        return "POST", "/api/feedback", {"session_id": session["id"], "question": last["question"], "answer": last["answer"], "like": random.random() < 0.8}
+    if step == "feedback_count":
+        return "GET", "/api/feedback", None
+    if step == "agents":
+        return "GET", "/api/agents", None
+    raise ValueError(f"Unknown step '{step}'")
+
+async def send(client, step, session, samples):
+    method, path, body = build_request(step, session)
+    start = time.perf_counter()
+    try:
+        response = await client.request(method, path, json=body)
+        status, ok = response.status_code, response.status_code < 400
+        if ok and step == "ask":
+            session["last"] = response.json()
+    except httpx.HTTPError as e:
+        status, ok = type(e).__name__, False
+    samples.append(Sample(step, start, time.perf_counter() - start, status, ok))
+
+async def run_user(client, user, options, weights, end, samples):
+    # Users join evenly over the ramp, then run conversations until the end of the test
+    await asyncio.sleep(options.ramp * user / options.users)
+    while time.perf_counter() < end:
+        scenario = random.choices(list(weights), weights=list(weights.values()))[0]
+        session = {"id": f"loadtest-{uuid.uuid4().hex}"}
+        for step in SCENARIOS[scenario]:
+            if time.perf_counter() >= end:
+                return
+            await send(client, step, session, samples)
+            if options.think_time:
+                await asyncio.sleep(random.expovariate(1 / options.think_time))
+
+async def sample_workers(server, end, interval, workers):
+    while time.perf_counter() < end:
+        workers.append(await server.get_workers())
+        await asyncio.sleep(interval)
+
+async def generate_load(url, options, server=None):
+    weights = parse_mix(options.mix)
+    samples, workers = [], []
+    limits = httpx.Limits(max_connections=options.users, max_keepalive_connections=options.users)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=options.timeout) as client:
+        start = time.perf_counter()
+        end = start + options.duration
+        tasks = [run_user(client, user, options, weights, end, samples) for user in range(options.users)]
+        if server is not None:
+            tasks.append(sample_workers(server, end, options.sample_interval, workers))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+    return summarize(samples, elapsed, workers)
+
+
+def percentile(values, q):
+    # Nearest rank on the sorted values
+    if not values:
+        return 0
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+def summarize_samples(samples, duration):
+    latencies = sorted(sample.latency for sample in samples)
+    errors = sum(not sample.ok for sample in samples)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": errors / len(samples) if samples else 0,
+        "throughput": len(samples) / duration if duration else 0,
+        "latency": {
+            **{ f"p{q}": percentile(latencies, q) for q in PERCENTILES },
+            "mean": sum(latencies) / len(latencies) if latencies else 0,
+            "max": latencies[-1] if latencies else 0
+        },
+        "status": { str(status): sum(sample.status == status for sample in samples) for status in {sample.status for sample in samples} }
+    }
+
+def summarize(samples, duration, workers):
+    endpoints = {}
+    for sample in samples:
+        endpoints.setdefault(sample.endpoint, []).append(sample)
+    report = {
+        "duration": duration,
+        "total": summarize_samples(samples, duration),
+        "endpoints": { endpoint: summarize_samples(endpoint_samples, duration) for endpoint, endpoint_samples in sorted(endpoints.items()) },
+        "workers": None
+    }
+    if workers:
+        # Share of the sampled time every worker thread of the sync endpoints was busy
+        busy = [borrowed for borrowed, _ in workers]
+        total = workers[-1][1]
+        report["workers"] = {
+            "threads": total,
+            "busy_mean": sum(busy) / len(busy),
+            "busy_max": max(busy),
+            "saturated": sum(borrowed >= threads for borrowed, threads in workers) / len(workers)
+        }
+    return report
+
+def format_report(report):
+    total = report["total"]
+    lines = [
+        f"{total['requests']} requests in {report['duration']:.1f}s, {total['throughput']:.1f} req/s, {total['errors']} errors ({total['error_rate']:.1%})",
+        "",
+        f"{'endpoint':<16}{'requests':>9}{'errors':>8}{'req/s':>8}" + "".join(f"{f'p{q} ms':>9}" for q in PERCENTILES) + f"{'max ms':>9}"
+    ]
+    for endpoint, stats in list(report["endpoints"].items()) + [("total", total)]:
+        latency = stats["latency"]
+        lines.append(
+            f"{endpoint:<16}{stats['requests']:>9}{stats['errors']:>8}{stats['throughput']:>8.1f}"
+            + "".join(f"{latency[f'p{q}'] * 1000:>9.0f}" for q in PERCENTILES) + f"{latency['max'] * 1000:>9.0f}"
+        )
+    workers = report["workers"]
+    lines.append("")
+    if workers:
+        lines.append(f"Worker threads: {workers['busy_mean']:.1f} busy on average, {workers['busy_max']} at most, of {workers['threads']} ({workers['saturated']:.0%} of the time all busy)")
+    else:
+        lines.append("Worker threads: not sampled for a remote server")
+    return "\n".join(lines)
+
+
+def run_load_test(options):
+    # Against a running deployment when a URL is given, otherwise against the app with simulated backends
+    if options.url:
+        return asyncio.run(generate_load(options.url, options))
+
+    import main as backend
+    initial_setup = backend.initial_setup
+    backend.initial_setup = lambda: build_setup(options)
+    server = Server(backend.app, options.threads)
+    try:
+        server.start()
+        return asyncio.run(generate_load(server.url, options, server))
+    finally:
+        if server.thread is not None:
+            server.stop()
+        backend.initial_setup = initial_setup
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Load test the backend endpoints with scripted conversations.")
+    parser.add_argument("--url", help="backend to test, by default the app is served here with simulated backends")
+    parser.add_argument("--users", type=int, default=20, help="concurrent virtual users")
+    parser.add_argument("--ramp", type=float, default=10, help="seconds until every user has joined")
+    parser.add_argument("--duration", type=float, default=60, help="seconds the test runs, ramp included")
+    parser.add_argument("--think-time", type=float, default=1, help="mean seconds a user waits between requests")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"weights of the scenarios ({', '.join(SCENARIOS)})")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds before a request is counted as failed")
+    parser.add_argument("--threads", type=int, help="worker threads of the sync endpoints, defaults to anyio's 40")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="median seconds of a simulated LLM call")
+    parser.add_argument("--llm-sigma", type=float, default=0.5, help="spread of the simulated LLM latencies")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="share of simulated LLM calls throttled with a 429")
+    parser.add_argument("--fetch-latency", type=float, default=0.2, help="median seconds of a simulated document search")
+    parser.add_argument("--fetch-sigma", type=float, default=0.5, help="spread of the simulated search latencies")
+    parser.add_argument("--history-answer-rate", type=float, default=0.2, help="share of agents answering from the chat history")
+    parser.add_argument("--sample-interval", type=float, default=0.25, help="seconds between worker thread samples")
+    parser.add_argument("--seed", type=int, help="seed for a repeatable mix of requests and latencies")
+    parser.add_argument("--json", help="also write the report to this file")
+    return parser
+
+def main(argv=None):
+    options = get_parser().parse_args(argv)
+    if options.seed is not None:
+        random.seed(options.seed)
+    report = run_load_test(options)
+    print(format_report(report))
+    if options.json:
+        with open(options.json, "w") as file:
+            json.dump(report, file, indent=2)
+    return 1 if report["total"]["errors"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
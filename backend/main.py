@@ -1,8 +1,13 @@
 import os
 import uuid
+import hashlib
+import logging
+from typing import Annotated, Optional
+from concurrent.futures import ThreadPoolExecutor
 from http.client import HTTPException
-from fastapi import FastAPI, Depends
-from config import rag_config, sql_config, csv_config, api_config
+from fastapi import FastAPI, Depends, Request, Header
+from fastapi.responses import PlainTextResponse, JSONResponse
+from config import rag_config, sql_config, csv_config, api_config, logging_config, health_config, history_config, llm_config, greeter_config, ask_config, state_config
 from modules.models import QuestionModel, AnswerModel, FeedbackModel
 from modules.agent_rag import AgentRag
 from modules.agent_sql import AgentSql
@@ -12,54 +17,103 @@ from modules.supervisor import Supervisor
 from modules.summarizer import Summarizer
 from modules.greeter import Greeter
 from modules.graph import Graph
+from modules.metrics import metrics
+from modules.logger import setup_logging, request_id
+from modules.llm import setup_llm
+from modules.state import setup_state, get_backend
+from modules.scheduler import llm_session
+from modules.health import HealthMonitor
+from modules.history import HistorySummarizer, SUMMARY_ROW_KEY
+from modules.utils import window_history
+from modules.cache import TTLCache
+from modules.coalescing import SingleFlight, get_request_key
 from azure.data.tables import TableServiceClient, TableEntity
 
 
+# Logging is configured before anything else so startup messages are captured
+setup_logging(logging_config)
+logger = logging.getLogger(__name__)
+
 # Entry point to use FastAPI
 app = FastAPI()
 
 def initial_setup():
-    print("Running initial setup...")
-
-    # Agents instantiation
-    agent_rag = AgentRag(rag_config)
-    print(f"{agent_rag.name} ready.")
-    agent_sql = AgentSql(sql_config)
-    print(f"{agent_sql.name} ready.")
-    agent_csv = AgentCsv(csv_config)
-    print(f"{agent_csv.name} ready.")
-    agent_api = AgentApi(api_config)
-    print(f"{agent_api.name} ready.")
-    agents = [agent_rag, agent_sql, agent_csv, agent_api]
+    logger.info("Running initial setup...")
+
+    # Caches, rate limiters and in-flight maps keep their state in the backend shared by all the workers
+    setup_state(state_config)
+
+    # Every component shares the same LLM HTTP client
+    setup_llm(llm_config)
+
+    # Agents instantiation, done concurrently since each agent may open remote connections
+    with ThreadPoolExecutor(thread_name_prefix="setup") as executor:
+        agents = list(executor.map(lambda build: build[0](build[1]), [(AgentRag, rag_config), (AgentSql, sql_config), (AgentCsv, csv_config), (AgentApi, api_config)]))
+    for agent in agents:
+        logger.info("%s ready.", agent.name)
 
     # Supervisor & summarizer instantiation
-    supervisor = Supervisor(agents)
-    print("Supervisor ready.")
+    supervisor = Supervisor(agents, history_config["supervisor_tokens"])
+    logger.info("Supervisor ready.")
     summarizer = Summarizer()
-    print("Summarizer ready.")
+    logger.info("Summarizer ready.")
 
     # Graph instantiation
     graph = Graph(supervisor, summarizer, agents)
-    print("Graph ready.")
+    logger.info("Graph ready.")
 
     # Tables instantiation
     table_service = TableServiceClient.from_connection_string(conn_str=os.getenv("AZURE_STORAGE_CONNECTION_STRING"))
     feedback_table = table_service.get_table_client("Feedback")
-    print("Feedback table client ready.")
+    logger.info("Feedback table client ready.")
     history_table = table_service.get_table_client("ChatHistory")
-    print("History table client ready.") 
-
-    # Greeter instantiation
-    greeter = Greeter(agents)
-    print("Greeter ready.")
+    logger.info("History table client ready.")
+    history_summarizer = HistorySummarizer(history_table, history_config)
+    logger.info("History summarizer ready.")
+
+    # Greeter instantiation, the greetings are generated in the background
+    greeter = Greeter(agents, greeter_config)
+    greeter.start()
+    logger.info("Greeter ready.")
+
+    # Health monitor instantiation
+    health = HealthMonitor(agents, health_config)
+    health.start()
+    logger.info("Health monitor ready.")
     
-    return { "graph": graph, "feedback_table": feedback_table, "history_table": history_table, "agents": agents, "greeter": greeter }
+    # Questions in flight and answers stored by idempotency key
+    single_flight = SingleFlight("ask", get_backend())
+    idempotency_cache = TTLCache(maxsize=ask_config["idempotency_entries"], ttl=ask_config["idempotency_ttl"], name="idempotency", backend=get_backend())
+
+    return { "graph": graph, "feedback_table": feedback_table, "history_table": history_table, "history_summarizer": history_summarizer, "agents": agents, "greeter": greeter, "health": health, "single_flight": single_flight, "idempotency_cache": idempotency_cache }
 
 # Store initial setup in the application state during startup
 @app.on_event("startup")
 async def startup():
     app.state.setup = initial_setup()
 
+# Stop background workers on shutdown
+@app.on_event("shutdown")
+async def shutdown():
+    setup = getattr(app.state, 'setup', {})
+    if "health" in setup:
+        setup["health"].stop()
+    if "history_summarizer" in setup:
+        setup["history_summarizer"].stop()
+    if "greeter" in setup:
+        setup["greeter"].stop()
+
+# Tag every request with a correlation id, taken from the caller when provided
+@app.middleware("http")
+async def add_request_id(request: Request, call_next):
+    token = request_id.set(request.headers.get("X-Request-ID") or uuid.uuid4().hex)
+    try:
+        response = await call_next(request)
+        response.headers["X-Request-ID"] = request_id.get()
+        return response
+    finally:
+        request_id.reset(token)
+
 # Dependency to retrieve agents and graph
 def get_setup():
     return getattr(app.state, 'setup', {})
@@ -70,18 +124,39 @@ def get_setup():
 def ping():
     return "pong"
 
+# Endpoint to expose latency and token metrics in Prometheus format
+@app.get("/api/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    return metrics.render()
+
 # Endpoint to check the status of each agent
 @app.get("/api/agents")
 def ping_agents(setup: dict = Depends(get_setup)):
-    agents = []
-    for agent in setup["agents"]:
-        status = agent.check_connection()
-        agents.append({ "agent": agent.name, "healthy": status["healthy"], "info": status["info"] })
-    return agents
+    return setup["health"].check_all()
 
 # This endpoint receives a prompt and generates a response
 @app.post("/api/ask")
-def generate_answer(body: QuestionModel, setup: dict = Depends(get_setup)):
+def generate_answer(body: QuestionModel, setup: dict = Depends(get_setup), idempotency_key: Annotated[Optional[str], Header()] = None):
+    if not idempotency_key:
+        return answer_question(body, setup)
+
+    # A retried request gets the response stored for the first one, waiting for it if it is still running.
+    # The response is stored with a hash of the request, so a key reused for another question is rejected.
+    key = f"{body.session_id}:{idempotency_key}"
+    request_hash = hashlib.sha256(body.model_dump_json().encode()).hexdigest()
+    idempotency_cache = setup["idempotency_cache"]
+    def answer_once():
+        stored = idempotency_cache.get(key)
+        if stored is None:
+            stored = { "request": request_hash, "response": answer_question(body, setup) }
+            idempotency_cache.set(key, stored)
+        return stored
+    stored = setup["single_flight"].run(("idempotency", key), answer_once)
+    if stored["request"] != request_hash:
+        return JSONResponse(status_code=422, content={"detail": "The Idempotency-Key was already used for a different request"})
+    return stored["response"]
+
+def answer_question(body, setup):
     session_id = body.session_id
     prompt = body.question
     graph = setup["graph"]
@@ -89,13 +164,22 @@ def generate_answer(body: QuestionModel, setup: dict = Depends(get_setup)):
     # Retrieve conversation history or start a new one
     session_history = get_chat_history(session_id, setup)
 
+    # The LLM calls of this question are queued fairly against the other sessions
+    token = llm_session.set(session_id)
     try:
-        result = graph.invoke({ "question": prompt, "history": session_history })
+        # The same question asked on top of the same conversation at the same time runs the graph once
+        key = get_request_key(prompt, session_history)
+        result = setup["single_flight"].run(key, lambda: graph.invoke({ "question": prompt, "history": session_history }))
         response = {"question": prompt, "answer": result["answer"], "session_id": session_id, "agents": result["agents"]}
         add_to_chat_history(AnswerModel(**response), setup=setup)
+
+        # Fold the entries leaving the history window into the session summary, off the request path
+        setup["history_summarizer"].schedule(session_id)
         return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error: {e}")
+    finally:
+        llm_session.reset(token)
 
 
 # This endpoint receives feedback from the user
@@ -141,21 +225,23 @@ def get_chat_history(session_id, setup: dict = Depends(get_setup)):
     history_table = setup["history_table"]
     entities = history_table.query_entities(query_filter=f"PartitionKey eq '{session_id}'")
 
+    # The rolling summary of older entries is stored along with the history
+    entities = list(entities)
+    summaries = [{"role": "summary", "content": entity["content"]} for entity in entities if entity["RowKey"] == SUMMARY_ROW_KEY]
+
     # Sort the entities by timestamp
     sorted_entities = sorted(
-            (dict(entity, Timestamp=entity.metadata["timestamp"]) for entity in entities),
+            (dict(entity, Timestamp=entity.metadata["timestamp"]) for entity in entities if entity["RowKey"] != SUMMARY_ROW_KEY),
             key=lambda x: x["Timestamp"]
         )
-    
-    # Return the latest 2 question-answer pairs
-    filtered_entities = sorted_entities[-4:]
 
     processed_entities = [
         {**{k: v for k, v in d.items() if k != "Timestamp" and k != "RowKey" and k != "PartitionKey"}}
-        for d in filtered_entities
+        for d in sorted_entities
     ]
 
-    return processed_entities
+    # Return the latest question-answer pairs that fit in the token budget, after the summary
+    return window_history(summaries + processed_entities, history_config["max_tokens"], history_config["max_entries"], history_config["max_entry_tokens"])
 
 
 # This endpoint adds a new chat to the chat history for a given session id
@@ -1,28 +1,57 @@
 from .models import State
-from .utils import filter_agent_history
+from .prefetch import Prefetch
+from .utils import filter_agent_history, compact_history
+from .validation import DEFAULT_ALLOWED_IMPORTS, validate_code
+from .serializer import serialize_result
+from .openapi import SpecCache, build_index, get_operation_signature, validate_call, build_request
+from .http_cache import CachedSession, get_exec_globals
+from .llm import get_llm_kwargs
 from langchain_openai import AzureChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnableLambda, RunnablePassthrough
+from langchain_core.runnables import RunnableLambda
 import re
+import threading
 import requests
 import yaml
 import json
+import logging
+
+logger = logging.getLogger(__name__)
 
 class AgentApi:
     
     def __init__(self, config): 
         self.name = f"agent_{config['agent_id']}"
         self.skills = config['agent_directive']
+        # Token budget for the chat history included in each prompt
+        self.history_tokens = config.get("history_tokens", 1000)
+        self.prefetch = config.get("prefetch", True)
         self.spec_url = config["spec_url"]
+        self.spec_format = config["spec_format"]
         self.endpoint_filter = config["endpoint_filter"]
-        self.base_url, self.endpoints, self.spec_data = self.get_spec(config["spec_format"])
+        # 'planner' asks the LLM for a JSON call plan, 'code' generates and runs Python code
+        self.mode = config.get("mode", "code")
+        self.allowed_imports = config.get("allowed_imports", DEFAULT_ALLOWED_IMPORTS)
+        # Results are compacted to this many tokens before answering, optionally keeping only some JSON fields
+        self.result_token_budget = config.get("result_token_budget", 2000)
+        self.result_fields = config.get("result_fields")
+        self.result_excluded_keys = config.get("result_excluded_keys", ())
+        self.spec_cache = SpecCache(config["spec_cache_dir"]) if config.get("spec_cache_dir") else None
+        self.operations = {}
+        self.lock = threading.Lock()
+
+        # Pooled HTTP session with a private cache, shared by the health check and the generated code
+        self.session = CachedSession(pool_size=config.get("http_pool_size", 10), max_entries=config.get("http_cache_entries", 256))
+
+        # API specification (downloaded on first use when the agent is lazy)
+        self.base_url, self.endpoints, self.spec_data = None, [], None
+        if not config.get("lazy_connect"):
+            self.load_spec()
         
-        # LLM instantiation
-        self.llm = AzureChatOpenAI(
-            deployment_name="gpt-4o",
-            api_version="2023-06-01-preview"
-        )
+        # LLM instantiation, each chain runs on the deployment and output limit configured for it
+        self.llms = { chain: AzureChatOpenAI(**get_llm_kwargs(chain)) for chain in ("endpoint_selector_chain", "code_generator_chain", "plan_generator_chain", "code_reviewer_chain", "answer_generator_chain", "entry_point_chain") }
+        self.llm = self.llms["answer_generator_chain"]
 
         # The prompt puts together the system prompt with the user question
         self.prompt = lambda inputs: ChatPromptTemplate.from_messages(
@@ -51,9 +80,9 @@ class AgentApi:
             { "question": RunnableLambda(lambda inputs: inputs["question"]), "endpoints": RunnableLambda(lambda inputs: inputs["endpoints"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.endpoint_selector_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            | self.llms["endpoint_selector_chain"]
             | self.parser
-        )
+        ).with_config(run_name="endpoint_selector_chain")
 
         # A prompt to double check the generated query and adjust if needed
         self.code_generator_prompt = (
@@ -62,12 +91,12 @@ class AgentApi:
             "Respond only with the generated code, nothing else. "
             "When generating the code: "
             "- Understand the context: analyze the user's question and the API details to understand how to make the request. " 
-            "- Use requests library to call the API. "
+            "- Use requests library to call the API (it is already imported). "
             "- Handle edge cases such as missing values or empty datasets gracefully. " 
             "- Ensure the code is executable. "
             "- ALWAYS assign the final result to a variable called 'result'. "
             "\n\n"
-            f"API base url: {self.base_url}"
+            "API base url: {base_url}"
             "\n\n"
             "Endpoint specification: {context}"
             "\n\n"
@@ -77,13 +106,34 @@ class AgentApi:
         )
 
         self.code_generator_chain = (
-            { "question": RunnableLambda(lambda inputs: inputs["question"]), "context": RunnableLambda(lambda inputs: inputs["context"]), "token": RunnableLambda(lambda inputs: inputs["token"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
+            { "question": RunnableLambda(lambda inputs: inputs["question"]), "base_url": RunnableLambda(lambda inputs: inputs["base_url"]), "context": RunnableLambda(lambda inputs: inputs["context"]), "token": RunnableLambda(lambda inputs: inputs["token"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.code_generator_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            | self.llms["code_generator_chain"]
             | self.parser
+        ).with_config(run_name="code_generator_chain")
+
+        # A prompt to plan a single API call as JSON, executed natively instead of running generated code
+        self.plan_generator_prompt = (
+            "You are an API call planner. "
+            "Given an input question and the available operations, choose the operation that answers the question and its parameters. "
+            "Respond only with a JSON object, nothing else, with this format: "
+            '{{"operation": "<operationId or path>", "parameters": {{"<parameter name>": <value>}}}}. '
+            "Use only the parameters listed for the chosen operation and always include the required ones. "
+            "\n\n"
+            "Operations: {operations}"
+            "\n\n"
+            "Chat history: {history}"
         )
 
+        self.plan_generator_chain = (
+            { "question": RunnableLambda(lambda inputs: inputs["question"]), "operations": RunnableLambda(lambda inputs: inputs["operations"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
+            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
+            | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.plan_generator_prompt, "human_prompt": inputs["question"]}))
+            | self.llms["plan_generator_chain"]
+            | self.parser
+        ).with_config(run_name="plan_generator_chain")
+
         # A prompt to double check the generated code and adjust if needed
         self.code_reviewer_prompt = (
             "You are a Python expert with a strong attention to detail. "
@@ -91,16 +141,17 @@ class AgentApi:
             "Ensure the final result is assigned to a variable called 'result'. "
             "Ensure the code is executable. "
             "If you see any mistakes, rewrite the code. If there are no mistakes, just reproduce the original code. "
+            "The following issues were already found in the code: {issues} "
             "Respond only with the rewritten code or the original code, nothing else. "
         )
 
         self.code_reviewer_chain = (
-            { "code": RunnablePassthrough() }
+            { "code": RunnableLambda(lambda inputs: inputs["code"]), "issues": RunnableLambda(lambda inputs: inputs["issues"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.code_reviewer_prompt, "human_prompt": inputs["code"]}))
-            | self.llm
+            | self.llms["code_reviewer_chain"]
             | self.parser
-        )
+        ).with_config(run_name="code_reviewer_chain")
 
         # A prompt to generate an answer to the question given the information pulled from the csv
         self.answer_generator_prompt = (
@@ -121,9 +172,9 @@ class AgentApi:
             { "question": RunnableLambda(lambda inputs: inputs["question"]), "code": RunnableLambda(lambda inputs: inputs["code"]), "result": RunnableLambda(lambda inputs: inputs["result"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.answer_generator_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            | self.llms["answer_generator_chain"]
             | self.parser
-        )
+        ).with_config(run_name="answer_generator_chain")
 
         self.entry_point_prompt = (
             "You are an AI assistant for question-answering tasks. "
@@ -142,32 +193,63 @@ class AgentApi:
             { "question": RunnableLambda(lambda inputs: inputs["question"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.entry_point_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            | self.llms["entry_point_chain"]
             | self.parser
-        )
+        ).with_config(run_name="entry_point_chain")
+
+    @property
+    def ready(self):
+        return self.spec_data is not None
+
+    def load_spec(self):
+        # Download the specification only once even if several requests arrive together
+        if self.spec_data is None:
+            with self.lock:
+                if self.spec_data is None:
+                    spec = self.get_spec(self.spec_format)
+                    if spec is not None:
+                        self.base_url, self.endpoints, self.spec_data = spec
+        return self.spec_data
 
     def check_connection(self):
-        print(f"{self.name} says: checking connection to API...")
+        logger.info("%s says: checking connection to API...", self.name)
+        self.load_spec()
         try:
             username = "fabimass"
             url = f"https://api.github.com/users/{username}/repos"
-            response = requests.get(url)
+            response = self.session.get(url)
 
             if response.status_code == 200:
-                print(f"{self.name} says: connection up and running.")
+                logger.info("%s says: connection up and running.", self.name)
                 return { "healthy": True, "info": "Agent up and running" }
             else:
-                print(f"{self.name} says: connection failed.")
+                logger.warning("%s says: connection failed.", self.name)
                 return { "healthy": False, "info": response.status_code }
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            logger.error("%s says: ERROR %s", self.name, e)
             return { "healthy": False, "info": e }
 
     def get_spec(self, format):
-        print(f"{self.name} says: retrieving api specification...")
+        logger.info("%s says: retrieving api specification...", self.name)
 
         try:
-            response = requests.get(self.spec_url)
+            # Revalidate the cached copy (if any) instead of downloading and parsing the whole specification
+            cache_key = f"{self.spec_url}|{format}|{','.join(self.endpoint_filter)}"
+            cached = self.spec_cache.load(cache_key) if self.spec_cache else None
+            headers = { "If-None-Match": cached["etag"] } if cached and cached.get("etag") else {}
+            try:
+                response = requests.get(self.spec_url, headers=headers)
+            except Exception as e:
+                if cached is None:
+                    raise
+                logger.warning("%s says: using cached api specification, download failed: %s", self.name, e)
+                response = None
+
+            if cached and (response is None or response.status_code == 304):
+                logger.info("%s says: api specification loaded from cache.", self.name)
+                self.operations = cached["operations"]
+                return cached["base_url"], [tuple(endpoint) for endpoint in cached["endpoints"]], cached["spec"]
+
             spec = response.text
 
             if format == "yaml":
@@ -177,40 +259,47 @@ class AgentApi:
                 # JSON specification
                 openapi_data = json.loads(spec)
             
+            # Take only the GET endpoints and specific endpoints if specified, with their references resolved
+            self.operations = build_index(openapi_data, self.endpoint_filter)
             endpoints = []
-            for path, methods in openapi_data["paths"].items():
+            for path, methods in self.operations.items():
                 for method, details in methods.items():
-                    # Take only the GET endpoints nas specific endpoints if specified
-                    if method == "get" and (any(keyword in path for keyword in self.endpoint_filter) or len(self.endpoint_filter)==0):
-                        summary = details.get("summary", "No summary")
-                        endpoints.append((method.upper(), path, summary))
+                    summary = details.get("summary", "No summary")
+                    endpoints.append((method.upper(), path, summary))
 
             servers = openapi_data.get("servers", [])
             base_url = servers[0].get("url", None)
 
-            print(f"{self.name} says:\n {base_url}\n {endpoints[:5]}")
+            etag = response.headers.get("ETag") if self.spec_cache else None
+            if isinstance(etag, str):
+                # Only the indexed paths are kept in the cached copy of the specification
+                slim_spec = { "servers": servers, "paths": {path: openapi_data["paths"][path] for path in self.operations} }
+                self.spec_cache.save(cache_key, { "etag": etag, "base_url": base_url, "endpoints": endpoints, "operations": self.operations, "spec": slim_spec })
+
+            logger.debug("%s says:\n %s\n %s", self.name, base_url, endpoints[:5])
             return base_url, endpoints, openapi_data
        
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            logger.error("%s says: ERROR %s", self.name, e)
             return None   
 
     def get_relevant_endpoints(self, question, history):
-        print(f"{self.name} says: getting relevant endpoints...")
+        logger.info("%s says: getting relevant endpoints...", self.name)
+        self.load_spec()
         endpoints = self.endpoint_selector_chain.invoke({"question": question, "endpoints": self.endpoints, "history": history})
         if endpoints == "":
             endpoints_list = []
         else:
             endpoints_list = endpoints.replace(" ", "").split(",")
-        print(f"{self.name} says: {endpoints_list}")
+        logger.debug("%s says: %s", self.name, endpoints_list)
         return endpoints_list
 
     def get_endpoint_details(self, endpoints_list):
-        print(f"{self.name} says: getting endpoint details...")
+        logger.info("%s says: getting endpoint details...", self.name)
         endpoint_details = {}
         for endpoint in endpoints_list:
-            details = self.spec_data["paths"].get(endpoint)
-            print(f"{self.name} says:\n {details}")
+            details = self.operations.get(endpoint)
+            logger.debug("%s says:\n %s", self.name, details)
             endpoint_details[endpoint] = details
         return endpoint_details
     
@@ -218,29 +307,77 @@ class AgentApi:
         return ""
 
     def generate_code(self, question, context, history):
-        print(f"{self.name} says: generating code...")
+        logger.info("%s says: generating code...", self.name)
         token = self.get_token()
-        code = self.code_generator_chain.invoke({"question": question, "context": context, "token": token, "history": history})
-        print(f"{self.name} says: {code}")
+        code = self.code_generator_chain.invoke({"question": question, "base_url": self.base_url, "context": context, "token": token, "history": history})
+        logger.debug("%s says: %s", self.name, code)
 
-        print(f"{self.name} says: reviewing code...")
-        reviewed_code = self.code_reviewer_chain.invoke(code.replace("{", "{{").replace("}", "}}"))
-        print(f"{self.name} says: {reviewed_code}")
-        
-        cleaned_code = re.sub(r"^```python\n", "", reviewed_code)  # Remove start markdown
+        # Only ask the LLM to review the code when the local validation finds something wrong
+        cleaned_code = self.clean_code(code)
+        issues = validate_code(cleaned_code, self.allowed_imports)
+        if not issues:
+            return cleaned_code
+
+        logger.info("%s says: reviewing code (%s)...", self.name, "; ".join(issues))
+        reviewed_code = self.code_reviewer_chain.invoke({"code": code.replace("{", "{{").replace("}", "}}"), "issues": "; ".join(issues)})
+        logger.debug("%s says: %s", self.name, reviewed_code)
+        return self.clean_code(reviewed_code)
+
+    @staticmethod
+    def clean_code(code):
+        cleaned_code = re.sub(r"^```python\n", "", code)  # Remove start markdown
         cleaned_code = re.sub(r"\n```$", "", cleaned_code)  # Remove end markdown
         return cleaned_code
     
+    def generate_plan(self, question, endpoints_list, history):
+        logger.info("%s says: planning api call...", self.name)
+        operations = { endpoint: get_operation_signature(self.operations[endpoint]["get"]) for endpoint in endpoints_list if "get" in self.operations.get(endpoint, {}) }
+        if not operations:
+            return None
+        raw_plan = self.plan_generator_chain.invoke({"question": question, "operations": operations, "history": history})
+        logger.debug("%s says: %s", self.name, raw_plan)
+
+        cleaned_plan = re.sub(r"^```(json)?\n", "", raw_plan.strip())  # Remove start markdown
+        cleaned_plan = re.sub(r"\n```$", "", cleaned_plan)  # Remove end markdown
+        try:
+            plan = json.loads(cleaned_plan)
+        except ValueError:
+            logger.warning("%s says: the plan is not valid JSON, falling back to code generation.", self.name)
+            return None
+
+        _, _, errors = validate_call(plan, self.operations)
+        if errors:
+            logger.warning("%s says: invalid plan (%s), falling back to code generation.", self.name, "; ".join(errors))
+            return None
+        return plan
+
+    def run_plan(self, plan):
+        path, operation, errors = validate_call(plan, self.operations)
+        if errors:
+            raise ValueError(f"Invalid plan: {'; '.join(errors)}")
+        url, query, headers = build_request(self.base_url, path, operation, plan.get("parameters") or {})
+
+        logger.info("%s says: calling %s...", self.name, path)
+        response = self.session.get(url, params=query, headers=headers)
+        try:
+            result = response.json()
+        except ValueError:
+            result = response.text
+        if response.status_code >= 400:
+            result = { "status_code": response.status_code, "error": result }
+        logger.debug("%s says: %s", self.name, result)
+        return result
+
     def run_code(self, code):
         safe_locals = {}
-        print(f"{self.name} says: executing code...")
-        exec(code, globals(), safe_locals)
+        logger.info("%s says: executing code...", self.name)
+        exec(code, get_exec_globals(self.session, globals()), safe_locals)
         result = safe_locals['result']
-        print(f"{self.name} says: {result}")
+        logger.debug("%s says: %s", self.name, result)
         return result
     
     def generate_answer(self, state: State):
-        print(f"{self.name} says: received question '{state['question']}'")
+        logger.info("%s says: received question '%s'", self.name, state['question'])
         
         if "agents" not in state:
             state["agents"] = {}
@@ -248,32 +385,46 @@ class AgentApi:
         try:
             # Filter agent history
             agent_history = filter_agent_history(state["history"], self.name)
+            agent_history = compact_history(agent_history, self.history_tokens)
+
+            # Start selecting the endpoints while the entry point decides whether they are needed
+            prefetch = Prefetch(self.name, self.get_relevant_endpoints, state['question'], agent_history, enabled=self.prefetch)
 
             # Check if it can answer the question right away or if it needs to continue
             answer = self.entry_point_chain.invoke({"question": state["question"], "history": agent_history})
-            print(f"{self.name} says: {answer}")
+            logger.debug("%s says: %s", self.name, answer)
             if answer == 'CONTINUE':
                 # Get relevant endpoints
-                relevant_endpoints = self.get_relevant_endpoints(state['question'], agent_history)
+                relevant_endpoints = prefetch.result()
 
-                # Get relevant endpoints details
-                context = self.get_endpoint_details(relevant_endpoints)
+                # In planner mode, plan a single call and run it without generating code
+                plan = self.generate_plan(state['question'], relevant_endpoints, agent_history) if self.mode == "planner" else None
 
-                # Generate Python code to interact with the files
-                code = self.generate_code(state['question'], context, agent_history)
+                if plan is not None:
+                    code = json.dumps(plan)
+                    result = self.run_plan(plan)
+                else:
+                    # Get relevant endpoints details
+                    context = self.get_endpoint_details(relevant_endpoints)
 
-                # Execute the code
-                result = self.run_code(code)
+                    # Generate Python code to interact with the files
+                    code = self.generate_code(state['question'], context, agent_history)
+
+                    # Execute the code
+                    result = self.run_code(code)
 
                 # Finally answer the question
-                print(f"{self.name} says: generating answer...")
-                answer = self.answer_generator_chain.invoke({"question": state["question"], "code": code.replace("{", "{{").replace("}", "}}"), "result": result, "history": agent_history})
-                print(f"{self.name} says: {answer}")
-            
+                logger.info("%s says: generating answer...", self.name)
+                answer = self.answer_generator_chain.invoke({"question": state["question"], "code": code.replace("{", "{{").replace("}", "}}"), "result": serialize_result(result, self.result_token_budget, self.result_fields, self.result_excluded_keys), "history": agent_history})
+                logger.debug("%s says: %s", self.name, answer)
+            else:
+                # Answered from the history, the prefetched data is not needed
+                prefetch.discard()
+
             state["agents"][f"{self.name}"] = answer
             return state
         
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            logger.error("%s says: ERROR %s", self.name, e)
             state["agents"][f"{self.name}"] = "I don't know"
             return state
\ No newline at end of file
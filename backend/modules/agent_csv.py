@@ -1,30 +1,69 @@
 from .models import State
-from .utils import filter_agent_history
-from langchain_openai import AzureChatOpenAI
+from .prefetch import Prefetch
+from .utils import filter_agent_history, compact_history
+from .validation import DEFAULT_ALLOWED_IMPORTS, validate_code
+from .serializer import serialize_result
+from .frame_cache import frame_cache
+from .file_index import FileIndex
+from .profiles import format_profile, answer_from_profiles
+from .metrics import metrics
+from .llm import get_llm_kwargs
+from langchain_openai import AzureOpenAIEmbeddings, AzureChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnableLambda, RunnablePassthrough
+from langchain_core.runnables import RunnableLambda
 from azure.storage.blob import BlobServiceClient
+from azure.core.exceptions import ResourceNotFoundError
 from io import StringIO
+import json
 import re
-import pandas as pd
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Stands for the code in the answer prompt when the result comes from the column profiles
+PROFILE_CODE = "# No code was run, the result comes from the column profiles computed when the files were ingested"
 
 class AgentCsv:
     
     def __init__(self, config): 
         self.name = f"agent_{config['agent_id']}"
         self.skills = config['agent_directive']
+        # Token budget for the chat history included in each prompt
+        self.history_tokens = config.get("history_tokens", 1000)
+        self.prefetch = config.get("prefetch", True)
         self.config = config
         self.status = ""
+        self.lock = threading.Lock()
+        self.index_file_name = config["index_file_name"]
+        self.profiles_file_name = config.get("profiles_file_name", "index.profiles.json")
+        self.container_name = config["container_name"]
+        self.connection_string = config["connection_string"]
+        self.allowed_imports = config.get("allowed_imports", DEFAULT_ALLOWED_IMPORTS)
+        # Results are compacted to this many tokens before answering, optionally keeping only some JSON fields
+        self.result_token_budget = config.get("result_token_budget", 2000)
+        self.result_fields = config.get("result_fields")
+        self.result_excluded_keys = config.get("result_excluded_keys", ())
+        # Parsed files are shared by the whole process within this memory budget
+        if "frame_cache_bytes" in config:
+            frame_cache.resize(config["frame_cache_bytes"])
+        # Smaller numeric types only when asked for, they can change the results of the generated code
+        frame_cache.downcast = config.get("frame_downcast", False)
+        # Files are picked from a local search index, the LLM only chooses when the search is not conclusive
+        self.max_files = config.get("max_files", 3)
+        self.file_score_ratio = config.get("file_score_ratio", 0.5)
+        self.index_embeddings = config.get("index_embeddings")
+        self.index_lock = threading.Lock()
+        self.file_index = None
+        self.file_index_source = None
         
-        # Blob storage instantiation
-        self.blob_service_client = self.connect()
+        # Blob storage instantiation (deferred until first use when the agent is lazy)
+        self.blob_service_client = None if config.get("lazy_connect") else self.connect()
         
-        # LLM instantiation
-        self.llm = AzureChatOpenAI(
-            deployment_name="gpt-4o",
-            api_version="2023-06-01-preview"
-        )
+        # LLM instantiation, each chain runs on the deployment and output limit configured for it
+        self.llms = { chain: AzureChatOpenAI(**get_llm_kwargs(chain)) for chain in ("file_selector_chain", "code_generator_chain", "code_reviewer_chain", "answer_generator_chain", "entry_point_chain") }
+        self.llm = self.llms["answer_generator_chain"]
 
         # The prompt puts together the system prompt with the user question
         self.prompt = lambda inputs: ChatPromptTemplate.from_messages(
@@ -53,9 +92,9 @@ class AgentCsv:
             { "question": RunnableLambda(lambda inputs: inputs["question"]), "index": RunnableLambda(lambda inputs: inputs["index"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.file_selector_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            | self.llms["file_selector_chain"]
             | self.parser
-        )
+        ).with_config(run_name="file_selector_chain")
 
         # A prompt to double check the generated query and adjust if needed
         self.code_generator_prompt = (
@@ -70,17 +109,8 @@ class AgentCsv:
             "- ALWAYS assign the final result to a variable called 'result'. "
             "- DO NOT attempt to modify the data in the csv files. "
             "\n\n"
-            f"CSV files location: Azure storage account. Container name: {self.container_name}. Connection string: {self.connection_string}"
-            "\n\n"
-            "Use the following function to load csv files: "
-            """```python
-            def load_csv_file(file_name, blob_container, blob_service_client):
-                blob_client = blob_service_client.get_blob_client(container=blob_container, blob=file_name)
-                blob_data = blob_client.download_blob().content_as_text()
-                csv_data = StringIO(blob_data)
-                return pd.read_csv(csv_data)
-            ```
-            """
+            "Load the csv files with the function load_csv_file(file_name), which is already defined and returns a pandas DataFrame. "
+            "Do not define it again nor load the files in any other way. "
             "\n\n"
             "Context: {context}"
             "\n\n"
@@ -91,9 +121,9 @@ class AgentCsv:
             { "question": RunnableLambda(lambda inputs: inputs["question"]), "context": RunnableLambda(lambda inputs: inputs["context"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.code_generator_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            | self.llms["code_generator_chain"]
             | self.parser
-        )
+        ).with_config(run_name="code_generator_chain")
 
         # A prompt to double check the generated code and adjust if needed
         self.code_reviewer_prompt = (
@@ -102,16 +132,17 @@ class AgentCsv:
             "Ensure the final result is assigned to a variable called 'result'. "
             "Ensure the code is executable. "
             "If you see any mistakes, rewrite the code. If there are no mistakes, just reproduce the original code. "
+            "The following issues were already found in the code: {issues} "
             "Respond only with the rewritten code or the original code, nothing else. "
         )
 
         self.code_reviewer_chain = (
-            { "code": RunnablePassthrough() }
+            { "code": RunnableLambda(lambda inputs: inputs["code"]), "issues": RunnableLambda(lambda inputs: inputs["issues"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.code_reviewer_prompt, "human_prompt": inputs["code"]}))
-            | self.llm
+            | self.llms["code_reviewer_chain"]
             | self.parser
-        )
+        ).with_config(run_name="code_reviewer_chain")
 
         # A prompt to generate an answer to the question given the information pulled from the csv
         self.answer_generator_prompt = (
@@ -132,9 +163,9 @@ class AgentCsv:
             { "question": RunnableLambda(lambda inputs: inputs["question"]), "code": RunnableLambda(lambda inputs: inputs["code"]), "result": RunnableLambda(lambda inputs: inputs["result"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.answer_generator_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            | self.llms["answer_generator_chain"]
             | self.parser
-        )
+        ).with_config(run_name="answer_generator_chain")
 
         self.entry_point_prompt = (
             "You are an AI assistant for question-answering tasks. "
@@ -153,91 +184,192 @@ class AgentCsv:
             { "question": RunnableLambda(lambda inputs: inputs["question"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.entry_point_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            | self.llms["entry_point_chain"]
             | self.parser
-        )
+        ).with_config(run_name="entry_point_chain")
 
     def connect(self):
-        self.index_file_name = self.config["index_file_name"]
-        self.container_name = self.config["container_name"]
-        self.connection_string = self.config["connection_string"]
-        print(f"{self.name} says: connecting to Azure Blob Storage...")
+        logger.info("%s says: connecting to Azure Blob Storage...", self.name)
         try:
             blob_client = BlobServiceClient.from_connection_string(self.connection_string)
-            print(f"{self.name} says: connection established.")
+            logger.info("%s says: connection established.", self.name)
             return blob_client
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            logger.error("%s says: ERROR %s", self.name, e)
             self.status = e
             return None
         
+    @property
+    def ready(self):
+        return self.blob_service_client is not None
+
+    def get_blob_service_client(self):
+        # Connect on first use, only once even if several requests arrive together
+        if self.blob_service_client is None:
+            with self.lock:
+                if self.blob_service_client is None:
+                    self.blob_service_client = self.connect()
+        return self.blob_service_client
+
     def check_connection(self):
-        print(f"{self.name} says: checking connection to storage account...")
+        logger.info("%s says: checking connection to storage account...", self.name)
         try:
             self.blob_service_client.get_blob_client(container=self.container_name, blob=self.index_file_name)
-            print(f"{self.name} says: connection up and running.")
+            logger.info("%s says: connection up and running.", self.name)
             self.status = "up and running"
             return { "healthy": True, "info": self.status }
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            if self.blob_service_client is None:
+                logger.info("%s says: not connected yet.", self.name)
+            else:
+                logger.error("%s says: ERROR %s", self.name, e)
             # Try to reconnect
             self.blob_service_client = self.connect()
             return { "healthy": True if self.blob_service_client is not None else False, "info": self.status }
 
     def get_index(self):
-        print(f"{self.name} says: retrieving index file...")
-        blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=self.index_file_name)
+        import pandas as pd
+        logger.info("%s says: retrieving index file...", self.name)
+        blob_client = self.get_blob_service_client().get_blob_client(container=self.container_name, blob=self.index_file_name)
         blob_data = blob_client.download_blob().content_as_text()
         csv_data = StringIO(blob_data)
         index = pd.read_csv(csv_data)
-        print(f"{self.name} says:\n {index}")
+        logger.debug("%s says:\n %s", self.name, index)
         return index
 
+    def get_profiles(self):
+        # Column profiles of every file, computed at ingestion. Containers ingested before they existed have none.
+        logger.info("%s says: retrieving column profiles...", self.name)
+        blob_client = self.get_blob_service_client().get_blob_client(container=self.container_name, blob=self.profiles_file_name)
+        try:
+            profiles = json.loads(blob_client.download_blob().readall())
+        except ResourceNotFoundError:
+            logger.info("%s says: no column profiles found.", self.name)
+            return {}
+        return profiles.get("files", {})
+
+    def get_catalog(self):
+        index = self.get_index()
+        profiles = self.get_profiles()
+        # The column names make the files easier to find when the index does not list them
+        if profiles and "COLUMNS" not in index.columns:
+            index = index.assign(COLUMNS=[", ".join(column["name"] for column in profiles.get(file, {}).get("columns", [])) for file in index["FILE_NAME"]])
+        return index, profiles
+
+    def get_embeddings(self):
+        if self.index_embeddings == "openai":
+            return AzureOpenAIEmbeddings(model="ada-002", openai_api_version="2024-06-01")
+        return None
+
+    def get_file_index(self, index):
+        # Built again only when the index file changes
+        source = index.to_csv(index=False)
+        with self.index_lock:
+            if self.file_index is None or source != self.file_index_source:
+                logger.info("%s says: indexing %s files...", self.name, len(index))
+                try:
+                    self.file_index = FileIndex.from_frame(index, self.get_embeddings())
+                except Exception as e:
+                    logger.warning("%s says: could not embed the index, using keywords only: %s", self.name, e)
+                    self.file_index = FileIndex.from_frame(index)
+                self.file_index_source = source
+            return self.file_index
+
     def get_relevant_files(self, question, index, history):
-        print(f"{self.name} says: getting relevant files...")
+        logger.info("%s says: getting relevant files...", self.name)
+        try:
+            results = self.get_file_index(index).search(question)
+        except Exception as e:
+            logger.warning("%s says: file search failed: %s", self.name, e)
+            results = []
+        logger.debug("%s says: %s", self.name, results)
+
+        if results:
+            # Files scoring close enough to the best one
+            candidates = [file for file, score in results if score >= results[0][1] * self.file_score_ratio]
+            if len(candidates) <= self.max_files:
+                metrics.inc("csv_file_selection_total", {"method": "index"})
+                return candidates
+            # Too many good candidates, the LLM chooses among them only
+            index = index[index["FILE_NAME"].isin(candidates)]
+
+        # Nothing matches the question itself (e.g. it refers to the chat history), the LLM chooses
+        metrics.inc("csv_file_selection_total", {"method": "llm"})
+        return self.select_files(question, index, history)
+
+    def select_files(self, question, index, history):
+        logger.info("%s says: asking which files are relevant...", self.name)
         files = self.file_selector_chain.invoke({"question": question, "index": index, "history": history})
         if files == "":
             files_list = []
         else:
             files_list = files.replace(" ", "").split(",")
-        print(f"{self.name} says: {files_list}")
+        logger.debug("%s says: %s", self.name, files_list)
         return files_list
     
+    def load_csv_file(self, file_name):
+        # Parsed once per version of the file, the generated code gets a read-only view of the shared frame
+        blob_client = self.get_blob_service_client().get_blob_client(container=self.container_name, blob=file_name)
+        version = blob_client.get_blob_properties().etag
+        return frame_cache.get((self.container_name, file_name), version, lambda: self.read_csv_file(blob_client))
+
+    def read_csv_file(self, blob_client):
+        import pandas as pd
+        logger.info("%s says: parsing %s...", self.name, blob_client.blob_name)
+        blob_data = blob_client.download_blob().content_as_text()
+        return pd.read_csv(StringIO(blob_data))
+
     def get_files_head(self, files_list):
-        print(f"{self.name} says: getting a sample from the files...")
+        logger.info("%s says: getting a sample from the files...", self.name)
         files_head = {}
         for file in files_list:
-            blob_client = self.blob_service_client.get_blob_client(container=self.container_name, blob=file)
-            blob_data = blob_client.download_blob().content_as_text()
-            csv_data = StringIO(blob_data)
-            head = pd.read_csv(csv_data, nrows=5)
-            print(f"{self.name} says:\n {head}")
-            files_head[file] = head.fillna("null").to_dict(orient="records")
+            # The whole file is parsed and cached, the generated code will load it next
+            head = self.load_csv_file(file).head(5)
+            logger.debug("%s says:\n %s", self.name, head)
+            files_head[file] = head.astype(object).where(head.notna(), "null").to_dict(orient="records")
         return files_head
 
+    def get_files_context(self, files_list, profiles):
+        # The profiles describe every row of a file, a sample is downloaded only for files without one
+        context = { file: format_profile(file, profiles[file]) for file in files_list if file in profiles }
+        missing = [file for file in files_list if file not in profiles]
+        if missing:
+            context.update(self.get_files_head(missing))
+        return context
+
     def generate_code(self, question, context, history):
-        print(f"{self.name} says: generating code...")
+        logger.info("%s says: generating code...", self.name)
         code = self.code_generator_chain.invoke({"question": question, "context": context, "history": history})
-        print(f"{self.name} says: {code}")
+        logger.debug("%s says: %s", self.name, code)
 
-        print(f"{self.name} says: reviewing code...")
-        reviewed_code = self.code_reviewer_chain.invoke(code.replace("{", "{{").replace("}", "}}"))
-        print(f"{self.name} says: {reviewed_code}")
-        
-        cleaned_code = re.sub(r"^```python\n", "", reviewed_code)  # Remove start markdown
+        # Only ask the LLM to review the code when the local validation finds something wrong
+        cleaned_code = self.clean_code(code)
+        issues = validate_code(cleaned_code, self.allowed_imports)
+        if not issues:
+            return cleaned_code
+
+        logger.info("%s says: reviewing code (%s)...", self.name, "; ".join(issues))
+        reviewed_code = self.code_reviewer_chain.invoke({"code": code.replace("{", "{{").replace("}", "}}"), "issues": "; ".join(issues)})
+        logger.debug("%s says: %s", self.name, reviewed_code)
+        return self.clean_code(reviewed_code)
+
+    @staticmethod
+    def clean_code(code):
+        cleaned_code = re.sub(r"^```python\n", "", code)  # Remove start markdown
         cleaned_code = re.sub(r"\n```$", "", cleaned_code)  # Remove end markdown
         return cleaned_code
     
     def run_code(self, code):
+        import pandas as pd
         safe_locals = {}
-        print(f"{self.name} says: executing code...")
-        exec(code, globals(), safe_locals)
+        logger.info("%s says: executing code...", self.name)
+        exec(code, {**globals(), "pd": pd, "load_csv_file": self.load_csv_file}, safe_locals)
         result = safe_locals['result']
-        print(f"{self.name} says: {result}")
+        logger.debug("%s says: %s", self.name, result)
         return result
     
     def generate_answer(self, state: State):
-        print(f"{self.name} says: received question '{state['question']}'")
+        logger.info("%s says: received question '%s'", self.name, state['question'])
         
         if "agents" not in state:
             state["agents"] = {}
@@ -245,35 +377,49 @@ class AgentCsv:
         try:
             # Filter agent history
             agent_history = filter_agent_history(state["history"], self.name)
+            agent_history = compact_history(agent_history, self.history_tokens)
+
+            # Start downloading the index and the profiles while the entry point decides whether they are needed
+            prefetch = Prefetch(self.name, self.get_catalog, enabled=self.prefetch)
 
             # Check if it can answer the question right away or if it needs to continue
             answer = self.entry_point_chain.invoke({"question": state["question"], "history": agent_history})
-            print(f"{self.name} says: {answer}")
+            logger.debug("%s says: %s", self.name, answer)
             if answer == 'CONTINUE':
-                # Get index file
-                index = self.get_index()
+                # Get index file and column profiles
+                index, profiles = prefetch.result()
 
                 # Get relevant files
                 relevant_files = self.get_relevant_files(state['question'], index, agent_history)
-                
-                # Get an extract from the relevant files
-                context = self.get_files_head(relevant_files)
 
-                # Generate Python code to interact with the files
-                code = self.generate_code(state['question'], context, agent_history)
+                # Simple questions about the files are answered from their profiles, without running code
+                descriptions = dict(zip(index["FILE_NAME"], index["SUMMARY"].fillna(""))) if "SUMMARY" in index.columns else {}
+                result = answer_from_profiles(state['question'], relevant_files, profiles, descriptions)
+                if result is not None:
+                    logger.info("%s says: answered from the column profiles.", self.name)
+                    code = PROFILE_CODE
+                else:
+                    # Get the profiles or an extract of the relevant files
+                    context = self.get_files_context(relevant_files, profiles)
+
+                    # Generate Python code to interact with the files
+                    code = self.generate_code(state['question'], context, agent_history)
 
-                # Execute the code
-                result = self.run_code(code)
+                    # Execute the code
+                    result = self.run_code(code)
 
                 # Finally answer the question
-                print(f"{self.name} says: generating answer...")
-                answer = self.answer_generator_chain.invoke({"question": state["question"], "code": code.replace("{", "{{").replace("}", "}}"), "result": result, "history": agent_history})
-                print(f"{self.name} says: {answer}")
-            
+                logger.info("%s says: generating answer...", self.name)
+                answer = self.answer_generator_chain.invoke({"question": state["question"], "code": code.replace("{", "{{").replace("}", "}}"), "result": serialize_result(result, self.result_token_budget, self.result_fields, self.result_excluded_keys), "history": agent_history})
+                logger.debug("%s says: %s", self.name, answer)
+            else:
+                # Answered from the history, the prefetched data is not needed
+                prefetch.discard()
+
             state["agents"][f"{self.name}"] = answer
             return state
         
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            logger.error("%s says: ERROR %s", self.name, e)
             state["agents"][f"{self.name}"] = "I don't know"
             return state
\ No newline at end of file
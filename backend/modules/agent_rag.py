@@ -1,27 +1,33 @@
 from .models import State
-from .utils import filter_agent_history
+from .prefetch import Prefetch
+from .utils import filter_agent_history, compact_history
+from .llm import get_llm_kwargs
 from langchain_openai import AzureOpenAIEmbeddings, AzureChatOpenAI
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
-from langchain_community.vectorstores.azuresearch import AzureSearch
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnableLambda
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
 
 class AgentRag:    
     def __init__(self, config):
         self.name = f"agent_{config['agent_id']}"
         self.skills = config['agent_directive']
+        # Token budget for the chat history included in each prompt
+        self.history_tokens = config.get("history_tokens", 1000)
+        self.prefetch = config.get("prefetch", True)
         self.config = config
         self.status = ""
+        self.lock = threading.Lock()
         
-        # Vector store instantiation
-        self.vstore = self.connect()
+        # Vector store instantiation (deferred until first use when the agent is lazy)
+        self.vstore = None if config.get("lazy_connect") else self.connect()
 
-        # LLM instantiation
-        self.llm = AzureChatOpenAI(
-            deployment_name="gpt-4o",
-            api_version="2023-06-01-preview"
-        )
+        # LLM instantiation, each chain runs on the deployment and output limit configured for it
+        self.llms = { chain: AzureChatOpenAI(**get_llm_kwargs(chain)) for chain in ("answer_generator_chain", "entry_point_chain") }
+        self.llm = self.llms["answer_generator_chain"]
 
         # The system prompt guides the agent on how to respond
         self.answer_generator_prompt = (
@@ -52,9 +58,9 @@ class AgentRag:
             { "question": RunnableLambda(lambda inputs: inputs["question"]), "context": RunnableLambda(lambda inputs: inputs["context"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.answer_generator_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            | self.llms["answer_generator_chain"]
             | self.parser
-        )
+        ).with_config(run_name="answer_generator_chain")
 
         self.entry_point_prompt = (
             "You are an AI assistant for question-answering tasks. "
@@ -73,17 +79,21 @@ class AgentRag:
             { "question": RunnableLambda(lambda inputs: inputs["question"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.entry_point_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            | self.llms["entry_point_chain"]
             | self.parser
-        )
+        ).with_config(run_name="entry_point_chain")
 
     def connect(self):
-        print(f"{self.name} says: connecting to vector store...")
+        logger.info("%s says: connecting to vector store...", self.name)
         try:
+            # Imported here, they take a good part of the startup time and are only needed to connect
+            from langchain_community.vectorstores.azuresearch import AzureSearch
+
             # Embeddings model instantiation
             if self.config["embeddings"] == "openai":
                 embeddings = AzureOpenAIEmbeddings(model="ada-002", openai_api_version="2024-06-01")
             elif self.config["embeddings"] == "google":    
+                from langchain_google_genai import GoogleGenerativeAIEmbeddings
                 embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001")
             else:
                 embeddings = AzureOpenAIEmbeddings(model="ada-002", openai_api_version="2024-06-01")
@@ -95,35 +105,50 @@ class AgentRag:
                 index_name=self.config["index_name"],
                 embedding_function=embeddings.embed_query
             )
-            print(f"{self.name} says: connection established.")
+            logger.info("%s says: connection established.", self.name)
             return vstore
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            logger.error("%s says: ERROR %s", self.name, e)
             self.status = e
             return None
 
+    @property
+    def ready(self):
+        return self.vstore is not None
+
+    def get_vstore(self):
+        # Connect on first use, only once even if several requests arrive together
+        if self.vstore is None:
+            with self.lock:
+                if self.vstore is None:
+                    self.vstore = self.connect()
+        return self.vstore
+
     def check_connection(self):
-        print(f"{self.name} says: checking connection to vector store...")
+        logger.info("%s says: checking connection to vector store...", self.name)
         try:
             self.vstore.similarity_search("this is a test", k=1)
-            print(f"{self.name} says: connection up and running.")
+            logger.info("%s says: connection up and running.", self.name)
             self.status = "up and running"
             return { "healthy": True, "info": self.status }
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            if self.vstore is None:
+                logger.info("%s says: not connected yet.", self.name)
+            else:
+                logger.error("%s says: ERROR %s", self.name, e)
             # Try to reconnect
             self.vstore = self.connect()
             return { "healthy": True if self.vstore is not None else False, "info": self.status }
 
     def retrieve_context(self, query):
-        print(f"{self.name} says: retrieving relevant information...")      
-        docs = self.vstore.similarity_search(query, k=3)
-        print(f"{self.name} says: {docs}")
+        logger.info("%s says: retrieving relevant information...", self.name)
+        docs = self.get_vstore().similarity_search(query, k=3)
+        logger.debug("%s says: %s", self.name, docs)
         # Put together the results of the similarity search into one chunk of text
         return "\n\n".join(doc.page_content for doc in docs)
 
     def generate_answer(self, state: State):
-        print(f"{self.name} says: received question '{state['question']}'")
+        logger.info("%s says: received question '%s'", self.name, state['question'])
 
         if "agents" not in state:
             state["agents"] = {}
@@ -131,22 +156,29 @@ class AgentRag:
         try:
             # Filter agent history
             agent_history = filter_agent_history(state["history"], self.name)
+            agent_history = compact_history(agent_history, self.history_tokens)
+
+            # Start retrieving the documents while the entry point decides whether they are needed
+            prefetch = Prefetch(self.name, self.retrieve_context, state['question'], enabled=self.prefetch)
 
             # Check if it can answer the question right away or if it needs to continue
             answer = self.entry_point_chain.invoke({"question": state["question"], "history": agent_history})
-            print(f"{self.name} says: {answer}")
+            logger.debug("%s says: %s", self.name, answer)
             if answer == 'CONTINUE':
                 # Retrieve the most relevant documents from the vector store
-                context = self.retrieve_context(state['question'])
+                context = prefetch.result()
                 
-                print(f"{self.name} says: generating answer...")
+                logger.info("%s says: generating answer...", self.name)
                 answer = self.answer_generator_chain.invoke({"question": state["question"], "context": context, "history": agent_history})
-                print(f"{self.name} says: {answer}")
-            
+                logger.debug("%s says: %s", self.name, answer)
+            else:
+                # Answered from the history, the prefetched data is not needed
+                prefetch.discard()
+
             state["agents"][f"{self.name}"] = answer
             return state
         
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            logger.error("%s says: ERROR %s", self.name, e)
             state["agents"][f"{self.name}"] = "I don't know"
             return state
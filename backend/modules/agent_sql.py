@@ -1,27 +1,55 @@
 from .models import State
-from .utils import filter_agent_history
+from .prefetch import Prefetch
+from .utils import filter_agent_history, compact_history
+from .cache import TTLCache
+from .state import get_backend
+from .metrics import metrics
+from .validation import parse_schema, validate_sql, canonicalize_sql, get_tables
+from .plan_cache import PlanCache
+from .sql_executor import get_engine_args, execute_query
+from .cost_guard import guard_query
+from .serializer import serialize_result
+from .llm import get_llm_kwargs
 from langchain_openai import AzureChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnableLambda, RunnablePassthrough
-from langchain_community.utilities import SQLDatabase
+from langchain_core.runnables import RunnableLambda
 import re
+import time
+import logging
+
+logger = logging.getLogger(__name__)
 
 class AgentSql:
     def __init__(self, config): 
         self.name = f"agent_{config['agent_id']}"
         self.skills = config['agent_directive']
+        # Token budget for the chat history included in each prompt
+        self.history_tokens = config.get("history_tokens", 1000)
+        self.prefetch = config.get("prefetch", True)
         self.config = config
         self.status = ""
+        self.result_token_budget = config.get("result_token_budget", 2000)
+
+        # The schema rarely changes, keep it for a while instead of querying it on every question
+        self.schema_cache = TTLCache(maxsize=1, ttl=config.get("schema_ttl", 300), name="sql_schema", backend=get_backend())
+
+        # Results of recent queries, reporting data changes rarely so they can be shared for a while
+        self.result_cache = TTLCache(maxsize=config.get("result_cache_size", 256), ttl=config.get("result_cache_ttl", 0), name="sql_result", backend=get_backend())
+
+        # Cost guard decisions for the same queries, so a cached result does not wait for a new estimate
+        self.guard_cache = TTLCache(maxsize=config.get("result_cache_size", 256), ttl=config.get("result_cache_ttl", 0), name="sql_guard", backend=get_backend())
+
+        # Validated question -> query pairs, reused for questions with the same shape
+        self.plan_cache = PlanCache(config["plan_cache_path"], max_entries=config.get("plan_cache_size", 500)) if config.get("plan_cache_path") else None
         
-        # Database instantiation 
-        self.db = self.connect()
+        # Database instantiation (deferred until first use when the agent is lazy)
+        self.engine = None
+        self.db = None if config.get("lazy_connect") else self.connect()
         
-        # LLM instantiation
-        self.llm = AzureChatOpenAI(
-            deployment_name="gpt-4o",
-            api_version="2023-06-01-preview"
-        )
+        # LLM instantiation, each chain runs on the deployment and output limit configured for it
+        self.llms = { chain: AzureChatOpenAI(**get_llm_kwargs(chain)) for chain in ("query_generator_chain", "query_reviewer_chain", "answer_generator_chain", "entry_point_chain") }
+        self.llm = self.llms["answer_generator_chain"]
 
         # The prompt puts together the system prompt with the user question
         self.prompt = lambda inputs: ChatPromptTemplate.from_messages(
@@ -48,16 +76,18 @@ class AgentSql:
             "\n\n"
             "Schema description (TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME, DATA_TYPE): {schema}"
             "\n\n"
+            "Examples of similar questions and the queries that answered them: {examples}"
+            "\n\n"
             "Chat history: {history}"
         )
 
         self.query_generator_chain = (
-            { "question": RunnableLambda(lambda inputs: inputs["question"]), "schema": RunnableLambda(lambda inputs: inputs["schema"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
+            { "question": RunnableLambda(lambda inputs: inputs["question"]), "schema": RunnableLambda(lambda inputs: inputs["schema"]), "examples": RunnableLambda(lambda inputs: inputs.get("examples", "none")), "history": RunnableLambda(lambda inputs: inputs["history"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.query_generator_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            | self.llms["query_generator_chain"]
             | self.parser
-        )
+        ).with_config(run_name="query_generator_chain")
 
         # A prompt to double check the generated query and adjust if needed
         self.query_reviewer_prompt = (
@@ -72,17 +102,18 @@ class AgentSql:
             "- Casting to the correct data type. "
             "- Using the proper columns for joins. "
             "- Ensuring TOP is used for limiting rows instead of LIMIT. "
+            "The following issues were already found in the query: {issues} "
             "If there are any of the above mistakes, rewrite the query. If there are no mistakes, just reproduce the original query. "
             "Respond only with the rewritten query or the original query, nothing else. "
         )
 
         self.query_reviewer_chain = (
-            { "query": RunnablePassthrough() }
+            { "query": RunnableLambda(lambda inputs: inputs["query"]), "issues": RunnableLambda(lambda inputs: inputs["issues"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.query_reviewer_prompt, "human_prompt": inputs["query"]}))
-            | self.llm
+            | self.llms["query_reviewer_chain"]
             | self.parser
-        )
+        ).with_config(run_name="query_reviewer_chain")
 
         # A prompt to generate an answer to the question given the information pulled from the database
         self.answer_generator_prompt = (
@@ -103,9 +134,9 @@ class AgentSql:
             { "question": RunnableLambda(lambda inputs: inputs["question"]), "query": RunnableLambda(lambda inputs: inputs["query"]), "result": RunnableLambda(lambda inputs: inputs["result"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.answer_generator_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            | self.llms["answer_generator_chain"]
             | self.parser
-        )
+        ).with_config(run_name="answer_generator_chain")
 
         self.entry_point_prompt = (
             "You are an AI assistant for question-answering tasks. "
@@ -124,64 +155,161 @@ class AgentSql:
             { "question": RunnableLambda(lambda inputs: inputs["question"]), "history": RunnableLambda(lambda inputs: inputs["history"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | RunnableLambda(lambda inputs: self.prompt({"system_prompt": self.entry_point_prompt, "human_prompt": inputs["question"]}))
-            | self.llm
+            | self.llms["entry_point_chain"]
             | self.parser
-        )
+        ).with_config(run_name="entry_point_chain")
 
     def connect(self):
         self.connection_string = self.config["connection_string"]
-        print(f"{self.name} says: connecting to database...")
+        logger.info("%s says: connecting to database...", self.name)
         try:
-            db = SQLDatabase.from_uri(self.connection_string)
-            print(f"{self.name} says: connection established.")
+            # Imported here, they are only needed to connect
+            from langchain_community.utilities.sql_database import SQLDatabase
+            from sqlalchemy import create_engine
+
+            # The queries and their cost estimates run on the pooled engine, SQLDatabase reads the schema
+            self.engine = create_engine(self.connection_string, **get_engine_args(self.config))
+            db = SQLDatabase(self.engine)
+            logger.info("%s says: connection established.", self.name)
             return db
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            logger.error("%s says: ERROR %s", self.name, e)
             self.status = e
             return None
 
+    @property
+    def ready(self):
+        return self.db is not None
+
     def check_connection(self):
-        print(f"{self.name} says: checking connection to database...")
+        logger.info("%s says: checking connection to database...", self.name)
         try:
             self.db.run("""SELECT 1""")
-            print(f"{self.name} says: connection up and running.")
+            logger.info("%s says: connection up and running.", self.name)
             self.status = "up and running"
             return { "healthy": True, "info": self.status }
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            if self.db is None:
+                logger.info("%s says: not connected yet.", self.name)
+            else:
+                logger.error("%s says: ERROR %s", self.name, e)
             # Try to reconnect
             self.db = self.connect()
             return { "healthy": True if self.db is not None else False, "info": self.status }
 
     def get_schema(self):
-        print(f"{self.name} says: retrieving database schema...")
+        schema = self.schema_cache.get("schema")
+        if schema is not None:
+            return schema
+        logger.info("%s says: retrieving database schema...", self.name)
         schema = self.db.run("SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME, DATA_TYPE FROM INFORMATION_SCHEMA.COLUMNS")
-        print(f"{self.name} says: {schema}")
+        logger.debug("%s says: %s", self.name, schema)
+        self.schema_cache.set("schema", schema)
         return schema
 
-    def generate_query(self, question, schema, history):
-        print(f"{self.name} says: generating query...")
-        query = self.query_generator_chain.invoke({"question": question, "schema": schema, "history": history})
-        print(f"{self.name} says: {query}")
-
-        print(f"{self.name} says: reviewing query...")
-        reviewed_query = self.query_reviewer_chain.invoke(query)
-        print(f"{self.name} says: {reviewed_query}")
+    def load_schema(self):
+        self.check_connection()
+        return self.get_schema()
 
-        cleaned_query = re.sub(r"^```sql\n", "", reviewed_query)  # Remove start markdown
+    @staticmethod
+    def clean_query(query):
+        cleaned_query = re.sub(r"^```sql\n", "", query)  # Remove start markdown
         cleaned_query = re.sub(r"\n```$", "", cleaned_query)  # Remove end markdown
         cleaned_query = re.sub(r"\n", " ", cleaned_query) # Replace new line with space
-        cleaned_query = cleaned_query.strip() # Remove leading and trailing whitespace (just in case)   
-        return cleaned_query
+        return cleaned_query.strip() # Remove leading and trailing whitespace (just in case)
+
+    def generate_query(self, question, schema, history):
+        tables = parse_schema(schema)
+        examples = "none"
+        if self.plan_cache is not None:
+            # A question with the same shape was already answered, reuse its query with the new parameters
+            cached_query = self.plan_cache.lookup(question, history)
+            if cached_query is not None and not validate_sql(cached_query, tables):
+                logger.info("%s says: reusing a previous query...", self.name)
+                return cached_query
+            examples = "\n".join(f"Question: {example['question']} Query: {example['query']}" for example in self.plan_cache.examples(question)) or "none"
+
+        logger.info("%s says: generating query...", self.name)
+        query = self.query_generator_chain.invoke({"question": question, "schema": schema, "examples": examples, "history": history})
+        logger.debug("%s says: %s", self.name, query)
+
+        # Only ask the LLM to review the query when the local validation finds something wrong
+        cleaned_query = self.clean_query(query)
+        issues = validate_sql(cleaned_query, tables)
+        if not issues:
+            return cleaned_query
+
+        logger.info("%s says: reviewing query (%s)...", self.name, "; ".join(issues))
+        reviewed_query = self.query_reviewer_chain.invoke({"query": query, "issues": "; ".join(issues)})
+        logger.debug("%s says: %s", self.name, reviewed_query)
+        return self.clean_query(reviewed_query)
     
+    def check_cost(self, query):
+        # Estimates the query plan before running it: cheap queries go through, queries returning too many
+        # rows get a row limit and expensive ones are sent back once to be made more selective
+        key = canonicalize_sql(query)
+        if self.guard_cache.ttl > 0:
+            checked_query = self.guard_cache.get(key)
+            if checked_query is not None:
+                return checked_query
+
+        max_cost = self.config.get("max_query_cost", 100)
+        max_rows = self.config.get("max_rows", 200)
+        guard = guard_query(self.engine, query, max_cost, max_rows)
+        if guard["decision"] == "rejected":
+            logger.info("%s says: query too expensive (estimated cost %s), reviewing query...", self.name, guard["estimate"]["cost"])
+            issues = f"the query is too expensive (estimated cost {guard['estimate']['cost']:.0f}, the limit is {max_cost}), avoid cross joins and full scans of large tables by adding selective WHERE predicates or aggregating"
+            reviewed_query = self.clean_query(self.query_reviewer_chain.invoke({"query": query, "issues": issues}))
+            guard = guard_query(self.engine, reviewed_query, max_cost, max_rows)
+            if guard["decision"] == "rejected":
+                raise ValueError(f"Query rejected, estimated cost {guard['estimate']['cost']} exceeds {max_cost}")
+        if guard["decision"] == "rewritten":
+            logger.info("%s says: limiting query to %s rows.", self.name, max_rows)
+        if self.guard_cache.ttl > 0:
+            self.guard_cache.set(key, guard["query"], tags=get_tables(query))
+        return guard["query"]
+
     def run_query(self, query):
-        print(f"{self.name} says: executing query...")
-        result = self.db.run(query)
-        print(f"{self.name} says: {result}")
+        key = canonicalize_sql(query)
+        if self.result_cache.ttl > 0:
+            result = self.result_cache.get(key)
+            if result is not None:
+                logger.info("%s says: using cached query result.", self.name)
+                return result
+
+        logger.info("%s says: executing query...", self.name)
+        start = time.perf_counter()
+        result = execute_query(
+            self.engine,
+            query,
+            timeout=self.config.get("query_timeout", 30),
+            max_rows=self.config.get("max_rows", 200),
+            max_bytes=self.config.get("max_result_bytes", 50000)
+        )
+        metrics.observe("sql_query_duration_seconds", time.perf_counter() - start)
+        if result["truncated"]:
+            metrics.inc("sql_results_truncated_total", {"reason": result["truncated"]})
+        logger.debug("%s says: %s", self.name, result)
+
+        if self.result_cache.ttl > 0:
+            # Tagged with the tables it reads, so a change in one of them can invalidate it
+            self.result_cache.set(key, result, tags=get_tables(query))
         return result
+
+    def invalidate_results(self, tables=None):
+        # Hook for data loads: drops the cached results that read from the given tables (all of them by default)
+        if tables is None:
+            self.result_cache.clear()
+            self.guard_cache.clear()
+            return
+        for table in tables:
+            # Their cost estimates may change with the data too
+            self.guard_cache.invalidate(table.split(".")[-1].strip("[]").lower())
+            removed = self.result_cache.invalidate(table.split(".")[-1].strip("[]").lower())
+            logger.info("%s says: invalidated %s cached results of %s.", self.name, removed, table)
     
     def generate_answer(self, state: State):
-        print(f"{self.name} says: received question '{state['question']}'")
+        logger.info("%s says: received question '%s'", self.name, state['question'])
         
         if "agents" not in state:
             state["agents"] = {}
@@ -189,31 +317,43 @@ class AgentSql:
         try:
             # Filter agent history
             agent_history = filter_agent_history(state["history"], self.name)
+            agent_history = compact_history(agent_history, self.history_tokens)
+
+            # Start loading the schema while the entry point decides whether it is needed
+            prefetch = Prefetch(self.name, self.load_schema, enabled=self.prefetch)
 
             # Check if it can answer the question right away or if it needs to continue
             answer = self.entry_point_chain.invoke({"question": state["question"], "history": agent_history})
-            print(f"{self.name} says: {answer}")
+            logger.debug("%s says: %s", self.name, answer)
             if answer == 'CONTINUE':
-                self.check_connection()
-                
                 # Get tables and columns from the database
-                schema = self.get_schema()
+                schema = prefetch.result()
 
                 # Construct a SQL query
                 query = self.generate_query(state['question'], schema, agent_history)
 
+                # Make sure the query is cheap enough before running it
+                query = self.check_cost(query)
+
                 # Execute the query
                 result = self.run_query(query)
 
+                # Remember the queries that pass validation and run successfully
+                if self.plan_cache is not None and not validate_sql(query, parse_schema(schema)):
+                    self.plan_cache.add(state['question'], query, agent_history)
+
                 # Finally answer the question
-                print(f"{self.name} says: generating answer...")
-                answer = self.answer_generator_chain.invoke({"question": state["question"], "query": query, "result": result, "history": agent_history})
-                print(f"{self.name} says: {answer}")
-            
+                logger.info("%s says: generating answer...", self.name)
+                answer = self.answer_generator_chain.invoke({"question": state["question"], "query": query, "result": serialize_result(result, self.result_token_budget), "history": agent_history})
+                logger.debug("%s says: %s", self.name, answer)
+            else:
+                # Answered from the history, the prefetched data is not needed
+                prefetch.discard()
+
             state["agents"][f"{self.name}"] = answer
             return state
         
         except Exception as e:
-            print(f"{self.name} says: ERROR {e}")
+            logger.error("%s says: ERROR %s", self.name, e)
             state["agents"][f"{self.name}"] = "I don't know"
             return state
\ No newline at end of file
@@ -0,0 +1,107 @@
+import threading
+import time
+from collections import OrderedDict
+from .metrics import metrics
+
+class TTLCache:
+    # Thread-safe LRU cache whose entries expire after a time to live (in seconds).
+    # Entries can be tagged so a group of them can be invalidated at once.
+    # With a shared state backend the entries live there instead, so every worker sees them; the backend
+    # expires them and evicts by its own memory policy.
+
+    # Tag holding the live keys of a shared cache, so it can be counted and cleared
+    ALL = "__all__"
+
+    def __init__(self, maxsize=1024, ttl=60, name="cache", backend=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.backend = backend if backend is not None and backend.shared else None
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.tags = {}
+
+    def get_key(self, key):
+        return f"cache:{self.name}:{key}"
+
+    def get_tag_key(self, tag):
+        return f"cache-tag:{self.name}:{tag}"
+
+    def get(self, key, default=None):
+        if self.backend is not None:
+            value = self.backend.get(self.get_key(key))
+            metrics.record_cache(self.name, value is not None)
+            return value if value is not None else default
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+        metrics.record_cache(self.name, entry is not None)
+        return entry[1] if entry is not None else default
+
+    def set(self, key, value, ttl=None, tags=()):
+        ttl = self.ttl if ttl is None else ttl
+        if self.backend is not None:
+            if ttl > 0:
+                self.backend.set(self.get_key(key), value, ttl)
+                for tag in (*tags, self.ALL):
+                    self.backend.add_member(self.get_tag_key(tag), self.get_key(key), ttl)
+            return
+        expires_at = time.monotonic() + ttl
+        with self.lock:
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            for tag in tags:
+                self.tags.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.maxsize:
+                evicted, _ = self.entries.popitem(last=False)
+                for keys in self.tags.values():
+                    keys.discard(evicted)
+
+    def delete(self, key):
+        if self.backend is not None:
+            self.backend.delete(self.get_key(key))
+            self.backend.remove_members(self.get_tag_key(self.ALL), self.get_key(key))
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def invalidate(self, tag):
+        # Removes every entry stored with the given tag, returns how many were removed
+        if self.backend is not None:
+            tag_key = self.get_tag_key(tag)
+            keys = self.backend.members(tag_key)
+            removed = self.backend.delete(*keys)
+            self.backend.delete(tag_key)
+            self.backend.remove_members(self.get_tag_key(self.ALL), *keys)
+        else:
+            with self.lock:
+                keys = self.tags.pop(tag, set())
+                removed = sum(self.entries.pop(key, None) is not None for key in keys)
+        metrics.inc("cache_invalidations_total", {"cache": self.name}, removed)
+        return removed
+
+    def clear(self):
+        if self.backend is not None:
+            self.invalidate(self.ALL)
+            return
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+
+    def __contains__(self, key):
+        if self.backend is not None:
+            return self.backend.get(self.get_key(key)) is not None
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and entry[0] >= time.monotonic()
+
+    def __len__(self):
+        if self.backend is not None:
+            # Tag members expire with their keys, only keys evicted by the backend memory policy are still counted
+            return len(self.backend.members(self.get_tag_key(self.ALL)))
+        with self.lock:
+            return len(self.entries)
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from .metrics import metrics
+
+def normalize_question(question):
+    # Case, spacing and trailing punctuation do not change the answer
+    return " ".join(question.lower().split()).rstrip("?!. ")
+
+def get_request_key(question, history):
+    # Same question asked on top of the same conversation
+    payload = json.dumps([normalize_question(question), history], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class SingleFlight:
+    # Runs a function once for every group of concurrent calls with the same key. The other callers wait
+    # for that call and share its result, or its exception.
+    # With a shared state backend the calls are also coalesced between workers: the worker that takes the
+    # key's lock runs the function and publishes the result, the others poll for it.
+
+    def __init__(self, name="single_flight", backend=None, timeout=120, result_ttl=30, poll_interval=0.1):
+        self.name = name
+        self.backend = backend if backend is not None and backend.shared else None
+        self.timeout = timeout
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def run(self, key, fn):
+        with self.lock:
+            future = self.calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self.calls[key] = future
+
+        if not leader:
+            metrics.inc("single_flight_calls_total", {"name": self.name, "result": "shared"})
+            return future.result()
+
+        try:
+            result = self.execute(key, fn)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+
+    def execute(self, key, fn):
+        if self.backend is None:
+            metrics.inc("single_flight_calls_total", {"name": self.name, "result": "executed"})
+            return fn()
+
+        lock_key = f"flight:{self.name}:{key}"
+        deadline = time.monotonic() + self.timeout
+        while True:
+            flight_id = uuid.uuid4().hex
+            if self.backend.add(lock_key, flight_id, self.timeout):
+                metrics.inc("single_flight_calls_total", {"name": self.name, "result": "executed"})
+                try:
+                    result = fn()
+                    self.backend.set(f"flight-result:{flight_id}", result, self.result_ttl)
+                    return result
+                finally:
+                    self.backend.delete(lock_key)
+
+            # Another worker is running it, wait for its result while it holds the lock
+            result = self.wait_for_result(lock_key, deadline)
+            if result is not None:
+                metrics.inc("single_flight_calls_total", {"name": self.name, "result": "shared"})
+                return result
+            if time.monotonic() >= deadline:
+                # The other worker is stuck, do not wait for it any longer
+                metrics.inc("single_flight_calls_total", {"name": self.name, "result": "executed"})
+                return fn()
+            # The other worker failed, try to take the lock
+
+    def wait_for_result(self, lock_key, deadline):
+        flight_id = self.backend.get(lock_key)
+        while flight_id is not None and time.monotonic() < deadline:
+            # The result is published before the lock is released
+            released = self.backend.get(lock_key) != flight_id
+            result = self.backend.get(f"flight-result:{flight_id}")
+            if result is not None or released:
+                return result
+            time.sleep(self.poll_interval)
+        return None
+
+    def in_flight(self):
+        with self.lock:
+            return len(self.calls)
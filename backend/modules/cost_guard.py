@@ -0,0 +1,85 @@
+import logging
+import math
+import re
+import xml.etree.ElementTree as ElementTree
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+SHOWPLAN_NAMESPACE = "{http://schemas.microsoft.com/sqlserver/2004/07/showplan}"
+
+COST_BUCKETS = (0.01, 0.1, 1, 10, 100, 1000, 10000, 100000)
+
+def estimate_mssql(cursor, query):
+    # SQL Server returns the estimated plan instead of running the query while SHOWPLAN_XML is on
+    cursor.execute("SET SHOWPLAN_XML ON")
+    try:
+        cursor.execute(query)
+        plan = cursor.fetchone()[0]
+    finally:
+        cursor.execute("SET SHOWPLAN_XML OFF")
+    statements = ElementTree.fromstring(plan).iter(f"{SHOWPLAN_NAMESPACE}StmtSimple")
+    costs = [(float(statement.get("StatementSubTreeCost", 0)), float(statement.get("StatementEstRows", 0))) for statement in statements]
+    return { "cost": sum(cost for cost, _ in costs), "rows": max((rows for _, rows in costs), default=0) }
+
+def estimate_sqlite(cursor, query):
+    # SQLite has no cost estimates, so they are derived from EXPLAIN QUERY PLAN: nested loops multiply
+    # the rows of the tables they read, a full scan reads the whole table and an index search about log2 of it
+    cursor.execute(f"EXPLAIN QUERY PLAN {query}")
+    details = [row[-1] for row in cursor.fetchall()]
+    rows = 1
+    for detail in details:
+        match = re.match(r"(SCAN|SEARCH) (?:TABLE )?(\w+)", detail)
+        if match is None or match.group(2) == "CONSTANT":
+            continue
+        cursor.execute(f'SELECT COUNT(*) FROM "{match.group(2)}"')
+        count = cursor.fetchone()[0]
+        rows *= count if match.group(1) == "SCAN" else max(1, math.ceil(math.log2(count + 1)))
+    return { "cost": float(rows), "rows": float(rows) }
+
+ESTIMATORS = { "mssql": estimate_mssql, "sqlite": estimate_sqlite }
+
+def estimate_cost(engine, query):
+    estimator = ESTIMATORS.get(engine.dialect.name)
+    if estimator is None:
+        return None
+    connection = engine.raw_connection()
+    try:
+        return estimator(connection.cursor(), query)
+    finally:
+        connection.close()
+
+def force_limit(query, dialect, limit):
+    # Adds a row limit to a query that has none, returns the query unchanged when it cannot
+    query = query.strip().rstrip(";")
+    if dialect == "mssql":
+        if re.search(r"\bTOP\b", query, re.IGNORECASE) or not re.match(r"SELECT\b", query, re.IGNORECASE):
+            return query
+        return re.sub(r"^SELECT\s+(DISTINCT\s+)?", lambda match: f"{match.group(0)}TOP ({limit}) ", query, count=1, flags=re.IGNORECASE)
+    if re.search(r"\bLIMIT\b", query, re.IGNORECASE):
+        return query
+    return f"{query} LIMIT {limit}"
+
+def guard_query(engine, query, max_cost, max_rows):
+    # Decides whether a query can run: 'allowed', 'rewritten' (with a forced row limit) or 'rejected'
+    try:
+        estimate = estimate_cost(engine, query)
+    except Exception as e:
+        # Execution will surface real errors, the guard only stops queries it can estimate
+        logger.warning("Could not estimate query cost: %s", e)
+        estimate = None
+
+    decision = "allowed"
+    if estimate is not None:
+        metrics.observe("sql_plan_cost", estimate["cost"], buckets=COST_BUCKETS)
+        metrics.observe("sql_plan_rows", estimate["rows"], buckets=COST_BUCKETS)
+        if estimate["cost"] > max_cost:
+            decision = "rejected"
+        elif estimate["rows"] > max_rows:
+            # One row over the limit, so the execution still sees that the result was cut
+            limited_query = force_limit(query, engine.dialect.name, max_rows + 1)
+            if limited_query != query.strip().rstrip(";"):
+                query = limited_query
+                decision = "rewritten"
+    metrics.inc("sql_cost_guard_total", {"decision": decision})
+    return { "decision": decision, "query": query, "estimate": estimate }
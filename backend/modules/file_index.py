@@ -0,0 +1,83 @@
+import math
+import re
+from collections import Counter
+
+# Words that say nothing about which file holds the answer
+STOPWORDS = {
+    "a", "an", "the", "of", "in", "on", "at", "for", "to", "from", "by", "with", "and", "or", "not", "is", "are", "was",
+    "were", "be", "been", "do", "does", "did", "have", "has", "had", "what", "which", "who", "whom", "whose", "how", "many",
+    "much", "when", "where", "why", "there", "their", "them", "they", "it", "its", "this", "that", "these", "those", "me",
+    "my", "i", "you", "your", "can", "could", "would", "should", "show", "list", "give", "tell", "find", "get", "all", "any",
+    "some", "about", "file", "files", "csv", "data",
+}
+
+def tokenize(text):
+    # camelCase and snake_case names are split into words, plurals folded into the singular
+    text = re.sub(r"([a-z])([A-Z])", r"\1 \2", str(text))
+    tokens = []
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        if word in STOPWORDS:
+            continue
+        if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+def cosine(a, b):
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return sum(x * y for x, y in zip(a, b)) / norm if norm else 0
+
+class FileIndex:
+    # Ranks the files of the CSV index for a question with BM25 over their name, summary and columns.
+    # With an embeddings model the keyword score is blended with the similarity of the question and the
+    # file description; similarities under min_similarity count as no match at all.
+
+    def __init__(self, files, embeddings=None, k1=1.5, b=0.75, embedding_weight=0.5, min_similarity=0.75):
+        self.files = [name for name, _ in files]
+        self.terms = [Counter(tokenize(text)) for _, text in files]
+        self.lengths = [sum(terms.values()) for terms in self.terms]
+        self.average_length = sum(self.lengths) / len(self.lengths) if self.lengths else 1
+        self.k1 = k1
+        self.b = b
+        documents = Counter(term for terms in self.terms for term in terms)
+        self.idf = { term: math.log(1 + (len(files) - count + 0.5) / (count + 0.5)) for term, count in documents.items() }
+
+        self.embeddings = embeddings
+        self.embedding_weight = embedding_weight
+        self.min_similarity = min_similarity
+        self.vectors = embeddings.embed_documents([text for _, text in files]) if embeddings is not None and files else None
+
+    @classmethod
+    def from_frame(cls, index, embeddings=None, **kwargs):
+        # index.csv rows: FILE_NAME, SUMMARY and, when the ingestion provides them, the COLUMNS of each file
+        files = []
+        for row in index.fillna("").to_dict(orient="records"):
+            text = " ".join(str(row.get(column, "")) for column in ("FILE_NAME", "SUMMARY", "COLUMNS"))
+            files.append((row["FILE_NAME"], text))
+        return cls(files, embeddings, **kwargs)
+
+    def get_keyword_scores(self, question):
+        terms = set(tokenize(question))
+        scores = []
+        for counts, length in zip(self.terms, self.lengths):
+            score = 0
+            for term in terms:
+                frequency = counts.get(term, 0)
+                if frequency:
+                    score += self.idf[term] * frequency * (self.k1 + 1) / (frequency + self.k1 * (1 - self.b + self.b * length / self.average_length))
+            scores.append(score)
+        return scores
+
+    def search(self, question, top_k=None):
+        # Files with any evidence for the question, best first, with their scores
+        scores = self.get_keyword_scores(question)
+        if self.vectors is not None:
+            best = max(scores, default=0)
+            query = self.embeddings.embed_query(question)
+            similarities = [max(0, (cosine(query, vector) - self.min_similarity) / (1 - self.min_similarity)) for vector in self.vectors]
+            scores = [(1 - self.embedding_weight) * (score / best if best else 0) + self.embedding_weight * similarity for score, similarity in zip(scores, similarities)]
+        results = sorted(((file, score) for file, score in zip(self.files, scores) if score > 0), key=lambda result: -result[1])
+        return results[:top_k] if top_k else results
+
+    def __len__(self):
+        return len(self.files)
@@ -0,0 +1,110 @@
+import threading
+from collections import OrderedDict
+from .coalescing import SingleFlight
+from .metrics import metrics
+
+def compact_frame(frame, downcast=False):
+    # Numbers are kept in 64 bits unless asked otherwise: in 32 bits the arithmetic of the generated code can
+    # overflow (a column doubled) or lose precision (a mean), even when every stored value survives. Text
+    # columns stay as they are, as categories value_counts, unique and groupby would give different results.
+    if not downcast:
+        return frame
+    import pandas as pd
+    dtypes = {}
+    for column in frame.columns:
+        series = frame[column]
+        if pd.api.types.is_integer_dtype(series):
+            if series.min() >= -2**31 and series.max() < 2**31:
+                dtypes[column] = "int32"
+        elif pd.api.types.is_float_dtype(series):
+            if series.astype("float32").astype(series.dtype).equals(series):
+                dtypes[column] = "float32"
+    # A new frame, the one given is left untouched
+    return frame.astype(dtypes)
+
+def get_view(frame):
+    import pandas as pd
+    # With copy on write (turned on by the cache) changes made through a shallow copy copy the data first
+    # and never reach the cached frame, without it every caller needs its own copy
+    return frame.copy(deep=not pd.get_option("mode.copy_on_write"))
+
+def get_size(frame):
+    return int(frame.memory_usage(index=True, deep=True).sum())
+
+class FrameCache:
+    # Parsed DataFrames shared by the whole process. Each entry is kept for one version of
+    # its file, and the least recently used ones are evicted once the frames go over the memory budget.
+    # Callers get views that never modify the cached frames: shallow copies with pandas copy on write, which
+    # the cache turns on unless told otherwise, or deep copies without it.
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, name="csv_frames", downcast=False, copy_on_write=True):
+        self.max_bytes = max_bytes
+        self.name = name
+        self.downcast = downcast
+        self.copy_on_write = copy_on_write
+        self.copy_on_write_enabled = False
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        # Concurrent requests for a file that is not cached parse it once
+        self.loads = SingleFlight(name)
+
+    def get(self, key, version, load):
+        with self.lock:
+            entry = self.entries.get(key)
+            hit = entry is not None and entry[0] == version
+            if hit:
+                self.entries.move_to_end(key)
+        metrics.record_cache(self.name, hit)
+        if hit:
+            return get_view(entry[1])
+
+        self.enable_copy_on_write()
+        frame = self.loads.run((key, version), lambda: self.put(key, version, compact_frame(load(), self.downcast)))
+        return get_view(frame)
+
+    def enable_copy_on_write(self):
+        # Set once for the whole process when the first frame is loaded, so pandas is only imported when needed
+        if self.copy_on_write and not self.copy_on_write_enabled:
+            import pandas as pd
+            pd.set_option("mode.copy_on_write", True)
+            self.copy_on_write_enabled = True
+
+    def put(self, key, version, frame):
+        size = get_size(frame)
+        with self.lock:
+            self.remove(key)
+            # A frame larger than the whole budget is used once and not kept
+            if size <= self.max_bytes:
+                self.entries[key] = (version, frame, size)
+                self.bytes += size
+            while self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+            metrics.set_gauge("csv_frame_cache_bytes", self.bytes)
+        return frame
+
+    def remove(self, key):
+        # Must be called with the lock held
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            while self.bytes > self.max_bytes:
+                self.remove(next(iter(self.entries)))
+            metrics.set_gauge("csv_frame_cache_bytes", self.bytes)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+            metrics.set_gauge("csv_frame_cache_bytes", 0)
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+
+frame_cache = FrameCache()
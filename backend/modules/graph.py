@@ -1,4 +1,5 @@
 from .models import State
+from .metrics import Tracer
 from langchain_core.runnables import RunnableLambda
 from langgraph.graph import StateGraph
 
@@ -37,5 +38,8 @@ class Graph():
         # Compile the graph structure into a runnable object.
         self.graph = self.builder.compile()
 
+        # The tracer records spans and metrics for every node, chain and LLM call
+        self.tracer = Tracer()
+
     def invoke(self, state):
-        return self.graph.invoke(state)
\ No newline at end of file
+        return self.graph.invoke(state, config={"callbacks": [self.tracer]})
\ No newline at end of file
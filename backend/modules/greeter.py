@@ -1,25 +1,42 @@
 from .models import State
+from .llm import get_llm_kwargs
 from langchain_openai import AzureChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnableLambda
+import random
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Each variant of the greeting answers a different opening message
+GREETING_QUESTIONS = (
+    "hi! what can you do?",
+    "hello! how can you help me?",
+    "hey! what kind of questions can I ask you?",
+    "good day! what are you able to help with?",
+)
 
 class Greeter:
-    
-    def __init__(self, agent_list): 
+    # The greeting only depends on the agents' skills, so a pool of variants is generated in the
+    # background and served from memory. The pool is refreshed periodically and when the skills change.
 
+    def __init__(self, agent_list, config=None):
+        config = config or {}
+        self.pool_size = config.get("pool_size", 3)
+        self.refresh_interval = config.get("refresh_interval", 3600)
+
+        self.agent_list = agent_list
         self.agents = [agent.skills for agent in agent_list]
-        
+
         # Instantiate a pre-trained Large Language Model from Azure OpenAI
-        self.llm = AzureChatOpenAI(
-            deployment_name="gpt-4o",
-            api_version="2023-06-01-preview"
-        )
+        self.llm = AzureChatOpenAI(**get_llm_kwargs("greeter_chain"))
 
         # The system prompt guides the agent on how to respond
         self.system_prompt = (
             "You are an AI assistant for question-answering tasks. "
-            f"This is a list of what you can do: {self.agents}. "
+            "This is a list of what you can do: {agents}. "
         )
 
         # The prompt puts together the system prompt with the user question
@@ -35,14 +52,72 @@ class Greeter:
 
         # The chain orchestrates the whole flow
         self.chain = (
-            { "question": RunnableLambda(lambda inputs: inputs["question"]) }
+            { "question": RunnableLambda(lambda inputs: inputs["question"]), "agents": RunnableLambda(lambda inputs: inputs["agents"]) }
             #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
             | self.prompt
             | self.llm
             | self.parser
-        )
+        ).with_config(run_name="greeter_chain")
+
+        # Greetings ready to be served and the skills they were generated from
+        self.lock = threading.Lock()
+        self.greetings = []
+        self.greetings_skills = None
+        self.wake = threading.Event()
+        self.stop_event = threading.Event()
+        self.worker = None
+
+    def set_agents(self, agent_list):
+        self.agent_list = agent_list
+        self.schedule_refresh()
+
+    def refresh(self):
+        skills = [agent.skills for agent in self.agent_list]
+        logger.info("Generating %s greetings...", self.pool_size)
+        greetings = []
+        for i in range(self.pool_size):
+            try:
+                greetings.append(self.chain.invoke({ "question": GREETING_QUESTIONS[i % len(GREETING_QUESTIONS)], "agents": skills }))
+            except Exception as e:
+                logger.error("Could not generate a greeting: %s", e)
+
+        # A failed refresh keeps serving the previous greetings
+        if greetings:
+            with self.lock:
+                self.agents = skills
+                self.greetings = greetings
+                self.greetings_skills = skills
+        return greetings
+
+    def schedule_refresh(self):
+        self.wake.set()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.wake.clear()
+            self.refresh()
+            self.wake.wait(self.refresh_interval or None)
+
+    def start(self):
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run, name="greeter", daemon=True)
+            self.worker.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.wake.set()
 
     def generate_answer(self):
-        print("Greeting the user...")
-        answer = self.chain.invoke({ "question": "hi! what can you do?" })
-        return { "answer": answer }
+        logger.info("Greeting the user...")
+        with self.lock:
+            greetings, greetings_skills = self.greetings, self.greetings_skills
+
+        # Agents changed since the pool was generated, the current greetings are served meanwhile
+        if greetings_skills is not None and greetings_skills != [agent.skills for agent in self.agent_list]:
+            self.schedule_refresh()
+
+        if not greetings:
+            # The pool is not ready yet, answer with the plain list of skills
+            skills = "\n".join(f"- {skill}" for skill in self.agents)
+            return { "answer": f"Hi! I can help you with:\n{skills}" }
+        return { "answer": random.choice(greetings) }
@@ -0,0 +1,89 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from .cache import TTLCache
+from .state import get_backend
+
+logger = logging.getLogger(__name__)
+
+class HealthMonitor:
+    # Runs the agents' connection checks concurrently and keeps the results for a while,
+    # so polling the status endpoint does not hit every backend on each request
+
+    def __init__(self, agents, config):
+        self.agents = agents
+        self.timeout = config["timeout"]
+        self.probe_interval = config.get("probe_interval", 0)
+        self.cache = TTLCache(maxsize=max(len(agents), 1), ttl=config["ttl"], name="health", backend=get_backend())
+        self.executor = ThreadPoolExecutor(max_workers=max(len(agents), 1), thread_name_prefix="health")
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.stop_event = threading.Event()
+        self.prober = None
+
+    def check_agent(self, agent):
+        status = agent.check_connection()
+        return { "agent": agent.name, "healthy": status["healthy"], "ready": self.is_ready(agent), "info": status["info"] }
+
+    @staticmethod
+    def is_ready(agent):
+        # Lazy agents report whether their remote resources have been created yet
+        return getattr(agent, "ready", True) is not False
+
+    def submit(self, agent):
+        # Reuse a check that is still running (e.g. one that timed out before) instead of piling up new ones
+        with self.lock:
+            future = self.in_flight.get(agent.name)
+            if future is None or future.done():
+                future = self.executor.submit(self.check_agent, agent)
+                future.add_done_callback(lambda done: self.store(agent.name, done))
+                self.in_flight[agent.name] = future
+            return future
+
+    def store(self, name, future):
+        if future.exception() is None:
+            self.cache.set(name, future.result())
+
+    def check_all(self, force=False):
+        agents = { agent.name: agent for agent in self.agents }
+        results = {}
+        pending = {}
+        for agent in self.agents:
+            cached = None if force else self.cache.get(agent.name)
+            if cached is not None:
+                results[agent.name] = cached
+            else:
+                pending[agent.name] = self.submit(agent)
+
+        # All the checks share the same deadline, so the endpoint waits at most one timeout
+        deadline = time.monotonic() + self.timeout
+        for name, future in pending.items():
+            try:
+                results[name] = future.result(timeout=max(0, deadline - time.monotonic()))
+            except TimeoutError:
+                logger.warning("Health check for %s timed out after %ss", name, self.timeout)
+                results[name] = { "agent": name, "healthy": False, "ready": self.is_ready(agents[name]), "info": f"health check timed out after {self.timeout}s" }
+            except Exception as e:
+                logger.error("Health check for %s failed: %s", name, e)
+                results[name] = { "agent": name, "healthy": False, "ready": self.is_ready(agents[name]), "info": str(e) }
+
+        return [results[agent.name] for agent in self.agents]
+
+    def probe(self):
+        while not self.stop_event.is_set():
+            try:
+                self.check_all(force=True)
+            except Exception as e:
+                logger.error("Background health probe failed: %s", e)
+            self.stop_event.wait(self.probe_interval)
+
+    def start(self):
+        # Optionally keep the status fresh in the background so the endpoint always answers from cache
+        if self.probe_interval and self.prober is None:
+            self.prober = threading.Thread(target=self.probe, name="health-prober", daemon=True)
+            self.prober.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,119 @@
+from .llm import get_llm_kwargs
+from .scheduler import llm_session
+from .utils import window_history
+from langchain_openai import AzureChatOpenAI
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
+from concurrent.futures import ThreadPoolExecutor
+from azure.data.tables import TableEntity
+import math
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_ROW_KEY = "summary"
+
+class HistorySummarizer:
+    # Keeps a rolling summary of each conversation in the history table. After every turn, the entries
+    # that no longer fit in the history window are folded into the summary in the background.
+
+    def __init__(self, table, config):
+        self.table = table
+        # The same window the history endpoint returns, whatever it leaves out goes into the summary
+        self.max_entries = config["max_entries"]
+        self.max_tokens = config.get("max_tokens", math.inf)
+        self.max_entry_tokens = config.get("max_entry_tokens")
+
+        # Instantiate a pre-trained Large Language Model from Azure OpenAI
+        self.llm = AzureChatOpenAI(**get_llm_kwargs("history_summarizer_chain"))
+
+        # The system prompt guides the agent on how to respond
+        self.system_prompt = (
+            "You are an AI assistant tasked with summarizing a conversation between a user and a chatbot. "
+            "Update the current summary with the new messages. "
+            "Keep the facts, names, numbers and open questions that later questions may refer to. "
+            "Use five sentences maximum. "
+            "\n\n"
+            "Current summary: {summary}"
+        )
+
+        # The prompt puts together the system prompt with the new messages
+        self.prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", self.system_prompt),
+                ("human", "{messages}"),
+            ]
+        )
+
+        # The parser just plucks the string content out of the LLM's output message
+        self.parser = StrOutputParser()
+
+        # The chain orchestrates the whole flow
+        self.chain = (
+            { "summary": RunnableLambda(lambda inputs: inputs["summary"]), "messages": RunnableLambda(lambda inputs: inputs["messages"]) }
+            #| RunnableLambda(lambda inputs: (print(f"Logging Inputs: {inputs}") or inputs))
+            | self.prompt
+            | self.llm
+            | self.parser
+        ).with_config(run_name="history_summarizer_chain")
+
+        # A single worker keeps the updates of a session in order
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history")
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def update(self, session_id):
+        entities = self.table.query_entities(query_filter=f"PartitionKey eq '{session_id}'")
+        summary = None
+        turns = []
+        for entity in entities:
+            if entity["RowKey"] == SUMMARY_ROW_KEY:
+                summary = entity
+            else:
+                turns.append(dict(entity, Timestamp=entity.metadata["timestamp"]))
+        turns.sort(key=lambda entity: entity["Timestamp"])
+
+        # Entries left out of the history window (by count or by tokens) that are not part of the summary yet
+        summaries = [{ "role": "summary", "content": summary["content"] }] if summary is not None else []
+        window = window_history(summaries + turns, self.max_tokens, self.max_entries, self.max_entry_tokens)
+        summarized = summary["turns"] if summary is not None else 0
+        new_entries = turns[summarized:len(turns) - (len(window) - len(summaries))]
+        if not new_entries:
+            return None
+
+        logger.info("Summarizing %s history entries of session %s...", len(new_entries), session_id)
+        messages = "\n".join(f"{entry['role']}: {entry['content']}" for entry in new_entries)
+        content = self.chain.invoke({ "summary": summary["content"] if summary is not None else "none", "messages": messages })
+
+        entity = TableEntity()
+        entity["PartitionKey"] = session_id
+        entity["RowKey"] = SUMMARY_ROW_KEY
+        entity["role"] = "summary"
+        entity["content"] = content
+        entity["turns"] = summarized + len(new_entries)
+        self.table.upsert_entity(entity=entity)
+        return content
+
+    def schedule(self, session_id):
+        # Sessions already waiting for an update are not queued twice
+        with self.lock:
+            if session_id in self.pending:
+                return
+            self.pending.add(session_id)
+        self.executor.submit(self.run, session_id)
+
+    def run(self, session_id):
+        with self.lock:
+            self.pending.discard(session_id)
+        token = llm_session.set(session_id)
+        try:
+            self.update(session_id)
+        except Exception as e:
+            logger.error("Could not update the history summary of session %s: %s", session_id, e)
+        finally:
+            llm_session.reset(token)
+
+    def stop(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,133 @@
+import builtins
+import copy
+import threading
+import time
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+from .metrics import metrics
+
+def parse_cache_control(value):
+    directives = {}
+    for part in (value or "").split(","):
+        name, _, argument = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = argument.strip('"')
+    return directives
+
+class CachedSession(requests.Session):
+    # A requests session with a keep-alive connection pool and a private HTTP cache for GET requests.
+    # Fresh responses (Cache-Control max-age) are served locally, stale ones are revalidated with
+    # their ETag / Last-Modified so an unchanged resource only costs a 304.
+
+    def __init__(self, pool_size=10, max_entries=256):
+        super().__init__()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get_cache_key(self, method, url, params, headers):
+        prepared = requests.Request(method, url, params=params).prepare()
+        # Responses depend on who is asking and in which format
+        varying = tuple((name, (headers or {}).get(name) or self.headers.get(name)) for name in ("Authorization", "Accept"))
+        return prepared.url, varying
+
+    def request(self, method, url, params=None, headers=None, **kwargs):
+        if method.upper() != "GET":
+            return super().request(method, url, params=params, headers=headers, **kwargs)
+
+        key = self.get_cache_key(method, url, params, headers)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        if entry is not None and entry["expires_at"] > time.monotonic():
+            metrics.record_cache("http", True)
+            return copy.copy(entry["response"])
+
+        # Ask the server whether our stale copy is still valid
+        headers = dict(headers or {})
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = super().request(method, url, params=params, headers=headers, **kwargs)
+
+        if entry is not None and response.status_code == 304:
+            metrics.record_cache("http", True)
+            entry["expires_at"] = time.monotonic() + self.get_max_age(response)
+            return copy.copy(entry["response"])
+
+        metrics.record_cache("http", False)
+        self.store(key, response)
+        return response
+
+    @staticmethod
+    def get_max_age(response):
+        directives = parse_cache_control(response.headers.get("Cache-Control"))
+        if "no-cache" in directives:
+            return 0
+        try:
+            return int(directives.get("max-age", 0))
+        except ValueError:
+            return 0
+
+    def store(self, key, response):
+        directives = parse_cache_control(response.headers.get("Cache-Control"))
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        max_age = self.get_max_age(response)
+        if response.status_code != 200 or "no-store" in directives or not (etag or last_modified or max_age):
+            return
+
+        # Read the body now so the cached response can be handed out many times
+        response.content
+        with self.lock:
+            self.entries[key] = { "response": response, "etag": etag, "last_modified": last_modified, "expires_at": time.monotonic() + max_age }
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear_cache(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SessionRequests:
+    # Behaves like the requests module but sends every call through the given session
+
+    def __init__(self, session):
+        self.session = session
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+    def request(self, method, url, **kwargs):
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, params=None, **kwargs):
+        return self.session.get(url, params=params, **kwargs)
+
+    def head(self, url, **kwargs):
+        return self.session.head(url, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.session.post(url, data=data, json=json, **kwargs)
+
+def get_exec_globals(session, base_globals):
+    # Globals for executing generated code: 'requests' (even when imported by the code itself)
+    # resolves to the pooled and cached session
+    session_requests = SessionRequests(session)
+
+    def session_import(name, globals=None, locals=None, fromlist=(), level=0):
+        if name == "requests" and level == 0:
+            return session_requests
+        return builtins.__import__(name, globals, locals, fromlist, level)
+
+    return { **base_globals, "requests": session_requests, "session": session, "__builtins__": { **builtins.__dict__, "__import__": session_import } }
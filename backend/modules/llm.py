@@ -0,0 +1,208 @@
+import email.utils
+import json
+import logging
+import math
+import random
+import re
+import threading
+import time
+import httpx
+from .metrics import metrics
+from .scheduler import LLMScheduler, DEFAULT_PRIORITY
+from .state import get_backend
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+# Set by each component on its client and removed before the request leaves the process
+PRIORITY_HEADER = "X-LLM-Priority"
+
+DEFAULT_CONFIG = {
+    "api_version": "2023-06-01-preview",
+    "max_connections": 50,
+    "max_keepalive_connections": 20,
+    "keepalive_expiry": 30,
+    "timeout": 60,
+    "http2": True,
+    "max_retries": 4,
+    "backoff_base": 0.5,
+    "backoff_max": 20,
+    "max_concurrency": 16,
+    "concurrency": {},
+    "tokens_per_minute": 0,
+    "requests_per_minute": 0,
+    "reserve": {},
+    "queue_timeout": 60,
+    "completion_tokens": 500,
+    "deployment": "gpt-4o",
+    "chains": {},
+}
+
+def get_deployment(request):
+    match = re.search(r"/deployments/([^/]+)/", request.url.path)
+    return match.group(1) if match else "default"
+
+def get_retry_after(response):
+    # Azure OpenAI sends retry-after-ms, the standard header is in seconds or an HTTP date
+    value = response.headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        date = email.utils.parsedate_to_datetime(value)
+        return max(0.0, date.timestamp() - time.time()) if date else None
+
+def estimate_tokens(request, completion_tokens):
+    # Prompt tokens estimated from the body size plus the tokens the completion may use
+    try:
+        body = json.loads(request.content or b"{}")
+    except ValueError:
+        body = {}
+    completion = body.get("max_tokens") if isinstance(body, dict) else None
+    return math.ceil(len(request.content) / 4) + (completion or completion_tokens)
+
+class LLMTransport(httpx.BaseTransport):
+    # Wraps the HTTP transport of the LLM client: admits calls through the scheduler, limits the calls in
+    # flight per deployment and retries throttled or failed calls with jittered exponential backoff,
+    # honouring Retry-After
+
+    def __init__(self, transport, config, scheduler=None):
+        self.transport = transport
+        self.scheduler = scheduler or LLMScheduler(config)
+        self.completion_tokens = config["completion_tokens"]
+        self.max_retries = config["max_retries"]
+        self.backoff_base = config["backoff_base"]
+        self.backoff_max = config["backoff_max"]
+        self.max_concurrency = config["max_concurrency"]
+        self.concurrency = config["concurrency"]
+        self.lock = threading.Lock()
+        self.semaphores = {}
+
+    def get_semaphore(self, deployment):
+        with self.lock:
+            if deployment not in self.semaphores:
+                self.semaphores[deployment] = threading.BoundedSemaphore(self.concurrency.get(deployment, self.max_concurrency))
+            return self.semaphores[deployment]
+
+    def get_backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        # Equal jitter: half of the exponential delay is fixed, the other half random
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def send(self, request, deployment):
+        with self.get_semaphore(deployment):
+            return self.transport.handle_request(request)
+
+    def handle_request(self, request):
+        deployment = get_deployment(request)
+        priority = request.headers.get(PRIORITY_HEADER)
+        if priority is not None:
+            del request.headers[PRIORITY_HEADER]
+        # The body is sent again on retries
+        request.read()
+        tokens = estimate_tokens(request, self.completion_tokens)
+        attempt = 0
+        while True:
+            try:
+                self.scheduler.acquire(tokens, priority)
+            except TimeoutError as e:
+                raise httpx.PoolTimeout(str(e), request=request) from e
+            try:
+                response = self.send(request, deployment)
+            except httpx.TransportError as e:
+                if attempt >= self.max_retries:
+                    raise
+                reason, delay = type(e).__name__, self.get_backoff(attempt)
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    return response
+                reason, delay = str(response.status_code), self.get_backoff(attempt, get_retry_after(response))
+                response.close()
+                if response.status_code == 429:
+                    self.scheduler.pause(delay)
+
+            metrics.inc("llm_retries_total", {"deployment": deployment, "reason": reason})
+            logger.warning("LLM call to %s failed (%s), retrying in %.2fs", deployment, reason, delay)
+            time.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        self.transport.close()
+
+
+class LLMClientFactory:
+    # Builds the settings of every AzureChatOpenAI instance, so they all share one pooled HTTP client
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.config = dict(DEFAULT_CONFIG)
+        self.transport = None
+        self.http_client = None
+
+    def configure(self, config, transport=None):
+        # The transport replaces the network one, e.g. a simulated model for load tests
+        with self.lock:
+            self.config = { **DEFAULT_CONFIG, **config }
+            self.transport = transport
+            if self.http_client is not None:
+                self.http_client.close()
+                self.http_client = None
+
+    def get_http_client(self):
+        with self.lock:
+            if self.http_client is None:
+                config = self.config
+                limits = httpx.Limits(
+                    max_connections=config["max_connections"],
+                    max_keepalive_connections=config["max_keepalive_connections"],
+                    keepalive_expiry=config["keepalive_expiry"]
+                )
+                transport = self.transport or httpx.HTTPTransport(http2=config["http2"] and self.has_http2(), limits=limits)
+                self.http_client = httpx.Client(transport=LLMTransport(transport, config, LLMScheduler(config, get_backend())), timeout=config["timeout"])
+            return self.http_client
+
+    @staticmethod
+    def has_http2():
+        try:
+            import h2  # noqa: F401
+            return True
+        except ImportError:
+            return False
+
+    def get_chain_config(self, chain):
+        # Chains without their own settings run on the default deployment with no output limit
+        return { "deployment": self.config["deployment"], "max_tokens": None, "priority": DEFAULT_PRIORITY, **self.config["chains"].get(chain, {}) }
+
+    def get_llm_kwargs(self, chain):
+        chain_config = self.get_chain_config(chain)
+        # Retries are done by the shared transport, the client itself must not retry on top of them. The
+        # timeout is given to the client too, it replaces the one of the HTTP client on every request.
+        kwargs = {
+            "deployment_name": chain_config["deployment"],
+            "api_version": self.config["api_version"],
+            "http_client": self.get_http_client(),
+            "timeout": self.config["timeout"],
+            "max_retries": 0,
+            "default_headers": {PRIORITY_HEADER: chain_config["priority"]}
+        }
+        if chain_config["max_tokens"]:
+            kwargs["max_tokens"] = chain_config["max_tokens"]
+        return kwargs
+
+llm_factory = LLMClientFactory()
+
+def setup_llm(config, transport=None):
+    llm_factory.configure(config, transport)
+
+def get_llm_kwargs(chain):
+    return llm_factory.get_llm_kwargs(chain)
@@ -0,0 +1,104 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+
+# Correlation id of the request being served, attached to every log record
+request_id = contextvars.ContextVar("request_id", default="-")
+
+# Loggers owned by the backend (third party libraries keep their own configuration)
+LOGGER_NAMES = ("main", "modules")
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    # Keeps only a fraction of the records below the given level (debug dumps by default)
+    def __init__(self, rate, level=logging.DEBUG):
+        super().__init__()
+        self.rate = rate
+        self.level = level
+
+    def filter(self, record):
+        if record.levelno > self.level or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+class TruncateFilter(logging.Filter):
+    # Caps the size of the rendered message so big payloads never reach the output as a whole
+    def __init__(self, max_chars):
+        super().__init__()
+        self.max_chars = max_chars
+
+    def filter(self, record):
+        message = record.getMessage()
+        if self.max_chars and len(message) > self.max_chars:
+            message = f"{message[:self.max_chars]}... [{len(message) - self.max_chars} chars truncated]"
+        record.msg = message
+        record.args = None
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    # Never blocks the caller: when the queue is full the record is dropped
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+listener = None
+
+def setup_logging(config):
+    global listener
+    stop_logging()
+
+    if config.get("format") == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s")
+
+    # The output handler runs in a background thread, the request path only enqueues records
+    output_handler = logging.StreamHandler(sys.stdout)
+    output_handler.setFormatter(formatter)
+    log_queue = queue.Queue(config.get("queue_size", 10000))
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(config.get("debug_sample_rate", 1.0)))
+    queue_handler.addFilter(RequestIdFilter())
+    queue_handler.addFilter(TruncateFilter(config.get("max_chars", 2000)))
+
+    for name in LOGGER_NAMES:
+        logger = logging.getLogger(name)
+        logger.handlers = [queue_handler]
+        logger.setLevel(config.get("level", "INFO"))
+        logger.propagate = False
+
+    listener = logging.handlers.QueueListener(log_queue, output_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+def stop_logging():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+atexit.register(stop_logging)
@@ -0,0 +1,264 @@
+import threading
+import time
+import uuid
+from collections import deque
+from langchain_core.callbacks import BaseCallbackHandler
+
+# Default histogram buckets (in seconds) for latency metrics
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class Metrics:
+
+    def __init__(self, max_spans=500):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.help = {}
+
+        # Most recent finished spans, kept in memory for inspection
+        self.spans = deque(maxlen=max_spans)
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, self.freeze(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, labels=None):
+        key = (name, self.freeze(labels))
+        with self.lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, labels=None, buckets=LATENCY_BUCKETS):
+        key = (name, self.freeze(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = { "buckets": buckets, "counts": [0] * len(buckets), "sum": 0, "count": 0 }
+                self.histograms[key] = histogram
+            for i, bound in enumerate(histogram["buckets"]):
+                if value <= bound:
+                    histogram["counts"][i] += 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def record_cache(self, cache, hit):
+        # Shared counters so every cache in the backend reports the same way
+        self.inc("cache_requests_total", { "cache": cache, "result": "hit" if hit else "miss" })
+
+    def record_span(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def get_spans(self):
+        with self.lock:
+            return list(self.spans)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+            self.spans.clear()
+
+    @staticmethod
+    def freeze(labels):
+        return tuple(sorted((labels or {}).items()))
+
+    @staticmethod
+    def format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs]
+        return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+    def render(self):
+        # Export everything using the Prometheus text exposition format
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {key: { **value, "counts": list(value["counts"]) } for key, value in self.histograms.items()}
+
+        lines = []
+        for metric_type, series in (("counter", counters), ("gauge", gauges)):
+            for name in sorted({name for name, _ in series}):
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                for (series_name, labels), value in sorted(series.items()):
+                    if series_name == name:
+                        lines.append(f"{name}{self.format_labels(labels)} {value}")
+
+        for name in sorted({name for name, _ in histograms}):
+            if name in self.help:
+                lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for (series_name, labels), histogram in sorted(histograms.items()):
+                if series_name != name:
+                    continue
+                for bound, count in zip(histogram["buckets"], histogram["counts"]):
+                    lines.append(f"{name}_bucket{self.format_labels(labels, [('le', bound)])} {count}")
+                lines.append(f"{name}_bucket{self.format_labels(labels, [('le', '+Inf')])} {histogram['count']}")
+                lines.append(f"{name}_sum{self.format_labels(labels)} {histogram['sum']}")
+                lines.append(f"{name}_count{self.format_labels(labels)} {histogram['count']}")
+
+        return "\n".join(lines) + "\n"
+
+
+# Process-wide registry shared by every component
+metrics = Metrics()
+metrics.describe("graph_node_duration_seconds", "Time spent inside each node of the graph.")
+metrics.describe("graph_invoke_duration_seconds", "Time spent answering a question end to end.")
+metrics.describe("chain_duration_seconds", "Time spent inside each named chain.")
+metrics.describe("llm_call_duration_seconds", "Time spent waiting for the LLM.")
+metrics.describe("llm_tokens_total", "Tokens consumed by LLM calls.")
+metrics.describe("cache_requests_total", "Cache lookups split by hit and miss.")
+metrics.describe("cache_invalidations_total", "Cache entries removed by invalidation.")
+metrics.describe("sql_query_duration_seconds", "Time spent executing SQL queries against the database.")
+metrics.describe("sql_results_truncated_total", "SQL results cut at the row or size limit.")
+metrics.describe("sql_plan_cost", "Estimated cost of the generated SQL queries.")
+metrics.describe("sql_plan_rows", "Estimated rows of the generated SQL queries.")
+metrics.describe("sql_cost_guard_total", "Generated SQL queries allowed, rewritten or rejected by the cost guard.")
+metrics.describe("agent_prefetch_total", "Agent context fetched ahead of the entry point, used, discarded or cancelled.")
+metrics.describe("single_flight_calls_total", "Calls executed or shared with an identical call in flight.")
+metrics.describe("llm_retries_total", "LLM calls retried after a throttling or server error.")
+metrics.describe("llm_queue_depth", "LLM calls waiting for quota, by priority.")
+metrics.describe("llm_queue_wait_seconds", "Time LLM calls waited for quota, by priority.")
+metrics.describe("llm_queue_timeouts_total", "LLM calls that gave up waiting for quota.")
+metrics.describe("llm_scheduled_tokens_total", "Estimated tokens admitted by the LLM scheduler, by priority.")
+metrics.describe("csv_file_selection_total", "CSV files picked by the local index or by the LLM.")
+metrics.describe("csv_frame_cache_bytes", "Memory used by the parsed CSV files kept in the frame cache.")
+
+
+class Tracer(BaseCallbackHandler):
+    # Turns LangChain callbacks into OpenTelemetry-like spans and Prometheus metrics.
+    # Spans are recorded for the graph itself, each graph node, each named chain and each LLM call.
+
+    def __init__(self, registry=metrics):
+        self.metrics = registry
+        self.lock = threading.Lock()
+        self.runs = {}
+
+    def start_span(self, kind, name, run_id, parent_run_id, metadata):
+        with self.lock:
+            parent = self.runs.get(parent_run_id) if parent_run_id else None
+            node = (metadata or {}).get("langgraph_node") or (parent["node"] if parent else None)
+            chain = parent["chain"] if parent else None
+            self.runs[run_id] = {
+                "kind": kind,
+                "name": name,
+                "trace_id": parent["trace_id"] if parent else uuid.uuid4().hex,
+                "span_id": uuid.uuid4().hex[:16],
+                "parent_span_id": parent["span_id"] if parent else None,
+                "node": node,
+                "chain": name if kind == "chain" else chain,
+                "start_time_unix_nano": time.time_ns(),
+                "start": time.perf_counter(),
+                "traced": kind is not None
+            }
+
+    def end_span(self, run_id, error=None, attributes=None):
+        with self.lock:
+            run = self.runs.pop(run_id, None)
+        if run is None or not run["traced"]:
+            return None
+        duration = time.perf_counter() - run["start"]
+        span = {
+            "trace_id": run["trace_id"],
+            "span_id": run["span_id"],
+            "parent_span_id": run["parent_span_id"],
+            "name": run["name"],
+            "kind": run["kind"],
+            "start_time_unix_nano": run["start_time_unix_nano"],
+            "end_time_unix_nano": run["start_time_unix_nano"] + int(duration * 1e9),
+            "status": "ERROR" if error else "OK",
+            "attributes": { "node": run["node"], "chain": run["chain"], "duration_seconds": duration, **(attributes or {}) }
+        }
+        self.metrics.record_span(span)
+        return run, duration
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, tags=None, metadata=None, **kwargs):
+        name = kwargs.get("name") or ""
+        node = (metadata or {}).get("langgraph_node")
+        if parent_run_id is None:
+            kind = "graph"
+        elif node and name == node:
+            kind = "node"
+        elif name.endswith("_chain"):
+            kind = "chain"
+        else:
+            # Untraced runs are still tracked so their children can find their parents
+            kind = None
+        self.start_span(kind, name, run_id, parent_run_id, metadata)
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self.finish_chain(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self.finish_chain(run_id, error)
+
+    def finish_chain(self, run_id, error=None):
+        ended = self.end_span(run_id, error)
+        if ended is None:
+            return
+        run, duration = ended
+        if run["kind"] == "graph":
+            self.metrics.observe("graph_invoke_duration_seconds", duration)
+        elif run["kind"] == "node":
+            self.metrics.observe("graph_node_duration_seconds", duration, { "node": run["node"] })
+        else:
+            self.metrics.observe("chain_duration_seconds", duration, { "node": run["node"], "chain": run["name"] })
+        if error:
+            self.metrics.inc("graph_errors_total", { "kind": run["kind"], "name": run["name"] })
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        self.start_span("llm", kwargs.get("name") or "llm", run_id, parent_run_id, metadata)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, metadata=None, **kwargs):
+        self.start_span("llm", kwargs.get("name") or "llm", run_id, parent_run_id, metadata)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        usage = self.get_token_usage(response)
+        ended = self.end_span(run_id, attributes=usage)
+        if ended is None:
+            return
+        run, duration = ended
+        labels = { "node": run["node"], "chain": run["chain"] }
+        self.metrics.observe("llm_call_duration_seconds", duration, labels)
+        for token_type in ("prompt", "completion", "cached"):
+            if usage.get(f"{token_type}_tokens"):
+                self.metrics.inc("llm_tokens_total", { **labels, "type": token_type }, usage[f"{token_type}_tokens"])
+        if usage.get("cached_tokens"):
+            self.metrics.record_cache("llm_prompt", True)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        ended = self.end_span(run_id, error)
+        if ended is not None:
+            run, _ = ended
+            self.metrics.inc("llm_errors_total", { "node": run["node"], "chain": run["chain"] })
+
+    @staticmethod
+    def get_token_usage(response):
+        # Azure OpenAI reports usage in llm_output, newer versions also attach it to the message
+        token_usage = (getattr(response, "llm_output", None) or {}).get("token_usage") or {}
+        if token_usage:
+            details = token_usage.get("prompt_tokens_details") or {}
+            return {
+                "prompt_tokens": token_usage.get("prompt_tokens", 0),
+                "completion_tokens": token_usage.get("completion_tokens", 0),
+                "cached_tokens": details.get("cached_tokens", 0) or 0
+            }
+        for generations in getattr(response, "generations", None) or []:
+            for generation in generations:
+                usage_metadata = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage_metadata:
+                    return {
+                        "prompt_tokens": usage_metadata.get("input_tokens", 0),
+                        "completion_tokens": usage_metadata.get("output_tokens", 0),
+                        "cached_tokens": 0
+                    }
+        return {}
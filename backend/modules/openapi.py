@@ -0,0 +1,150 @@
+import hashlib
+import json
+import logging
+import os
+from urllib.parse import quote
+from .utils import is_private_dir, write_json
+
+logger = logging.getLogger(__name__)
+
+def resolve_pointer(spec, ref):
+    # Only local references (#/components/...) are supported
+    node = spec
+    for part in ref.lstrip("#/").split("/"):
+        node = node[part.replace("~1", "/").replace("~0", "~")]
+    return node
+
+def resolve_refs(node, spec, resolving=()):
+    if isinstance(node, dict):
+        ref = node.get("$ref")
+        if isinstance(ref, str) and ref.startswith("#/"):
+            # Recursive schemas are left as references to avoid infinite expansion
+            if ref in resolving:
+                return node
+            return resolve_refs(resolve_pointer(spec, ref), spec, resolving + (ref,))
+        return {key: resolve_refs(value, spec, resolving) for key, value in node.items()}
+    if isinstance(node, list):
+        return [resolve_refs(item, spec, resolving) for item in node]
+    return node
+
+def build_index(spec, endpoint_filter, methods=("get",)):
+    # Maps each selected path to its fully dereferenced operations
+    operations = {}
+    for path, path_item in spec.get("paths", {}).items():
+        if len(endpoint_filter) > 0 and not any(keyword in path for keyword in endpoint_filter):
+            continue
+        shared_parameters = path_item.get("parameters", [])
+        for method, details in path_item.items():
+            if method not in methods:
+                continue
+            operation = resolve_refs(details, spec)
+            # Parameters declared at path level apply to every operation of the path
+            parameters = {(p.get("name"), p.get("in")): p for p in resolve_refs(shared_parameters, spec)}
+            parameters.update({(p.get("name"), p.get("in")): p for p in operation.get("parameters", [])})
+            operation["parameters"] = list(parameters.values())
+            operations.setdefault(path, {})[method] = operation
+    return operations
+
+class SpecCache:
+    # Keeps the indexed specification on disk so restarts do not download and parse it again. The base URL
+    # of every call comes from it, so the files are only trusted in a directory that nobody else can write.
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f"{hashlib.sha256(key.encode()).hexdigest()}.json")
+
+    def load(self, key):
+        try:
+            if not is_private_dir(self.cache_dir):
+                logger.warning("Ignoring specification cache, %s is not a private directory", self.cache_dir)
+                return None
+            with open(self.get_path(key)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Ignoring unreadable specification cache: %s", e)
+            return None
+
+    def save(self, key, entry):
+        try:
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+            if not is_private_dir(self.cache_dir):
+                logger.warning("Not writing specification cache, %s is not a private directory", self.cache_dir)
+                return
+            write_json(self.get_path(key), entry)
+        except Exception as e:
+            logger.warning("Could not write specification cache: %s", e)
+
+def get_operation_signature(operation):
+    # A compact view of an operation, enough to plan a call without the response schemas
+    parameters = []
+    for parameter in operation.get("parameters", []):
+        schema = parameter.get("schema", {})
+        signature = { "name": parameter.get("name"), "in": parameter.get("in"), "required": parameter.get("required", False), "type": schema.get("type", "string") }
+        if "enum" in schema:
+            signature["enum"] = schema["enum"]
+        if parameter.get("description"):
+            signature["description"] = parameter["description"][:200]
+        parameters.append(signature)
+    return { "operationId": operation.get("operationId"), "summary": operation.get("summary", "No summary"), "parameters": parameters }
+
+def find_operation(operations, name):
+    # Plans may refer to an operation by its operationId or by its path
+    if name in operations and "get" in operations[name]:
+        return name, operations[name]["get"]
+    for path, methods in operations.items():
+        for operation in methods.values():
+            if operation.get("operationId") == name:
+                return path, operation
+    return None, None
+
+def validate_call(plan, operations):
+    if not isinstance(plan, dict) or not isinstance(plan.get("operation"), str):
+        return None, None, ["the plan must be an object with an 'operation' field"]
+    parameters = plan.get("parameters") or {}
+    if not isinstance(parameters, dict):
+        return None, None, ["'parameters' must be an object"]
+
+    path, operation = find_operation(operations, plan["operation"])
+    if operation is None:
+        return None, None, [f"unknown operation '{plan['operation']}'"]
+
+    errors = []
+    declared = { parameter["name"]: parameter for parameter in operation.get("parameters", []) }
+    for name, parameter in declared.items():
+        if parameter.get("required") and parameters.get(name) in (None, ""):
+            errors.append(f"missing required parameter '{name}'")
+    for name, value in parameters.items():
+        if name not in declared:
+            errors.append(f"unknown parameter '{name}'")
+            continue
+        schema = declared[name].get("schema", {})
+        if "enum" in schema and value not in schema["enum"]:
+            errors.append(f"invalid value '{value}' for parameter '{name}'")
+        elif schema.get("type") == "integer" and not isinstance(value, int):
+            try:
+                int(value)
+            except (TypeError, ValueError):
+                errors.append(f"parameter '{name}' must be an integer")
+    return path, operation, errors
+
+def build_request(base_url, path, operation, parameters):
+    # Splits the plan parameters between the path, the query string and the headers
+    url_path = path
+    query = {}
+    headers = {}
+    locations = { parameter["name"]: parameter.get("in") for parameter in operation.get("parameters", []) }
+    for name, value in parameters.items():
+        if value is None:
+            continue
+        location = locations.get(name)
+        if location == "path":
+            url_path = url_path.replace(f"{{{name}}}", quote(str(value), safe=""))
+        elif location == "header":
+            headers[name] = str(value)
+        else:
+            query[name] = value
+    return f"{base_url.rstrip('/')}{url_path}", query, headers
@@ -0,0 +1,162 @@
+import difflib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from .metrics import metrics
+from .utils import is_private_dir, write_json
+
+logger = logging.getLogger(__name__)
+
+LITERAL = re.compile(r"'[^']*'|\"[^\"]*\"|\b\d+(?:\.\d+)?\b")
+
+def extract_literals(question):
+    # Numbers and quoted strings are the parameters of a question, the rest is its shape
+    literals = []
+    for match in LITERAL.finditer(question):
+        value = match.group().strip("'\"")
+        if value not in literals:
+            literals.append(value)
+    return literals
+
+def normalize_question(question):
+    template = question.lower()
+    for index, value in enumerate(extract_literals(template)):
+        template = re.sub(rf"(?<![\w.])['\"]?{re.escape(value)}['\"]?(?![\w.])", f" <{index}> ", template)
+    template = re.sub(r"[^\w<>\s]", " ", template)
+    return " ".join(template.split())
+
+NUMBER = re.compile(r"^-?\d+(\.\d+)?$")
+SQL_STRING = re.compile(r"N?'(?:[^']|'')*'")
+
+def parameterize_query(query, literals):
+    # Replaces the question parameters in the SQL with placeholders and tells the kind of each slot: numbers
+    # written as such, or values inside a quoted SQL string. None unless each of them appears exactly once
+    # (a value that only happens to match, e.g. a flag = 1 for "top 1", would be replaced too) and in one of
+    # those two places, anything else (names, keywords) cannot be replaced safely.
+    strings = [match.span() for match in SQL_STRING.finditer(query)]
+    spans = []
+    for index, value in enumerate(literals):
+        matches = list(re.finditer(rf"(?<![\w.]){re.escape(value)}(?![\w.])", query))
+        if len(matches) != 1:
+            return None
+        start, stop = matches[0].span()
+        if any(begin < start and stop < end for begin, end in strings):
+            kind = "string"
+        elif NUMBER.match(value):
+            kind = "number"
+        else:
+            return None
+        spans.append((start, stop, index, kind))
+    spans.sort()
+    template = ""
+    end = 0
+    for start, stop, index, _ in spans:
+        if start < end:
+            return None
+        template += query[end:start].replace("{", "{{").replace("}", "}}") + f"{{{index}}}"
+        end = stop
+    template += query[end:].replace("{", "{{").replace("}", "}}")
+    return template, [kind for *_, kind in sorted(spans, key=lambda span: span[2])]
+
+def fill_template(template, kinds, literals):
+    # The values of a new question go into the slots of their own kind only, None on any mismatch
+    values = []
+    for kind, value in zip(kinds, literals):
+        if kind == "number" and NUMBER.match(value):
+            values.append(value)
+        elif kind == "string":
+            values.append(value.replace("'", "''"))
+        else:
+            return None
+    return template.format(*values)
+
+class PlanCache:
+    # Persistent store of validated question -> SQL pairs. Questions with the same shape reuse the
+    # stored SQL with their own parameters, similar ones are offered to the LLM as examples. Questions that
+    # are part of a conversation may depend on it, so they are only kept as examples and never reuse a query.
+
+    def __init__(self, path, max_entries=500, min_similarity=0.6, min_words=4):
+        self.path = path
+        self.directory = os.path.dirname(path) or "."
+        self.max_entries = max_entries
+        self.min_similarity = min_similarity
+        self.min_words = min_words
+        self.lock = threading.Lock()
+        self.entries = self.load()
+
+    def load(self):
+        try:
+            # The stored queries run without going through the LLM, only a private directory is trusted
+            if not is_private_dir(self.directory):
+                logger.warning("Ignoring plan cache, %s is not a private directory", self.directory)
+                return {}
+            with open(self.path) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning("Ignoring unreadable plan cache: %s", e)
+            return {}
+
+    def save(self):
+        # Must be called with the lock held. Other workers share the file, so their pairs are merged in
+        # (the most recently used one wins) instead of being overwritten.
+        for template, entry in self.load().items():
+            if template not in self.entries or self.entries[template]["used_at"] < entry["used_at"]:
+                self.entries[template] = entry
+        # Forget the least recently used pairs
+        while len(self.entries) > self.max_entries:
+            del self.entries[min(self.entries, key=lambda key: self.entries[key]["used_at"])]
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            if not is_private_dir(self.directory):
+                logger.warning("Not writing plan cache, %s is not a private directory", self.directory)
+                return
+            write_json(self.path, self.entries)
+        except Exception as e:
+            logger.warning("Could not write plan cache: %s", e)
+
+    def add(self, question, query, history=None):
+        literals = extract_literals(question)
+        template, kinds = parameterize_query(query, literals) or (None, None)
+        entry = { "question": question, "query": query, "literals": literals, "sql_template": template, "slots": kinds, "standalone": not history, "used_at": time.time() }
+        with self.lock:
+            self.entries[normalize_question(question)] = entry
+            self.save()
+
+    def lookup(self, question, history=None):
+        # Returns the stored SQL adapted to the question parameters when a question with the same shape was seen
+        if history:
+            metrics.record_cache("sql_plan", False)
+            return None
+        template = normalize_question(question)
+        literals = extract_literals(question)
+        with self.lock:
+            entry = self.entries.get(template)
+            if entry is not None:
+                entry["used_at"] = time.time()
+
+        query = None
+        if entry is not None and entry.get("standalone", True) and len(re.sub(r"<\d+>", "", template).split()) >= self.min_words:
+            if literals == entry["literals"]:
+                query = entry["query"]
+            elif entry["sql_template"] is not None and entry.get("slots") is not None and len(literals) == len(entry["literals"]):
+                query = fill_template(entry["sql_template"], entry["slots"], literals)
+        metrics.record_cache("sql_plan", query is not None)
+        return query
+
+    def examples(self, question, k=3):
+        # The most similar stored pairs, to be used as few-shot examples
+        words = normalize_question(question).split()
+        with self.lock:
+            entries = list(self.entries.items())
+        scored = []
+        for template, entry in entries:
+            similarity = difflib.SequenceMatcher(None, words, template.split()).ratio()
+            if similarity >= self.min_similarity:
+                scored.append((similarity, entry))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [{ "question": entry["question"], "query": entry["query"] } for _, entry in scored[:k]]
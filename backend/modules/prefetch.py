@@ -0,0 +1,43 @@
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Shared by every agent, the fetches spend most of their time waiting for the network
+executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="prefetch")
+
+class Prefetch:
+    # Starts fetching what an agent will need while it waits for something else (the entry point LLM call).
+    # The result is either used or discarded; a discarded fetch is cancelled if it has not started yet.
+    # When disabled the fetch simply runs when its result is asked for.
+
+    def __init__(self, agent, fn, *args, enabled=True):
+        self.agent = agent
+        self.fn = fn
+        self.args = args
+        self.future = None
+        if enabled:
+            # The request context (request id, LLM session) goes along with the fetch
+            context = contextvars.copy_context()
+            self.future = executor.submit(context.run, fn, *args)
+
+    def result(self):
+        if self.future is None:
+            return self.fn(*self.args)
+        metrics.inc("agent_prefetch_total", {"agent": self.agent, "result": "used"})
+        return self.future.result()
+
+    def discard(self):
+        if self.future is None:
+            return
+        cancelled = self.future.cancel()
+        metrics.inc("agent_prefetch_total", {"agent": self.agent, "result": "cancelled" if cancelled else "discarded"})
+        if not cancelled:
+            self.future.add_done_callback(self.log_error)
+
+    def log_error(self, future):
+        # Nobody waits for a discarded result, its errors are only logged
+        if future.exception() is not None:
+            logger.debug("%s says: discarded prefetch failed: %s", self.agent, future.exception())
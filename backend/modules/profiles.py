@@ -0,0 +1,93 @@
+from .file_index import tokenize
+
+# Statistics of the column profiles and the words asking for them
+STATISTICS = {
+    "mean": {"average", "mean"},
+    "max": {"maximum", "max", "highest", "largest", "biggest", "latest"},
+    "min": {"minimum", "min", "lowest", "smallest", "earliest"},
+    "sum": {"sum", "total"},
+    "distinct": {"distinct", "unique", "different"},
+    "null_rate": {"missing", "null", "empty", "blank"},
+}
+
+# Words that only say the question is about the rows or the columns of the files
+ROW_WORDS = {"row", "record", "entry", "entrie", "line"}
+COLUMN_WORDS = {"column", "field", "attribute", "header"}
+GENERIC_WORDS = {"number", "count", "value", "dataset", "table", "overall", "percentage", "percent", "rate", "share", "name"} | ROW_WORDS | COLUMN_WORDS
+
+# Questions about a particular entity need the rows themselves, negations are dropped by the tokenizer
+ENTITY_WORDS = {"who", "which", "whose", "whom"}
+NEGATION_WORDS = {"not", "no", "non", "without", "except", "excluding", "neither", "nor"}
+
+def format_profile(file, profile):
+    # One line per column, the context the code is generated from
+    lines = [f"{file}: {profile['rows']} rows"]
+    for column in profile["columns"]:
+        details = [f"{column['distinct']} distinct"]
+        if column.get("null_rate"):
+            details.append(f"{column['null_rate']:.0%} null")
+        if "min" in column:
+            details.append(f"min {column['min']}, max {column['max']}, mean {column['mean']}")
+        if column.get("top"):
+            details.append("most frequent: " + ", ".join(f"{value} ({count})" for value, count in column["top"]))
+        lines.append(f"- {column['name']} ({column['dtype']}): {'; '.join(details)}")
+    return "\n".join(lines)
+
+def get_statistic(column, statistic):
+    if statistic == "distinct":
+        return column["distinct"]
+    if statistic == "null_rate":
+        return column.get("null_rate", 0)
+    return column.get(statistic)
+
+def answer_from_profile(question, file, profile, description=""):
+    words = set(question.lower().replace("?", " ").split())
+    tokens = set(tokenize(question))
+    if words & (ENTITY_WORDS | NEGATION_WORDS) or any(word.endswith("n't") for word in words):
+        return None
+
+    statistics = [name for name, statistic_words in STATISTICS.items() if tokens & statistic_words]
+    columns = [column for column in profile["columns"] if set(tokenize(column["name"])) and set(tokenize(column["name"])) <= tokens]
+    values = { (column["name"], str(value)): count for column in profile["columns"] for value, count in column.get("top", []) }
+    value_tokens = set().union(*(tokenize(value) for _, value in values))
+
+    # Words of the file description that are neither column names nor values say what the rows are (e.g. characters)
+    subjects = set(tokenize(description)) - value_tokens - set().union(*(tokenize(column["name"]) for column in profile["columns"]))
+    explained = GENERIC_WORDS | set(tokenize(file)) | subjects | set().union(*STATISTICS.values()) | set().union(*(tokenize(column["name"]) for column in columns))
+    unexplained = tokens - explained
+    counting = "how many" in question.lower() or bool(tokens & {"count", "number"})
+
+    if not unexplained and len(statistics) == 1 and len(columns) == 1:
+        # A statistic of a single column
+        value = get_statistic(columns[0], statistics[0])
+        return None if value is None else { "column": columns[0]["name"], statistics[0]: value }
+    if unexplained or statistics:
+        # A count of the rows with one of the most frequent values of a column
+        named = {column["name"] for column in columns}
+        matches = [key for key in values if set(tokenize(key[1])) == unexplained and (not named or key[0] in named)]
+        if counting and not statistics and unexplained and len(matches) == 1:
+            return { "column": matches[0][0], "value": matches[0][1], "rows": values[matches[0]] }
+        return None
+    if columns:
+        return None
+    if tokens & COLUMN_WORDS and not tokens & ROW_WORDS:
+        return { "columns": [column["name"] for column in profile["columns"]] }
+    if counting or tokens & ROW_WORDS:
+        return { "rows": profile["rows"] }
+    return None
+
+def answer_from_profiles(question, files, profiles, descriptions=None):
+    # Answers simple questions about the files (size, columns, a statistic of a column, the count of a
+    # frequent value) from their profiles. Returns None as soon as one of the files cannot answer.
+    descriptions = descriptions or {}
+    if not files:
+        return None
+    results = {}
+    for file in files:
+        if file not in profiles:
+            return None
+        result = answer_from_profile(question, file, profiles[file], descriptions.get(file, ""))
+        if result is None:
+            return None
+        results[file] = result
+    return results
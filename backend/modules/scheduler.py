@@ -0,0 +1,157 @@
+import contextvars
+import itertools
+import threading
+import time
+from .metrics import metrics
+
+# From the most to the least important: the final answer, the agents answers, routing and selection
+# steps, the greeting and background work such as the history summaries
+PRIORITIES = ("summarizer", "answer", "routing", "greeting", "background")
+DEFAULT_PRIORITY = "answer"
+
+# Session the LLM calls of the current request are accounted to
+llm_session = contextvars.ContextVar("llm_session", default="-")
+
+QUEUE_WAIT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+class TokenBucket:
+    # Refills continuously up to the per-minute limit, a limit of 0 means unlimited
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        if self.capacity:
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60)
+        self.updated = now
+
+    def get_wait(self, amount, reserve=0):
+        # Seconds until the amount can be taken while leaving the reserved share for others
+        if not self.capacity:
+            return 0
+        needed = min(self.capacity, min(amount, self.capacity) + reserve * self.capacity)
+        if self.level >= needed:
+            return 0
+        return (needed - self.level) * 60 / self.capacity
+
+    def take(self, amount):
+        if self.capacity:
+            self.level -= min(amount, self.capacity)
+
+
+class SharedTokenBucket:
+    # Per-minute budget counted in a shared state backend, so every worker draws from the same quota.
+    # Fixed one minute windows, which is how the service counts them too.
+
+    def __init__(self, backend, name, per_minute):
+        self.backend = backend
+        self.name = name
+        self.capacity = per_minute
+
+    def get_window(self):
+        now = time.time()
+        return f"llm-quota:{self.name}:{int(now // 60)}", 60 - now % 60
+
+    def refill(self, now):
+        pass
+
+    def get_wait(self, amount, reserve=0):
+        if not self.capacity:
+            return 0
+        needed = min(self.capacity, min(amount, self.capacity) + reserve * self.capacity)
+        key, remaining = self.get_window()
+        if self.capacity - self.backend.get_counter(key) >= needed:
+            return 0
+        return remaining
+
+    def take(self, amount):
+        if self.capacity:
+            self.backend.incr(self.get_window()[0], min(amount, self.capacity), ttl=120)
+
+
+class LLMScheduler:
+    # Admits the LLM calls of the whole process against the Azure OpenAI token and request quotas.
+    # Waiting calls are served by priority first and then fairly between sessions (start-time fair
+    # queuing on the tokens each session used), so a busy session cannot starve the others.
+    # Low priorities can only use the quota above their reserve, which is kept for interactive calls.
+    # With a shared state backend the quota is counted there, for all the workers together.
+
+    def __init__(self, config, backend=None):
+        if backend is not None and backend.shared:
+            self.tokens = SharedTokenBucket(backend, "tokens", config.get("tokens_per_minute", 0))
+            self.requests = SharedTokenBucket(backend, "requests", config.get("requests_per_minute", 0))
+        else:
+            self.tokens = TokenBucket(config.get("tokens_per_minute", 0))
+            self.requests = TokenBucket(config.get("requests_per_minute", 0))
+        self.reserve = config.get("reserve", {})
+        self.queue_timeout = config.get("queue_timeout", 60)
+        self.condition = threading.Condition()
+        self.sequence = itertools.count()
+        self.queue = []
+        self.depth = dict.fromkeys(PRIORITIES, 0)
+        self.virtual_time = 0
+        self.finish = {}
+        self.paused_until = 0
+
+    def get_wait(self, entry, priority, tokens, now):
+        if now < self.paused_until:
+            return self.paused_until - now
+        if entry != min(self.queue):
+            # Not our turn, wait to be notified
+            return None
+        reserve = self.reserve.get(priority, 0)
+        return max(self.tokens.get_wait(tokens, reserve), self.requests.get_wait(1, reserve))
+
+    def acquire(self, tokens, priority=None, session=None):
+        priority = priority if priority in PRIORITIES else DEFAULT_PRIORITY
+        session = session or llm_session.get()
+        start = time.monotonic()
+        deadline = start + self.queue_timeout
+
+        with self.condition:
+            virtual_start = max(self.virtual_time, self.finish.get(session, 0))
+            self.finish[session] = virtual_start + tokens
+            entry = (PRIORITIES.index(priority), virtual_start, next(self.sequence))
+            self.queue.append(entry)
+            self.set_depth(priority, 1)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.tokens.refill(now)
+                    self.requests.refill(now)
+                    wait = self.get_wait(entry, priority, tokens, now)
+                    if wait == 0:
+                        break
+                    if now >= deadline:
+                        metrics.inc("llm_queue_timeouts_total", {"priority": priority})
+                        raise TimeoutError(f"LLM call waited more than {self.queue_timeout}s for quota")
+                    self.condition.wait(deadline - now if wait is None else min(wait, deadline - now))
+
+                self.tokens.take(tokens)
+                self.requests.take(1)
+                self.virtual_time = virtual_start
+                self.prune()
+            finally:
+                self.queue.remove(entry)
+                self.set_depth(priority, -1)
+                self.condition.notify_all()
+
+        metrics.observe("llm_queue_wait_seconds", time.monotonic() - start, {"priority": priority}, buckets=QUEUE_WAIT_BUCKETS)
+        metrics.inc("llm_scheduled_tokens_total", {"priority": priority}, tokens)
+
+    def pause(self, seconds):
+        # A throttled call stops every other call until the quota is back, instead of each one retrying alone
+        with self.condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.condition.notify_all()
+
+    def prune(self):
+        # Sessions behind the virtual time have no advantage left to remember
+        if len(self.finish) > 1000:
+            self.finish = {session: finish for session, finish in self.finish.items() if finish > self.virtual_time}
+
+    def set_depth(self, priority, change):
+        self.depth[priority] += change
+        metrics.set_gauge("llm_queue_depth", self.depth[priority], {"priority": priority})
@@ -0,0 +1,141 @@
+import functools
+import json
+import logging
+import math
+import numbers
+import re
+
+logger = logging.getLogger(__name__)
+
+@functools.lru_cache(maxsize=1)
+def get_encoder():
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # The encoding files may not be available offline, an estimate is good enough for a budget
+        logger.warning("Token counting falls back to an estimate: %s", e)
+        return None
+
+def count_tokens(text):
+    encoder = get_encoder()
+    if encoder is None:
+        return math.ceil(len(text) / 4)
+    return len(encoder.encode(text, disallowed_special=()))
+
+def truncate_tokens(text, max_tokens):
+    if count_tokens(text) <= max_tokens:
+        return text
+    # Keep the proportional share of characters, leaving room for the marker
+    keep = max(0, int(len(text) * max_tokens / count_tokens(text)) - 40)
+    return f"{text[:keep]}... [{len(text) - keep} chars truncated]"
+
+def project_json(data, fields=None, excluded_keys=()):
+    # Keeps only the given fields (at any depth, objects and lists are always walked into) and drops
+    # empty values and the keys matching one of the excluded patterns
+    patterns = [re.compile(pattern) for pattern in excluded_keys]
+    def project(node):
+        if isinstance(node, dict):
+            projected = {}
+            for key, value in node.items():
+                if fields is not None and key not in fields and not isinstance(value, (dict, list)):
+                    continue
+                if any(pattern.match(str(key)) for pattern in patterns):
+                    continue
+                value = project(value)
+                if value in (None, "", [], {}):
+                    continue
+                projected[key] = value
+            return projected
+        if isinstance(node, list):
+            return [project(item) for item in node]
+        return node
+    return project(data)
+
+def shrink_lists(data, max_items):
+    # Keeps the first items of every list and tells how many were left out
+    if isinstance(data, dict):
+        return {key: shrink_lists(value, max_items) for key, value in data.items()}
+    if isinstance(data, list):
+        items = [shrink_lists(item, max_items) for item in data[:max_items]]
+        if len(data) > max_items:
+            items.append(f"... {len(data) - max_items} more items")
+        return items
+    return data
+
+def serialize_json(data, max_tokens, fields=None, excluded_keys=()):
+    text = json.dumps(data, default=str, ensure_ascii=False)
+    # Payloads within the budget are shown whole unless only some fields were asked for
+    if fields is None and count_tokens(text) <= max_tokens:
+        return text
+    data = project_json(data, fields, excluded_keys)
+    text = json.dumps(data, default=str, ensure_ascii=False)
+    max_items = 50
+    while count_tokens(text) > max_tokens and max_items > 1:
+        max_items //= 2
+        text = json.dumps(shrink_lists(data, max_items), default=str, ensure_ascii=False)
+    return truncate_tokens(text, max_tokens)
+
+def summarize_columns(columns, rows):
+    # Aggregates over every row, so the answer can rely on them even when most rows are left out
+    summaries = {}
+    for index, column in enumerate(columns):
+        values = [row[index] for row in rows if row[index] is not None]
+        numeric = [value for value in values if isinstance(value, numbers.Number) and not isinstance(value, bool)]
+        if numeric and len(numeric) == len(values):
+            summaries[column] = { "min": min(numeric), "max": max(numeric), "mean": round(sum(numeric) / len(numeric), 4), "sum": sum(numeric) }
+        else:
+            summaries[column] = { "distinct": len(set(map(str, values))) }
+        if len(values) < len(rows):
+            summaries[column]["nulls"] = len(rows) - len(values)
+    return summaries
+
+def serialize_table(columns, rows, max_tokens, note=None):
+    columns = [str(column) for column in columns]
+    rows = [tuple(row) for row in rows]
+    text = f"Columns: {columns} Rows: {rows}"
+    if note:
+        text += f" ({note})"
+    if count_tokens(text) <= max_tokens:
+        return text
+
+    # Too big: first and last rows plus aggregates over all of them
+    summary = f"Row count: {len(rows)} Aggregates: {summarize_columns(columns, rows)}"
+    if note:
+        summary += f" ({note})"
+    keep = max(len(rows) // 2, 1)
+    while True:
+        head, tail = rows[:keep], rows[-keep:] if len(rows) > 2 * keep else []
+        omitted = len(rows) - len(head) - len(tail)
+        text = f"Columns: {columns} First rows: {head}"
+        if tail:
+            text += f" Last rows: {tail} ({omitted} rows in between are not shown)"
+        text += f" {summary}"
+        if count_tokens(text) <= max_tokens or keep == 1:
+            return truncate_tokens(text, max_tokens)
+        keep //= 2
+
+def serialize_result(result, max_tokens, fields=None, excluded_keys=()):
+    # Turns any agent result (SQL rows, DataFrames, JSON payloads, plain values) into text for the
+    # answer prompt, never longer than the token budget
+    try:
+        import pandas as pd
+    except ImportError:
+        pd = None
+
+    if isinstance(result, dict) and "columns" in result and "rows" in result:
+        note = None
+        if result.get("truncated"):
+            limit = "row" if result["truncated"] == "rows" else "size"
+            note = f"only the first {len(result['rows'])} rows were read, the result was cut at the {limit} limit"
+        if not result["rows"]:
+            return "no rows"
+        return serialize_table(result["columns"], result["rows"], max_tokens, note)
+    if pd is not None and isinstance(result, pd.Series):
+        result = result.to_frame()
+    if pd is not None and isinstance(result, pd.DataFrame):
+        frame = result.reset_index() if not isinstance(result.index, pd.RangeIndex) else result
+        return serialize_table(list(frame.columns), frame.itertuples(index=False, name=None), max_tokens)
+    if isinstance(result, (dict, list)):
+        return serialize_json(result, max_tokens, fields, excluded_keys)
+    return truncate_tokens(str(result), max_tokens)
@@ -0,0 +1,76 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+def get_engine_args(config):
+    # Connection pool settings for SQLAlchemy: connections are checked before use and recycled
+    # before the server or a firewall drops them
+    return {
+        "pool_size": config.get("pool_size", 5),
+        "max_overflow": config.get("pool_max_overflow", 10),
+        "pool_pre_ping": True,
+        "pool_recycle": config.get("pool_recycle", 1800),
+    }
+
+def execute_query(engine, query, timeout=30, max_rows=200, max_bytes=50000, fetch_size=50):
+    # Runs a query on a pooled connection, streaming rows until one of the caps is reached.
+    # Queries running longer than the timeout are cancelled on the server.
+    connection = engine.raw_connection()
+    driver_connection = connection.driver_connection
+    cursor = connection.cursor()
+    cancelled = threading.Event()
+
+    # Statement timeout enforced by the driver (pyodbc)
+    if hasattr(driver_connection, "timeout"):
+        driver_connection.timeout = timeout
+
+    def cancel():
+        cancelled.set()
+        logger.warning("Cancelling query after %ss", timeout)
+        try:
+            if hasattr(cursor, "cancel"):
+                cursor.cancel()  # pyodbc, sends the cancellation to the server
+            elif hasattr(driver_connection, "interrupt"):
+                driver_connection.interrupt()  # sqlite
+        except Exception as e:
+            logger.error("Could not cancel query: %s", e)
+
+    watchdog = threading.Timer(timeout, cancel)
+    watchdog.daemon = True
+    watchdog.start()
+    try:
+        cursor.execute(query)
+        columns = [column[0] for column in cursor.description or []]
+        rows = []
+        size = 0
+        truncated = None
+        while cursor.description and truncated is None:
+            batch = cursor.fetchmany(fetch_size)
+            if not batch:
+                break
+            for row in batch:
+                row = tuple(row)
+                size += len(repr(row))
+                if len(rows) >= max_rows:
+                    truncated = "rows"
+                    break
+                if size > max_bytes:
+                    truncated = "bytes"
+                    break
+                rows.append(row)
+        if truncated is not None and hasattr(cursor, "cancel"):
+            # Stop the server from sending the rows we are not going to read
+            cursor.cancel()
+        return { "columns": columns, "rows": rows, "truncated": truncated }
+    except Exception as e:
+        if cancelled.is_set():
+            raise TimeoutError(f"query cancelled after {timeout}s") from e
+        raise
+    finally:
+        watchdog.cancel()
+        try:
+            cursor.close()
+        except Exception as e:
+            logger.warning("Could not close cursor: %s", e)
+        connection.close()
@@ -0,0 +1,167 @@
+import logging
+import math
+import pickle
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class InProcessBackend:
+    # Keeps the state in this process only, every worker has its own copy
+
+    shared = False
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def read(self, key):
+        # Must be called with the lock held
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] is not None and entry[0] < time.monotonic():
+            del self.entries[key]
+            return None
+        return entry
+
+    @staticmethod
+    def expires_at(ttl):
+        return time.monotonic() + ttl if ttl else None
+
+    def get(self, key):
+        with self.lock:
+            entry = self.read(key)
+            return entry[1] if entry is not None else None
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.entries[key] = (self.expires_at(ttl), value)
+
+    def add(self, key, value, ttl=None):
+        # Sets the key only if it does not exist, returns whether it was set
+        with self.lock:
+            if self.read(key) is not None:
+                return False
+            self.entries[key] = (self.expires_at(ttl), value)
+            return True
+
+    def delete(self, *keys):
+        with self.lock:
+            return sum(self.entries.pop(key, None) is not None for key in keys)
+
+    def incr(self, key, amount=1, ttl=None):
+        with self.lock:
+            entry = self.read(key)
+            value = (entry[1] if entry is not None else 0) + amount
+            self.entries[key] = (entry[0] if entry is not None else self.expires_at(ttl), value)
+            return value
+
+    def get_counter(self, key):
+        return self.get(key) or 0
+
+    def add_member(self, key, member, ttl=None):
+        # Each member expires on its own, expired ones are dropped on every write
+        with self.lock:
+            entry = self.read(key)
+            now = time.monotonic()
+            members = {name: expires_at for name, expires_at in (entry[1] if entry is not None else {}).items() if expires_at >= now}
+            members[member] = now + ttl if ttl else math.inf
+            latest = max(members.values())
+            self.entries[key] = (latest if latest != math.inf else None, members)
+
+    def remove_members(self, key, *members):
+        with self.lock:
+            entry = self.read(key)
+            if entry is not None:
+                for member in members:
+                    entry[1].pop(member, None)
+
+    def members(self, key):
+        with self.lock:
+            entry = self.read(key)
+            now = time.monotonic()
+            return {name for name, expires_at in entry[1].items() if expires_at >= now} if entry is not None else set()
+
+
+class RedisBackend:
+    # Keeps the state in Redis (or anything speaking its protocol), so every worker shares it.
+    # Values are pickled: the server is private to the backend and holds our own cached objects.
+
+    shared = True
+
+    def __init__(self, client, prefix=""):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, prefix=""):
+        import redis
+        return cls(redis.Redis.from_url(url), prefix)
+
+    def key(self, key):
+        return f"{self.prefix}{key}"
+
+    @staticmethod
+    def milliseconds(ttl):
+        return int(ttl * 1000) if ttl else None
+
+    def get(self, key):
+        value = self.client.get(self.key(key))
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.key(key), pickle.dumps(value), px=self.milliseconds(ttl))
+
+    def add(self, key, value, ttl=None):
+        return bool(self.client.set(self.key(key), pickle.dumps(value), px=self.milliseconds(ttl), nx=True))
+
+    def delete(self, *keys):
+        if not keys:
+            return 0
+        return self.client.delete(*[self.key(key) for key in keys])
+
+    def incr(self, key, amount=1, ttl=None):
+        # Counters are stored as plain integers so Redis can increment them atomically
+        value = self.client.incrby(self.key(key), amount)
+        if ttl and value == amount:
+            self.client.pexpire(self.key(key), self.milliseconds(ttl))
+        return value
+
+    def get_counter(self, key):
+        value = self.client.get(self.key(key))
+        return int(value) if value is not None else 0
+
+    def add_member(self, key, member, ttl=None):
+        # Sorted set scored by the expiry of each member: expired ones are pruned on every write, so the set
+        # only grows with the live members, and it lives as long as its last member
+        key = self.key(key)
+        now = time.time()
+        self.client.zadd(key, {member: now + ttl if ttl else math.inf})
+        self.client.zremrangebyscore(key, "-inf", now)
+        expires_at = self.client.zrange(key, -1, -1, withscores=True)[0][1]
+        if expires_at == math.inf:
+            self.client.persist(key)
+        else:
+            self.client.pexpireat(key, math.ceil(expires_at * 1000))
+
+    def remove_members(self, key, *members):
+        if members:
+            self.client.zrem(self.key(key), *members)
+
+    def members(self, key):
+        return {member.decode() if isinstance(member, bytes) else member for member in self.client.zrangebyscore(self.key(key), time.time(), "+inf")}
+
+
+state_backend = InProcessBackend()
+
+def setup_state(config):
+    # Chooses the backend shared by caches, rate limiters and in-flight maps, before they are created
+    global state_backend
+    if config.get("backend") == "redis":
+        logger.info("Sharing state through Redis...")
+        state_backend = RedisBackend.from_url(config["redis_url"], config.get("prefix", ""))
+    else:
+        state_backend = InProcessBackend()
+    return state_backend
+
+def get_backend():
+    return state_backend
@@ -1,18 +1,19 @@
 from .models import State
+from .llm import get_llm_kwargs
 from langchain_openai import AzureChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnableLambda
+import logging
+
+logger = logging.getLogger(__name__)
 
 class Summarizer:
     
     def __init__(self): 
 
         # Instantiate a pre-trained Large Language Model from Azure OpenAI
-        self.llm = AzureChatOpenAI(
-            deployment_name="gpt-4o",
-            api_version="2023-06-01-preview"
-        )
+        self.llm = AzureChatOpenAI(**get_llm_kwargs("summarizer_chain"))
 
         # The system prompt guides the agent on how to respond
         self.system_prompt = (
@@ -42,10 +43,10 @@ class Summarizer:
             | self.prompt
             | self.llm
             | self.parser
-        )
+        ).with_config(run_name="summarizer_chain")
 
     def generate_answer(self, state: State):
-        print("Summarizing...")
+        logger.info("Summarizing...")
         if "agents" not in state:    
             answer = self.chain.invoke({ "question": state["question"], "agents_output": "NO RESPONSES" })
             return { "answer": answer, "agents": {} }
@@ -1,12 +1,20 @@
 from .models import State
+from .utils import compact_history
+from .llm import get_llm_kwargs
 from langchain_openai import AzureChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnableLambda
+import logging
+
+logger = logging.getLogger(__name__)
 
 class Supervisor:
     
-    def __init__(self, agent_list): 
+    def __init__(self, agent_list, history_tokens=1000): 
+
+        # Token budget for the chat history included in the prompt
+        self.history_tokens = history_tokens
 
         # List with all the agents to supervise
         self.agents = [{
@@ -14,10 +22,7 @@ class Supervisor:
             "agent_skills": agent.skills } for agent in agent_list]
 
         # Instantiate a pre-trained Large Language Model from Azure OpenAI
-        self.llm = AzureChatOpenAI(
-            deployment_name="gpt-4o",
-            api_version="2023-06-01-preview"
-        )
+        self.llm = AzureChatOpenAI(**get_llm_kwargs("supervisor_chain"))
 
         # The system prompt guides the agent on how to respond
         self.system_prompt = (
@@ -50,16 +55,18 @@ class Supervisor:
             | self.prompt
             | self.llm
             | self.parser
-        )
+        ).with_config(run_name="supervisor_chain")
 
     def get_relevant_agents(self, state: State):
-        print("Supervisor says: getting relevant agents...")
-        agents = self.chain.invoke({"question": state["question"], "agents": self.agents, "history": state["history"]})
+        logger.info("Supervisor says: getting relevant agents...")
+        # Only the role and content of each entry, the agents answers are not needed to route
+        history = compact_history(state["history"], self.history_tokens)
+        agents = self.chain.invoke({"question": state["question"], "agents": self.agents, "history": history})
         if agents == "":
             agents_list = []
         else:
             agents_list = agents.replace(" ", "").split(",")
-        print(f"Supervisor says: {agents_list}")
+        logger.debug("Supervisor says: %s", agents_list)
         return { "relevant_agents": agents_list }
 
     def generate_answer(self, state: State):
@@ -67,6 +74,6 @@ class Supervisor:
             state["agents"] = {}
         for agent in state["relevant_agents"]:
             if agent not in state["agents"]:
-                print(f"Next agent: {agent}")
+                logger.info("Next agent: %s", agent)
                 return { "next": agent }
         return { "next": "FINISH" }
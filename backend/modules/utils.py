@@ -1,3 +1,8 @@
+import json
+import os
+import tempfile
+from .serializer import count_tokens, truncate_tokens
+
 def filter_agent_history(history, agent_name):
     filtered_history = []
 
@@ -13,4 +18,50 @@ def filter_agent_history(history, agent_name):
             # Keep user entries as is.
             filtered_history.append(entry)
 
-    return filtered_history
\ No newline at end of file
+    return filtered_history
+
+def window_history(entries, max_tokens, max_entries=None, max_entry_tokens=None):
+    # Most recent entries that fit in the token budget, long messages are shortened first.
+    # A summary entry is always kept at the start, it stands for everything older.
+    summaries = [entry for entry in entries if entry.get("role") == "summary"]
+    turns = [entry for entry in entries if entry.get("role") != "summary"]
+    if max_entries is not None:
+        turns = turns[-max_entries:] if max_entries > 0 else []
+
+    window = []
+    used = sum(count_tokens(entry["content"]) for entry in summaries)
+    for entry in reversed(turns):
+        entry = dict(entry)
+        if max_entry_tokens is not None:
+            entry["content"] = truncate_tokens(str(entry["content"]), max_entry_tokens)
+        tokens = count_tokens(str(entry["content"]))
+        if used + tokens > max_tokens:
+            break
+        used += tokens
+        window.insert(0, entry)
+    return summaries + window
+
+def compact_history(history, max_tokens):
+    # Only what a prompt needs from each entry (role and content), within the token budget
+    return window_history([{ "role": entry["role"], "content": entry.get("content", "") } for entry in history], max_tokens)
+
+def is_private_dir(path):
+    # Owned by this user and writable by nobody else, so the files in it cannot have been planted
+    info = os.stat(path)
+    if not hasattr(os, "getuid"):
+        # No owners to check (Windows), the directory permissions are left to the system
+        return True
+    return info.st_uid == os.getuid() and not info.st_mode & 0o022
+
+def write_json(path, data):
+    # Through a temporary file with an unpredictable name in the same directory, so concurrent workers never
+    # read a partial file
+    descriptor, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "w") as file:
+            json.dump(data, file)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
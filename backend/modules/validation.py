@@ -0,0 +1,195 @@
+import ast
+import re
+
+# Modules the generated code may import, anything else is sent back for review
+DEFAULT_ALLOWED_IMPORTS = ("pandas", "numpy", "requests", "io", "json", "re", "math", "statistics", "datetime", "collections", "itertools", "functools", "urllib")
+
+SQL_TOKEN = re.compile(r"""
+    (?P<string>N?'(?:[^']|'')*')
+    | (?P<bracket>\[[^\]]*\])
+    | (?P<quoted>"[^"]*"|`[^`]*`)
+    | (?P<number>\d+(?:\.\d+)?)
+    | (?P<variable>@@?\w+)
+    | (?P<word>[A-Za-z_\#][\w\#$]*)
+    | (?P<symbol>[(),.;*])
+    | (?P<other>\S)
+""", re.VERBOSE)
+
+SQL_FORBIDDEN = {"INSERT", "UPDATE", "DELETE", "DROP", "ALTER", "CREATE", "TRUNCATE", "MERGE", "EXEC", "EXECUTE", "GRANT", "REVOKE", "DENY", "INTO"}
+
+# Words that can appear in a read-only T-SQL query without being a table or a column
+SQL_KEYWORDS = {
+    "SELECT", "DISTINCT", "TOP", "PERCENT", "WITH", "TIES", "FROM", "WHERE", "GROUP", "BY", "HAVING", "ORDER", "ASC", "DESC",
+    "AS", "ON", "JOIN", "INNER", "LEFT", "RIGHT", "FULL", "OUTER", "CROSS", "APPLY", "UNION", "ALL", "EXCEPT", "INTERSECT",
+    "AND", "OR", "NOT", "IN", "IS", "NULL", "LIKE", "BETWEEN", "EXISTS", "ANY", "SOME", "CASE", "WHEN", "THEN", "ELSE", "END",
+    "OVER", "PARTITION", "ROWS", "RANGE", "UNBOUNDED", "PRECEDING", "FOLLOWING", "CURRENT", "ROW", "OFFSET", "FETCH", "NEXT",
+    "FIRST", "ONLY", "ESCAPE", "COLLATE", "NOLOCK", "TRUE", "FALSE", "LIMIT",
+    # Arguments of built-in functions that look like identifiers
+    "YEAR", "QUARTER", "MONTH", "DAYOFYEAR", "DAY", "WEEK", "WEEKDAY", "HOUR", "MINUTE", "SECOND", "MILLISECOND",
+    "YY", "YYYY", "QQ", "MM", "DD", "WK", "HH", "MI", "SS",
+    "INT", "BIGINT", "SMALLINT", "TINYINT", "BIT", "DECIMAL", "NUMERIC", "FLOAT", "REAL", "MONEY", "DATE", "DATETIME",
+    "DATETIME2", "TIME", "VARCHAR", "NVARCHAR", "CHAR", "NCHAR", "TEXT", "MAX",
+}
+
+def parse_schema(schema):
+    # The schema comes from INFORMATION_SCHEMA.COLUMNS, either as rows or as their string representation
+    if isinstance(schema, str):
+        try:
+            schema = ast.literal_eval(schema)
+        except (ValueError, SyntaxError):
+            return {}
+    tables = {}
+    for row in schema or []:
+        if isinstance(row, (list, tuple)) and len(row) >= 3:
+            table_schema, table_name, column_name = (str(value).lower() for value in row[:3])
+            tables.setdefault(table_name, set()).add(column_name)
+            tables.setdefault(f"{table_schema}.{table_name}", set()).add(column_name)
+    return tables
+
+def tokenize_sql(query):
+    # Comments are dropped, every other token is kept with its kind
+    query = re.sub(r"--[^\n]*", " ", query)
+    query = re.sub(r"/\*.*?\*/", " ", query, flags=re.DOTALL)
+    return [(match.lastgroup, match.group()) for match in SQL_TOKEN.finditer(query)]
+
+def get_name(kind, value):
+    if kind == "bracket":
+        return value[1:-1].lower()
+    return value.lower()
+
+def canonicalize_sql(query):
+    # Same query, same text: comments, spacing, case and unneeded brackets are dropped
+    # (string literals are kept as they are)
+    tokens = []
+    for kind, value in tokenize_sql(query):
+        if kind in ("word", "bracket"):
+            name = get_name(kind, value)
+            value = name if re.fullmatch(r"[a-z_\#][\w\#$]*", name) else f"[{name}]"
+        tokens.append(value)
+    while tokens and tokens[-1] == ";":
+        tokens.pop()
+    return " ".join(tokens)
+
+def get_tables(query):
+    # Names of the tables a query reads from, without schema
+    tokens = tokenize_sql(query)
+    tables = set()
+    for index, (kind, value) in enumerate(tokens[:-1]):
+        if kind == "word" and value.upper() in ("FROM", "JOIN", "APPLY"):
+            position = index + 1
+            while position + 2 < len(tokens) and tokens[position + 1][1] == "." and tokens[position + 2][0] in ("word", "bracket"):
+                position += 2
+            if tokens[position][0] in ("word", "bracket"):
+                tables.add(get_name(*tokens[position]))
+    return tables
+
+def validate_sql(query, tables):
+    # Lints a generated query against the T-SQL rules and the known schema, returns the issues found
+    tokens = tokenize_sql(query)
+    words = [value.upper() for kind, value in tokens if kind == "word"]
+    issues = []
+
+    if not words or words[0] not in ("SELECT", "WITH"):
+        issues.append("the query must be a single SELECT statement")
+    forbidden = sorted(SQL_FORBIDDEN.intersection(words))
+    if forbidden:
+        issues.append(f"statements that modify the database are not allowed ({', '.join(forbidden)})")
+    if any(value == ";" for _, value in tokens[:-1]):
+        issues.append("only one statement is allowed")
+    if "LIMIT" in words:
+        issues.append("use TOP instead of LIMIT to limit rows")
+    if any(kind == "quoted" for kind, _ in tokens):
+        issues.append("quote identifiers with square brackets instead of double quotes or backticks")
+
+    if not tables or issues:
+        return issues
+
+    # Collect table references and their aliases
+    referenced = {}
+    aliases = set()
+    derived = False
+    index = 0
+    while index < len(tokens):
+        kind, value = tokens[index]
+        if kind == "word" and value.upper() in ("FROM", "JOIN", "APPLY"):
+            index += 1
+            if index < len(tokens) and tokens[index][1] == "(":
+                derived = True
+                continue
+            parts = []
+            while index < len(tokens) and tokens[index][0] in ("word", "bracket"):
+                parts.append(get_name(*tokens[index]))
+                if index + 1 < len(tokens) and tokens[index + 1][1] == ".":
+                    index += 2
+                else:
+                    index += 1
+                    break
+            if not parts:
+                continue
+            name = ".".join(parts[-2:])
+            if name not in tables and parts[-1] not in tables:
+                issues.append(f"unknown table '{'.'.join(parts)}'")
+                continue
+            columns = tables.get(name, tables.get(parts[-1]))
+            referenced[parts[-1]] = columns
+            # Optional alias, with or without AS
+            if index < len(tokens) and tokens[index][0] == "word" and tokens[index][1].upper() == "AS":
+                index += 1
+            if index < len(tokens) and tokens[index][0] in ("word", "bracket") and get_name(*tokens[index]).upper() not in SQL_KEYWORDS:
+                alias = get_name(*tokens[index])
+                referenced[alias] = columns
+                aliases.add(alias)
+                index += 1
+            continue
+        if kind == "word" and value.upper() == "AS" and index + 1 < len(tokens) and tokens[index + 1][0] in ("word", "bracket"):
+            aliases.add(get_name(*tokens[index + 1]))
+        index += 1
+
+    # Common table expressions and derived tables have columns we do not know about
+    if issues or derived or words[0] == "WITH":
+        return issues
+
+    known_columns = set().union(*referenced.values()) if referenced else set()
+    schemas = {name.split(".")[0] for name in tables if "." in name}
+    for index, (kind, value) in enumerate(tokens):
+        if kind not in ("word", "bracket"):
+            continue
+        name = get_name(kind, value)
+        previous = tokens[index - 1][1] if index > 0 else ""
+        following = tokens[index + 1][1] if index + 1 < len(tokens) else ""
+        if kind == "word" and value.upper() in SQL_KEYWORDS or following == "(" or name in aliases or name in schemas or name in tables:
+            continue
+        if following == ".":
+            continue
+        if previous == ".":
+            qualifier = get_name(*tokens[index - 2]) if index > 1 else ""
+            if qualifier in referenced and name not in referenced[qualifier]:
+                issues.append(f"column '{name}' does not exist in '{qualifier}'")
+            continue
+        if name not in known_columns:
+            issues.append(f"unknown column '{name}'")
+    return issues
+
+def validate_code(code, allowed_imports=DEFAULT_ALLOWED_IMPORTS):
+    # Static checks for generated Python code, returns the issues found
+    try:
+        tree = ast.parse(code)
+    except SyntaxError as e:
+        return [f"syntax error: {e.msg} (line {e.lineno})"]
+
+    issues = []
+    assigned = False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id == "result" and isinstance(node.ctx, ast.Store):
+            assigned = True
+        modules = []
+        if isinstance(node, ast.Import):
+            modules = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            modules = [node.module or ""] if node.level == 0 else ["." * node.level]
+        for module in modules:
+            if module.split(".")[0] not in allowed_imports:
+                issues.append(f"import of '{module}' is not allowed")
+    if not assigned:
+        issues.append("the final result must be assigned to a variable called 'result'")
+    return issues
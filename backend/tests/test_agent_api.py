@@ -2,6 +2,7 @@ import pytest
 from unittest.mock import MagicMock, patch
 from modules.models import State
 from modules.agent_api import AgentApi
+from modules.openapi import SpecCache
 import yaml
 import json
 
@@ -73,13 +74,13 @@ def agent_api(config, test_variables):
         return AgentApi(config)
 
 def test_check_connection_success(agent_api):
-    with patch('modules.agent_api.requests') as MockRequests:
-      MockRequests.get.return_value.status_code = 200
+    with patch.object(agent_api, 'session') as MockSession:
+      MockSession.get.return_value.status_code = 200
       assert agent_api.check_connection()["healthy"] is True
 
 def test_check_connection_failure(agent_api):
-     with patch('modules.agent_api.requests') as MockRequests:
-      MockRequests.get.return_value.status_code = 401
+     with patch.object(agent_api, 'session') as MockSession:
+      MockSession.get.return_value.status_code = 401
       assert agent_api.check_connection()["healthy"] is False
 
 def test_get_spec(agent_api, test_variables):
@@ -132,7 +133,7 @@ def test_get_endpoint_details(agent_api, test_variables):
 
 def test_generate_code(agent_api, test_variables):
     # Mock LLM response
-    agent_api.llm.side_effect = [test_variables["mock_raw_code"], test_variables["mock_fixed_code"]]
+    agent_api.llm.side_effect = [test_variables["mock_raw_code"]]
     
     # Call the method under test
     generated_code = agent_api.generate_code(test_variables["mock_question"], test_variables["mock_context"], test_variables["mock_history"])
@@ -141,12 +142,27 @@ def test_generate_code(agent_api, test_variables):
     assert test_variables["mock_question"] in agent_api.llm.call_args_list[0][0][0].messages[1].content
     assert test_variables["mock_context"] in agent_api.llm.call_args_list[0][0][0].messages[0].content
 
-    # Assert that the previously generated code was used when looking for mistakes
-    assert test_variables["mock_raw_code"] in agent_api.llm.call_args_list[1][0][0].messages[1].content
-
     # Assert the agent is aware of the chat history
     assert str(test_variables["mock_history"]) in agent_api.llm.call_args_list[0][0][0].messages[0].content
 
+    # Assert that valid code is not sent for review
+    agent_api.llm.assert_called_once()
+
+    # Assert generated code
+    assert generated_code == test_variables["mock_cleaned_code"]
+
+def test_generate_code_review(agent_api, test_variables):
+    # Mock LLM response (the generated code never assigns the result)
+    invalid_code = "```python\nimport os\nvalue=1\n```"
+    agent_api.llm.side_effect = [invalid_code, test_variables["mock_fixed_code"]]
+
+    generated_code = agent_api.generate_code(test_variables["mock_question"], test_variables["mock_context"], test_variables["mock_history"])
+
+    # Assert that the previously generated code and the issues found were used when looking for mistakes
+    assert invalid_code in agent_api.llm.call_args_list[1][0][0].messages[1].content
+    assert "import of 'os' is not allowed" in agent_api.llm.call_args_list[1][0][0].messages[0].content
+    assert "'result'" in agent_api.llm.call_args_list[1][0][0].messages[0].content
+
     # Assert generated code
     assert generated_code == test_variables["mock_cleaned_code"]
 
@@ -157,6 +173,16 @@ def test_run_code(agent_api, test_variables):
     # Assertions to verify expected behavior
     assert result == test_variables["mock_code_result"]
 
+def test_run_code_uses_session(agent_api):
+    with patch.object(agent_api, 'session') as MockSession:
+        MockSession.get.return_value.json.return_value = {"login": "octocat"}
+
+        # Generated code importing requests goes through the pooled session
+        result = agent_api.run_code("import requests\nresult = requests.get('https://api.example.com/v1/users/octocat').json()['login']")
+
+        assert result == "octocat"
+        MockSession.get.assert_called_once_with('https://api.example.com/v1/users/octocat', params=None)
+
 def test_generate_answer_complete_flow(agent_api, test_variables, config):
     with patch('modules.agent_api.filter_agent_history') as MockFilterAgentHistory:
         MockFilterAgentHistory.return_value = test_variables["mock_history"]
@@ -197,7 +223,8 @@ def test_generate_answer_complete_flow(agent_api, test_variables, config):
         assert answer["agents"]["agent_api"] == test_variables["mock_answer"]
 
 def test_generate_answer_skip_flow(agent_api, test_variables, config):
-    with patch('modules.agent_api.filter_agent_history') as MockFilterAgentHistory:
+    with patch('modules.agent_api.filter_agent_history') as MockFilterAgentHistory, \
+         patch('modules.agent_api.Prefetch') as MockPrefetch:
         MockFilterAgentHistory.return_value = test_variables["mock_history"]
 
         # Mock already tested methods
@@ -221,10 +248,72 @@ def test_generate_answer_skip_flow(agent_api, test_variables, config):
         agent_api.generate_code.assert_not_called()
         agent_api.run_code.assert_not_called()
 
+        # Assert the prefetched context was discarded
+        MockPrefetch.return_value.result.assert_not_called()
+        MockPrefetch.return_value.discard.assert_called_once()
+
         # Assert the final answer
         assert "agent_api" in answer["agents"]
         assert answer["agents"]["agent_api"] == test_variables["mock_answer"]
 
+def test_generate_plan(agent_api, test_variables):
+    # Mock LLM response (a valid plan, then an unknown operation)
+    agent_api.llm.side_effect = ['```json\n{"operation": "/endpoint1", "parameters": {}}\n```', '{"operation": "/endpoint3", "parameters": {}}']
+
+    plan = agent_api.generate_plan(test_variables["mock_question"], test_variables["mock_relevant_endpoints"], test_variables["mock_history"])
+    assert plan == {"operation": "/endpoint1", "parameters": {}}
+
+    # Assert that the user question and the operation signatures were used when planning
+    assert test_variables["mock_question"] in agent_api.llm.call_args_list[0][0][0].messages[1].content
+    assert "Endpoint 1" in agent_api.llm.call_args_list[0][0][0].messages[0].content
+
+    # Invalid plans are rejected
+    assert agent_api.generate_plan(test_variables["mock_question"], test_variables["mock_relevant_endpoints"], test_variables["mock_history"]) is None
+
+def test_run_plan(agent_api):
+    with patch.object(agent_api, 'session') as MockSession:
+        MockSession.get.return_value.status_code = 200
+        MockSession.get.return_value.json.return_value = {"id": 1}
+
+        result = agent_api.run_plan({"operation": "/endpoint1", "parameters": {}})
+
+        assert result == {"id": 1}
+        MockSession.get.assert_called_once_with("https://api.example.com/v1/endpoint1", params={}, headers={})
+
+        # Invalid plans are never executed
+        with pytest.raises(ValueError):
+            agent_api.run_plan({"operation": "/endpoint3"})
+
+def test_generate_answer_planner_flow(agent_api, test_variables):
+    agent_api.mode = "planner"
+    plan = {"operation": "/endpoint1", "parameters": {}}
+
+    # Mock already tested methods
+    agent_api.get_relevant_endpoints = MagicMock(return_value=test_variables["mock_relevant_endpoints"])
+    agent_api.generate_plan = MagicMock(return_value=plan)
+    agent_api.run_plan = MagicMock(return_value={"id": 1})
+    agent_api.generate_code = MagicMock()
+    agent_api.run_code = MagicMock()
+    agent_api.llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
+
+    answer = agent_api.generate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]}))
+
+    # The plan is executed natively, no code is generated
+    agent_api.run_plan.assert_called_once_with(plan)
+    agent_api.generate_code.assert_not_called()
+    assert '"operation": "/endpoint1"' in agent_api.llm.call_args_list[1][0][0].messages[0].content
+    assert answer["agents"]["agent_api"] == test_variables["mock_answer"]
+
+    # When no valid plan is produced it falls back to code generation
+    agent_api.generate_plan.return_value = None
+    agent_api.generate_code.return_value = test_variables["mock_cleaned_code"]
+    agent_api.run_code.return_value = test_variables["mock_code_result"]
+    agent_api.llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
+
+    agent_api.generate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]}))
+
+    agent_api.run_code.assert_called_once_with(test_variables["mock_cleaned_code"])
+
 def test_generate_answer_error(agent_api, test_variables):
     # Mock to raise an error
     agent_api.get_relevant_endpoints = MagicMock(side_effect=Exception("Mocked exception"))
@@ -232,4 +321,45 @@ def test_generate_answer_error(agent_api, test_variables):
     answer = agent_api.generate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]}))
 
     assert "agent_api" in answer["agents"]
-    assert answer["agents"]["agent_api"] == "I don't know"
\ No newline at end of file
+    assert answer["agents"]["agent_api"] == "I don't know"
+
+def test_lazy_spec(config, test_variables):
+    config["lazy_connect"] = True
+    with patch('modules.agent_api.AzureChatOpenAI') as MockLLM, \
+         patch('modules.agent_api.requests') as MockRequests:
+        MockRequests.get.return_value.text = test_variables["mock_spec_json"]
+        agent_api = AgentApi(config)
+
+        # The specification is not downloaded at startup
+        MockRequests.get.assert_not_called()
+        assert agent_api.ready is False
+
+        # It is downloaded once, the first time it is needed
+        agent_api.llm.return_value = "/endpoint1"
+        agent_api.get_relevant_endpoints(test_variables["mock_question"], test_variables["mock_history"])
+        agent_api.get_relevant_endpoints(test_variables["mock_question"], test_variables["mock_history"])
+        MockRequests.get.assert_called_once()
+        assert agent_api.ready is True
+        assert agent_api.base_url == "https://api.example.com/v1"
+
+def test_get_spec_cache(agent_api, test_variables, tmp_path):
+    agent_api.spec_cache = SpecCache(str(tmp_path))
+
+    with patch('modules.agent_api.requests') as MockRequests:
+        # First download stores the indexed specification
+        MockRequests.get.return_value.text = test_variables["mock_spec_json"]
+        MockRequests.get.return_value.headers = {"ETag": "v1"}
+        base_url, endpoints, _ = agent_api.get_spec("json")
+
+        # Then the cached copy is revalidated with its ETag and reused without parsing
+        MockRequests.get.return_value.status_code = 304
+        MockRequests.get.return_value.text = "not a valid specification"
+        cached_base_url, cached_endpoints, _ = agent_api.get_spec("json")
+
+        assert MockRequests.get.call_args[1]["headers"] == {"If-None-Match": "v1"}
+        assert cached_base_url == base_url
+        assert cached_endpoints == endpoints
+
+        # The cached copy is also used when the download fails
+        MockRequests.get.side_effect = Exception("Connection error")
+        assert agent_api.get_spec("json")[1] == endpoints
@@ -1,5 +1,7 @@
+import json
 import pytest
 from unittest.mock import MagicMock, patch
+from azure.core.exceptions import ResourceNotFoundError
 from modules.models import State
 from modules.agent_csv import AgentCsv
 import pandas as pd
@@ -73,25 +75,52 @@ def test_get_index(agent_csv, test_variables):
     assert isinstance(index, pd.DataFrame)
     assert index.equals(pd.DataFrame({"col1": ["val1"], "col2": ["val2"]}))
 
-def test_get_relevant_files(agent_csv, test_variables):
+@pytest.fixture
+def mock_index():
+    return pd.DataFrame({
+        "FILE_NAME": ["marvel.csv", "dc.csv", "movies.csv"],
+        "SUMMARY": ["Marvel comic characters and their first appearances", "DC comic characters and their first appearances", "Box office of superhero movies"]
+    })
+
+def test_get_relevant_files(agent_csv, mock_index):
+    # The files are picked from the local index, without asking the LLM
+    assert agent_csv.get_relevant_files("How many Marvel characters are there?", mock_index, []) == ["marvel.csv"]
+    assert sorted(agent_csv.get_relevant_files("Which comic characters appeared first?", mock_index, [])) == ["dc.csv", "marvel.csv"]
+    agent_csv.llm.assert_not_called()
+
+    # The index is built once for the same index file
+    file_index = agent_csv.file_index
+    agent_csv.get_relevant_files("Which movie made the most?", mock_index, [])
+    assert agent_csv.file_index is file_index
+
+def test_get_relevant_files_fallback(agent_csv, test_variables, mock_index):
     # Mock LLM response
     agent_csv.llm.side_effect = ["file1.csv, file2.csv", ""]
 
-    # Test when the LLM provides a list of files
-    files = agent_csv.get_relevant_files(test_variables["mock_question"], test_variables["mock_index"], test_variables["mock_history"])
+    # Test when the LLM provides a list of files (the question matches no file in the index)
+    files = agent_csv.get_relevant_files(test_variables["mock_question"], mock_index, test_variables["mock_history"])
     assert files == test_variables["mock_relevant_files"]
 
     # Test when the LLM doesn't provide any file
-    files = agent_csv.get_relevant_files(test_variables["mock_question"], test_variables["mock_index"], test_variables["mock_history"])
+    files = agent_csv.get_relevant_files(test_variables["mock_question"], mock_index, test_variables["mock_history"])
     assert files == []
 
     # Assert that the user question and the index were used when choosing relevant files
     assert test_variables["mock_question"] in agent_csv.llm.call_args_list[0][0][0].messages[1].content
-    assert test_variables["mock_index"] in agent_csv.llm.call_args_list[0][0][0].messages[0].content
+    assert "movies.csv" in agent_csv.llm.call_args_list[0][0][0].messages[0].content
 
     # Assert the agent is aware of the chat history
     assert str(test_variables["mock_history"]) in agent_csv.llm.call_args_list[0][0][0].messages[0].content
 
+def test_get_relevant_files_ambiguous(agent_csv, mock_index):
+    # More good candidates than files to pick, only those are sent to the LLM
+    agent_csv.max_files = 1
+    agent_csv.llm.side_effect = ["dc.csv"]
+
+    assert agent_csv.get_relevant_files("Which comic characters appeared first?", mock_index, []) == ["dc.csv"]
+    assert "marvel.csv" in agent_csv.llm.call_args_list[0][0][0].messages[0].content
+    assert "movies.csv" not in agent_csv.llm.call_args_list[0][0][0].messages[0].content
+
 def test_get_files_head(agent_csv, test_variables):
     # Mock Azure Blob Storage responses
     mock_blob_client = MagicMock()
@@ -109,9 +138,68 @@ def test_get_files_head(agent_csv, test_variables):
     assert files_head["file1.csv"][0]["col1"] == "val1"
     assert files_head["file2.csv"][0]["col1"] == "val1"
 
+@pytest.fixture
+def mock_profiles():
+    return {
+        "marvel.csv": {"rows": 3, "columns": [
+            {"name": "Name", "dtype": "object", "null_rate": 0.0, "distinct": 3, "top": [["Spider-Man", 1], ["Hulk", 1], ["Thor", 1]]},
+            {"name": "Alignment", "dtype": "object", "null_rate": 0.0, "distinct": 2, "top": [["Good", 2], ["Bad", 1]]},
+            {"name": "Appearances", "dtype": "int64", "null_rate": 0.0, "distinct": 3, "min": 10, "max": 4043, "mean": 1500.5, "sum": 4501}
+        ]}
+    }
+
+def test_get_catalog(agent_csv, test_variables, mock_profiles):
+    agent_csv.get_index = MagicMock(return_value=pd.DataFrame({"FILE_NAME": ["marvel.csv", "dc.csv"], "SUMMARY": ["Marvel characters", "DC characters"]}))
+    agent_csv.blob_service_client.get_blob_client.return_value.download_blob.return_value.readall.return_value = json.dumps({"version": 1, "files": mock_profiles}).encode()
+
+    index, profiles = agent_csv.get_catalog()
+
+    # The profiles are read from their own file and their columns added to the index
+    assert agent_csv.blob_service_client.get_blob_client.call_args[1]["blob"] == "index.profiles.json"
+    assert profiles == mock_profiles
+    assert index["COLUMNS"].tolist() == ["Name, Alignment, Appearances", ""]
+
+def test_get_catalog_without_profiles(agent_csv):
+    agent_csv.get_index = MagicMock(return_value=pd.DataFrame({"FILE_NAME": ["marvel.csv"], "SUMMARY": ["Marvel characters"]}))
+    agent_csv.blob_service_client.get_blob_client.return_value.download_blob.side_effect = ResourceNotFoundError("not found")
+
+    index, profiles = agent_csv.get_catalog()
+
+    assert profiles == {}
+    assert "COLUMNS" not in index.columns
+
+def test_get_files_context(agent_csv, mock_profiles):
+    agent_csv.get_files_head = MagicMock(return_value={"dc.csv": [{"Name": "Batman"}]})
+
+    context = agent_csv.get_files_context(["marvel.csv", "dc.csv"], mock_profiles)
+
+    # Only the file without a profile is downloaded
+    agent_csv.get_files_head.assert_called_once_with(["dc.csv"])
+    assert context["dc.csv"] == [{"Name": "Batman"}]
+    assert "marvel.csv: 3 rows" in context["marvel.csv"]
+    assert "- Appearances (int64): 3 distinct; min 10, max 4043, mean 1500.5" in context["marvel.csv"]
+
+def test_load_csv_file(agent_csv, test_variables):
+    mock_blob_client = MagicMock()
+    agent_csv.blob_service_client.get_blob_client.return_value = mock_blob_client
+    mock_blob_client.get_blob_properties.return_value.etag = "etag-1"
+    mock_blob_client.download_blob.return_value.content_as_text.return_value = test_variables["mock_context"]
+
+    # The generated code loads the files through the shared cache
+    result = agent_csv.run_code("result = load_csv_file('load-test.csv')['col2'].tolist()")
+    agent_csv.load_csv_file("load-test.csv")
+
+    assert result == ["val2", "val4", "val6", "val8", "val10"]
+    mock_blob_client.download_blob.assert_called_once()
+
+    # A new version of the file is downloaded again
+    mock_blob_client.get_blob_properties.return_value.etag = "etag-2"
+    agent_csv.load_csv_file("load-test.csv")
+    assert mock_blob_client.download_blob.call_count == 2
+
 def test_generate_code(agent_csv, test_variables):
     # Mock LLM response
-    agent_csv.llm.side_effect = [test_variables["mock_raw_code"], test_variables["mock_fixed_code"]]
+    agent_csv.llm.side_effect = [test_variables["mock_raw_code"]]
     
     # Call the method under test
     generated_code = agent_csv.generate_code(test_variables["mock_question"], test_variables["mock_context"], test_variables["mock_history"])
@@ -120,12 +208,27 @@ def test_generate_code(agent_csv, test_variables):
     assert test_variables["mock_question"] in agent_csv.llm.call_args_list[0][0][0].messages[1].content
     assert test_variables["mock_context"] in agent_csv.llm.call_args_list[0][0][0].messages[0].content
 
-    # Assert that the previously generated code was used when looking for mistakes
-    assert test_variables["mock_raw_code"] in agent_csv.llm.call_args_list[1][0][0].messages[1].content
-
     # Assert the agent is aware of the chat history
     assert str(test_variables["mock_history"]) in agent_csv.llm.call_args_list[0][0][0].messages[0].content
 
+    # Assert that valid code is not sent for review
+    agent_csv.llm.assert_called_once()
+
+    # Assert generated code
+    assert generated_code == test_variables["mock_cleaned_code"]
+
+def test_generate_code_review(agent_csv, test_variables):
+    # Mock LLM response (the generated code never assigns the result)
+    invalid_code = "```python\nimport os\nvalue=1\n```"
+    agent_csv.llm.side_effect = [invalid_code, test_variables["mock_fixed_code"]]
+
+    generated_code = agent_csv.generate_code(test_variables["mock_question"], test_variables["mock_context"], test_variables["mock_history"])
+
+    # Assert that the previously generated code and the issues found were used when looking for mistakes
+    assert invalid_code in agent_csv.llm.call_args_list[1][0][0].messages[1].content
+    assert "import of 'os' is not allowed" in agent_csv.llm.call_args_list[1][0][0].messages[0].content
+    assert "'result'" in agent_csv.llm.call_args_list[1][0][0].messages[0].content
+
     # Assert generated code
     assert generated_code == test_variables["mock_cleaned_code"]
 
@@ -136,14 +239,14 @@ def test_run_code(agent_csv, test_variables):
     # Assertions to verify expected behavior
     assert result == test_variables["mock_code_result"]
 
-def test_generate_answer_complete_flow(agent_csv, test_variables, config):
+def test_generate_answer_complete_flow(agent_csv, test_variables, config, mock_index):
     with patch('modules.agent_csv.filter_agent_history') as MockFilterAgentHistory:
         MockFilterAgentHistory.return_value = test_variables["mock_history"]
 
         # Mock already tested methods
-        agent_csv.get_index = MagicMock(return_value=test_variables["mock_index"])
+        agent_csv.get_catalog = MagicMock(return_value=(mock_index, {}))
         agent_csv.get_relevant_files = MagicMock(return_value=test_variables["mock_relevant_files"])
-        agent_csv.get_files_head = MagicMock(return_value=test_variables["mock_context"])
+        agent_csv.get_files_context = MagicMock(return_value=test_variables["mock_context"])
         agent_csv.generate_code = MagicMock(return_value=test_variables["mock_cleaned_code"])
         agent_csv.run_code = MagicMock(return_value=test_variables["mock_code_result"])
         
@@ -176,14 +279,31 @@ def test_generate_answer_complete_flow(agent_csv, test_variables, config):
         assert "agent_csv" in answer["agents"]
         assert answer["agents"]["agent_csv"] == test_variables["mock_answer"]
 
+def test_generate_answer_from_profiles(agent_csv, test_variables, mock_profiles):
+    agent_csv.get_catalog = MagicMock(return_value=(pd.DataFrame({"FILE_NAME": ["marvel.csv"], "SUMMARY": ["Marvel characters"]}), mock_profiles))
+    agent_csv.get_files_context = MagicMock()
+    agent_csv.generate_code = MagicMock()
+    agent_csv.run_code = MagicMock()
+    agent_csv.llm.side_effect = ["CONTINUE", test_variables["mock_answer"]]
+
+    answer = agent_csv.generate_answer(State({"question": "What is the average number of appearances of Marvel characters?", "history": []}))
+
+    # No code is generated nor run, the answer comes from the profile
+    agent_csv.get_files_context.assert_not_called()
+    agent_csv.generate_code.assert_not_called()
+    agent_csv.run_code.assert_not_called()
+    assert "1500.5" in agent_csv.llm.call_args_list[1][0][0].messages[0].content
+    assert answer["agents"]["agent_csv"] == test_variables["mock_answer"]
+
 def test_generate_answer_skip_flow(agent_csv, test_variables, config):
-    with patch('modules.agent_csv.filter_agent_history') as MockFilterAgentHistory:
+    with patch('modules.agent_csv.filter_agent_history') as MockFilterAgentHistory, \
+         patch('modules.agent_csv.Prefetch') as MockPrefetch:
         MockFilterAgentHistory.return_value = test_variables["mock_history"]
 
         # Mock already tested methods
-        agent_csv.get_index = MagicMock(return_value=test_variables["mock_index"])
+        agent_csv.get_catalog = MagicMock(return_value=(test_variables["mock_index"], {}))
         agent_csv.get_relevant_files = MagicMock(return_value=test_variables["mock_relevant_files"])
-        agent_csv.get_files_head = MagicMock(return_value=test_variables["mock_context"])
+        agent_csv.get_files_context = MagicMock(return_value=test_variables["mock_context"])
         agent_csv.generate_code = MagicMock(return_value=test_variables["mock_cleaned_code"])
         agent_csv.run_code = MagicMock(return_value=test_variables["mock_code_result"])
         
@@ -197,12 +317,16 @@ def test_generate_answer_skip_flow(agent_csv, test_variables, config):
         agent_csv.llm.assert_called_once()
 
         # Assert no other methods were called
-        agent_csv.get_index.assert_not_called()
+        agent_csv.get_catalog.assert_not_called()
         agent_csv.get_relevant_files.assert_not_called()
-        agent_csv.get_files_head.assert_not_called()
+        agent_csv.get_files_context.assert_not_called()
         agent_csv.generate_code.assert_not_called()
         agent_csv.run_code.assert_not_called()
 
+        # Assert the prefetched context was discarded
+        MockPrefetch.return_value.result.assert_not_called()
+        MockPrefetch.return_value.discard.assert_called_once()
+
         # Assert the final answer
         assert "agent_csv" in answer["agents"]
         assert answer["agents"]["agent_csv"] == test_variables["mock_answer"]
@@ -214,4 +338,21 @@ def test_generate_answer_error(agent_csv, test_variables):
     answer = agent_csv.generate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]}))
 
     assert "agent_csv" in answer["agents"]
-    assert answer["agents"]["agent_csv"] == "I don't know"
\ No newline at end of file
+    assert answer["agents"]["agent_csv"] == "I don't know"
+
+def test_lazy_connect(config, test_variables):
+    config["lazy_connect"] = True
+    with patch('modules.agent_csv.BlobServiceClient') as MockBlob, \
+         patch('modules.agent_csv.AzureChatOpenAI'):
+        agent_csv = AgentCsv(config)
+
+        # Nothing is created at startup
+        MockBlob.from_connection_string.assert_not_called()
+        assert agent_csv.ready is False
+
+        # The blob client is created on first use
+        mock_blob_client = MockBlob.from_connection_string.return_value.get_blob_client.return_value
+        mock_blob_client.download_blob.return_value.content_as_text.return_value = test_variables["mock_index"]
+        agent_csv.get_index()
+        MockBlob.from_connection_string.assert_called_once_with(config["connection_string"])
+        assert agent_csv.ready is True
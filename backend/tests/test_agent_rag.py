@@ -27,7 +27,7 @@ def test_variables():
 @pytest.fixture
 def agent_rag(config):
     with patch('modules.agent_rag.AzureOpenAIEmbeddings') as MockEmbeddings, \
-         patch('modules.agent_rag.AzureSearch') as MockAzureSearch, \
+         patch('langchain_community.vectorstores.azuresearch.AzureSearch') as MockAzureSearch, \
          patch('modules.agent_rag.AzureChatOpenAI') as MockLLM:
         
         # Mock the embeddings, vector store, and LLM
@@ -40,8 +40,8 @@ def agent_rag(config):
 def test_connect(agent_rag, config):
     # Test initialization with different embeddings configurations
     with patch('modules.agent_rag.AzureOpenAIEmbeddings') as MockOpenAIEmbeddings, \
-         patch('modules.agent_rag.GoogleGenerativeAIEmbeddings') as MockGoogleEmbeddings, \
-         patch('modules.agent_rag.AzureSearch') as MockAzureSearch:
+         patch('langchain_google_genai.GoogleGenerativeAIEmbeddings') as MockGoogleEmbeddings, \
+         patch('langchain_community.vectorstores.azuresearch.AzureSearch') as MockAzureSearch:
         
         # Test with OpenAI embeddings
         agent_rag.connect()
@@ -119,7 +119,8 @@ def test_generate_answer_complete_flow(agent_rag, test_variables, config):
         assert answer["agents"]["agent_rag"] == test_variables["mock_answer"]
 
 def test_generate_answer_skip_flow(agent_rag, test_variables, config):
-    with patch('modules.agent_rag.filter_agent_history') as MockFilterAgentHistory:
+    with patch('modules.agent_rag.filter_agent_history') as MockFilterAgentHistory, \
+         patch('modules.agent_rag.Prefetch') as MockPrefetch:
         MockFilterAgentHistory.return_value = test_variables["mock_history"]
 
         # Mock context retrieval
@@ -137,6 +138,10 @@ def test_generate_answer_skip_flow(agent_rag, test_variables, config):
         # Assert no other methods were called
         agent_rag.retrieve_context.assert_not_called()
 
+        # Assert the prefetched context was discarded
+        MockPrefetch.return_value.result.assert_not_called()
+        MockPrefetch.return_value.discard.assert_called_once()
+
         # Assert the final answer
         assert "agent_rag" in answer["agents"]
         assert answer["agents"]["agent_rag"] == test_variables["mock_answer"]
@@ -149,3 +154,22 @@ def test_generate_answer_error(agent_rag, test_variables):
 
     assert "agent_rag" in answer["agents"]
     assert answer["agents"]["agent_rag"] == "I don't know"
+
+
+def test_lazy_connect(config):
+    config["lazy_connect"] = True
+    with patch('modules.agent_rag.AzureOpenAIEmbeddings'), \
+         patch('langchain_community.vectorstores.azuresearch.AzureSearch') as MockAzureSearch, \
+         patch('modules.agent_rag.AzureChatOpenAI'):
+        agent_rag = AgentRag(config)
+
+        # Nothing is created at startup
+        MockAzureSearch.assert_not_called()
+        assert agent_rag.ready is False
+
+        # The vector store is created on first use and reused afterwards
+        MockAzureSearch.return_value.similarity_search.return_value = []
+        agent_rag.retrieve_context("question")
+        agent_rag.retrieve_context("question")
+        MockAzureSearch.assert_called_once()
+        assert agent_rag.ready is True
@@ -2,6 +2,11 @@ import pytest
 from unittest.mock import MagicMock, patch
 from modules.models import State
 from modules.agent_sql import AgentSql
+from modules.plan_cache import PlanCache
+from modules.sql_executor import get_engine_args
+from modules.serializer import serialize_result
+from langchain_community.utilities import SQLDatabase
+from sqlalchemy import create_engine
 
 @pytest.fixture
 def config():
@@ -22,14 +27,15 @@ def test_variables():
         "mock_raw_query": "```sql\nSELECT name\nFROM users LIMIT 5;\n```",
         "mock_fixed_query": "```sql\nSELECT TOP(5) name\nFROM users;\n```",
         "mock_cleaned_query": "SELECT TOP(5) name FROM users;",
-        "mock_query_result": [("Alice"), ("Bob")],
+        "mock_query_result": {"columns": ["name"], "rows": [("Alice",), ("Bob",)], "truncated": None},
         "mock_answer": "The users are Alice and Bob",
         "mock_history": [{"role": "user", "content": "hi!"}, {"role": "bot", "content": "hi! how can I help you?"}]
     }
 
 @pytest.fixture
 def agent_sql(config):
-    with patch('modules.agent_sql.SQLDatabase') as MockSQL, \
+    with patch('langchain_community.utilities.sql_database.SQLDatabase') as MockSQL, \
+         patch('sqlalchemy.create_engine'), \
          patch('modules.agent_sql.AzureChatOpenAI') as MockLLM:
         
         # Mock the SQL connection and LLM
@@ -39,9 +45,12 @@ def agent_sql(config):
         return AgentSql(config)
 
 def test_connect(agent_sql, config):
-    with patch('modules.agent_sql.SQLDatabase') as MockSQL:
+    with patch('langchain_community.utilities.sql_database.SQLDatabase') as MockSQL, \
+         patch('sqlalchemy.create_engine') as MockCreateEngine:
         agent_sql.connect()
-        MockSQL.from_uri.assert_called_once_with(config["connection_string"])
+        MockCreateEngine.assert_called_once_with(config["connection_string"], **get_engine_args(config))
+        MockSQL.assert_called_once_with(MockCreateEngine.return_value)
+        assert agent_sql.engine is MockCreateEngine.return_value
 
 def test_check_connection_success(agent_sql):
     agent_sql.db.run = MagicMock(return_value=None)
@@ -66,6 +75,10 @@ def test_get_schema(agent_sql, test_variables):
         "SELECT TABLE_SCHEMA, TABLE_NAME, COLUMN_NAME, DATA_TYPE FROM INFORMATION_SCHEMA.COLUMNS"
     )
 
+    # The schema is cached
+    assert agent_sql.get_schema() == test_variables["mock_schema"]
+    agent_sql.db.run.assert_called_once()
+
 def test_generate_query(agent_sql, test_variables):
     # Mock LLM response
     agent_sql.llm.side_effect = [test_variables["mock_raw_query"], test_variables["mock_fixed_query"]]
@@ -77,8 +90,9 @@ def test_generate_query(agent_sql, test_variables):
     assert test_variables["mock_question"] in agent_sql.llm.call_args_list[0][0][0].messages[1].content
     assert str(test_variables["mock_schema"]) in agent_sql.llm.call_args_list[0][0][0].messages[0].content
 
-    # Assert that the previously generated query was used when looking for mistakes
+    # Assert that the previously generated query and the issues found were used when looking for mistakes
     assert test_variables["mock_raw_query"] in agent_sql.llm.call_args_list[1][0][0].messages[1].content
+    assert "use TOP instead of LIMIT" in agent_sql.llm.call_args_list[1][0][0].messages[0].content
 
     # Assert the agent is aware of the chat history
     assert str(test_variables["mock_history"]) in agent_sql.llm.call_args_list[0][0][0].messages[0].content
@@ -86,16 +100,110 @@ def test_generate_query(agent_sql, test_variables):
     # Assert generated query
     assert generated_query == test_variables["mock_cleaned_query"]
 
-def test_run_query(agent_sql, test_variables):   
-    # Mock the query execution
-    agent_sql.db.run = MagicMock(return_value=test_variables["mock_query_result"])
-    
+def test_generate_query_valid(agent_sql, test_variables):
+    # Mock LLM response (the query is already valid)
+    agent_sql.llm.side_effect = [test_variables["mock_fixed_query"]]
+
+    generated_query = agent_sql.generate_query(test_variables["mock_question"], test_variables["mock_schema"], test_variables["mock_history"])
+
+    # Assert that the reviewer was not needed
+    agent_sql.llm.assert_called_once()
+    assert generated_query == test_variables["mock_cleaned_query"]
+
+def test_generate_query_unknown_column(agent_sql, test_variables):
+    # Mock LLM response (the query uses a column that is not in the schema)
+    agent_sql.llm.side_effect = ["SELECT TOP(5) email FROM users;", test_variables["mock_fixed_query"]]
+
+    generated_query = agent_sql.generate_query(test_variables["mock_question"], test_variables["mock_schema"], test_variables["mock_history"])
+
+    assert "unknown column 'email'" in agent_sql.llm.call_args_list[1][0][0].messages[0].content
+    assert generated_query == test_variables["mock_cleaned_query"]
+
+def test_generate_query_plan_cache(agent_sql, test_variables, tmp_path):
+    agent_sql.plan_cache = PlanCache(str(tmp_path / "plans.json"))
+    agent_sql.plan_cache.add("What are the names of the first 5 users?", test_variables["mock_cleaned_query"])
+    agent_sql.llm.side_effect = [test_variables["mock_fixed_query"]]
+
+    # A question with the same shape reuses the stored query without calling the LLM
+    generated_query = agent_sql.generate_query("What are the names of the first 3 users?", test_variables["mock_schema"], [])
+    assert generated_query == "SELECT TOP(3) name FROM users;"
+    agent_sql.llm.assert_not_called()
+
+    # Similar questions get the stored pairs as examples
+    agent_sql.generate_query("What are the names of the users?", test_variables["mock_schema"], test_variables["mock_history"])
+    assert test_variables["mock_cleaned_query"] in agent_sql.llm.call_args_list[0][0][0].messages[0].content
+
+def test_run_query(agent_sql, test_variables, tmp_path):
+    # Run against a real (SQLite) database
+    agent_sql.engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", **get_engine_args({}))
+    agent_sql.db = SQLDatabase(agent_sql.engine)
+    agent_sql.db.run("CREATE TABLE users (id INTEGER, name TEXT)")
+    agent_sql.db.run("INSERT INTO users VALUES (1, 'Alice'), (2, 'Bob')")
+
     # Call the method under test
-    result = agent_sql.run_query(test_variables["mock_cleaned_query"])
+    result = agent_sql.run_query("SELECT name FROM users ORDER BY id")
 
     # Assertions to verify expected behavior
     assert result == test_variables["mock_query_result"]
-    agent_sql.db.run.assert_called_once_with(test_variables["mock_cleaned_query"])
+
+    # The answer generator is told when the result was cut
+    agent_sql.config["max_rows"] = 1
+    result = agent_sql.run_query("SELECT name FROM users ORDER BY id")
+    assert result["rows"] == [("Alice",)]
+    assert "only the first 1 rows were read" in serialize_result(result, 100)
+
+def test_run_query_cache(agent_sql, test_variables):
+    agent_sql.result_cache.ttl = 60
+
+    with patch('modules.agent_sql.execute_query') as MockExecuteQuery:
+        MockExecuteQuery.return_value = test_variables["mock_query_result"]
+
+        # The same query, written differently, is only executed once
+        assert agent_sql.run_query("SELECT TOP(5) name FROM users;") == test_variables["mock_query_result"]
+        assert agent_sql.run_query("select top(5) [name]\nfrom users") == test_variables["mock_query_result"]
+        MockExecuteQuery.assert_called_once()
+
+        # Invalidating the table forces a new execution
+        agent_sql.invalidate_results(["dbo.users"])
+        agent_sql.run_query("SELECT TOP(5) name FROM users;")
+        assert MockExecuteQuery.call_count == 2
+
+def test_check_cost(agent_sql, test_variables):
+    with patch('modules.agent_sql.guard_query') as MockGuardQuery:
+        # An expensive query is sent back for review once
+        MockGuardQuery.side_effect = [
+            {"decision": "rejected", "query": "SELECT * FROM users, users", "estimate": {"cost": 1000, "rows": 10}},
+            {"decision": "rewritten", "query": "SELECT TOP (200) name FROM users", "estimate": {"cost": 1, "rows": 500}}
+        ]
+        agent_sql.llm.side_effect = ["SELECT name FROM users"]
+
+        assert agent_sql.check_cost("SELECT * FROM users, users") == "SELECT TOP (200) name FROM users"
+        assert "too expensive" in agent_sql.llm.call_args_list[0][0][0].messages[0].content
+
+        # It is rejected when it is still too expensive
+        MockGuardQuery.side_effect = [{"decision": "rejected", "query": "q", "estimate": {"cost": 1000, "rows": 10}}] * 2
+        agent_sql.llm.side_effect = ["q"]
+        with pytest.raises(ValueError):
+            agent_sql.check_cost("q")
+
+def test_check_cost_cache(agent_sql):
+    agent_sql.result_cache.ttl = agent_sql.guard_cache.ttl = 60
+
+    with patch('modules.agent_sql.guard_query') as MockGuardQuery, \
+         patch('modules.agent_sql.execute_query') as MockExecuteQuery:
+        MockGuardQuery.return_value = {"decision": "rewritten", "query": "SELECT TOP (200) name FROM users", "estimate": {"cost": 1, "rows": 500}}
+        MockExecuteQuery.return_value = {"columns": ["name"], "rows": [("Alice",)], "truncated": None}
+
+        # A repeated query neither gets a new estimate nor runs again
+        for _ in range(2):
+            agent_sql.run_query(agent_sql.check_cost("SELECT name FROM users"))
+        MockGuardQuery.assert_called_once()
+        MockExecuteQuery.assert_called_once()
+
+        # Until its tables change
+        agent_sql.invalidate_results(["dbo.users"])
+        agent_sql.check_cost("select name from users")
+        assert MockGuardQuery.call_count == 2
 
 def test_generate_answer_complete_flow(agent_sql, test_variables, config):
     with patch('modules.agent_sql.filter_agent_history') as MockFilterAgentHistory:
@@ -118,8 +226,8 @@ def test_generate_answer_complete_flow(agent_sql, test_variables, config):
         assert test_variables["mock_question"] in agent_sql.llm.call_args_list[1][0][0].messages[1].content
         assert test_variables["mock_cleaned_query"] not in agent_sql.llm.call_args_list[0][0][0].messages[0].content
         assert test_variables["mock_cleaned_query"] in agent_sql.llm.call_args_list[1][0][0].messages[0].content
-        assert str(test_variables["mock_query_result"]) not in agent_sql.llm.call_args_list[0][0][0].messages[0].content
-        assert str(test_variables["mock_query_result"]) in agent_sql.llm.call_args_list[1][0][0].messages[0].content
+        assert str(test_variables["mock_query_result"]["rows"]) not in agent_sql.llm.call_args_list[0][0][0].messages[0].content
+        assert str(test_variables["mock_query_result"]["rows"]) in agent_sql.llm.call_args_list[1][0][0].messages[0].content
 
         # Assert the agent is aware of its own skills
         assert config["agent_directive"] in agent_sql.llm.call_args_list[0][0][0].messages[0].content
@@ -137,7 +245,8 @@ def test_generate_answer_complete_flow(agent_sql, test_variables, config):
         assert answer["agents"]["agent_sql"] == test_variables["mock_answer"]
 
 def test_generate_answer_skip_flow(agent_sql, test_variables, config):
-    with patch('modules.agent_sql.filter_agent_history') as MockFilterAgentHistory:
+    with patch('modules.agent_sql.filter_agent_history') as MockFilterAgentHistory, \
+         patch('modules.agent_sql.Prefetch') as MockPrefetch:
         MockFilterAgentHistory.return_value = test_variables["mock_history"]
         
         # Mock already tested methods
@@ -161,6 +270,10 @@ def test_generate_answer_skip_flow(agent_sql, test_variables, config):
         agent_sql.generate_query.assert_not_called()
         agent_sql.run_query.assert_not_called()
 
+        # Assert the prefetched context was discarded
+        MockPrefetch.return_value.result.assert_not_called()
+        MockPrefetch.return_value.discard.assert_called_once()
+
         # Assert the final answer
         assert "agent_sql" in answer["agents"]
         assert answer["agents"]["agent_sql"] == test_variables["mock_answer"]
@@ -172,4 +285,20 @@ def test_generate_answer_error(agent_sql, test_variables):
     answer = agent_sql.generate_answer(State({"question": test_variables["mock_question"], "history": test_variables["mock_history"]}))
 
     assert "agent_sql" in answer["agents"]
-    assert answer["agents"]["agent_sql"] == "I don't know"
\ No newline at end of file
+    assert answer["agents"]["agent_sql"] == "I don't know"
+
+def test_lazy_connect(config):
+    config["lazy_connect"] = True
+    with patch('langchain_community.utilities.sql_database.SQLDatabase') as MockSQL, \
+         patch('sqlalchemy.create_engine') as MockCreateEngine, \
+         patch('modules.agent_sql.AzureChatOpenAI'):
+        agent_sql = AgentSql(config)
+
+        # Nothing is created at startup
+        MockSQL.assert_not_called()
+        assert agent_sql.ready is False
+
+        # The first connection check opens the connection
+        assert agent_sql.check_connection()["healthy"] is True
+        MockCreateEngine.assert_called_once_with(config["connection_string"], **get_engine_args(config))
+        assert agent_sql.ready is True
@@ -0,0 +1,122 @@
+import time
+import pytest
+from unittest.mock import patch
+from modules.cache import TTLCache
+from modules.state import RedisBackend, InProcessBackend
+from tests.test_state import FakeRedis
+
+@pytest.fixture
+def clock():
+    with patch('modules.cache.time') as MockTime:
+        MockTime.monotonic.return_value = 1000
+        yield MockTime
+
+def test_get_and_set(clock):
+    cache = TTLCache(maxsize=10, ttl=60)
+    assert cache.get("key") is None
+    assert cache.get("key", "default") == "default"
+
+    cache.set("key", "value")
+    assert cache.get("key") == "value"
+    assert "key" in cache
+
+def test_entries_expire(clock):
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set("key", "value")
+    cache.set("short", "value", ttl=5)
+
+    clock.monotonic.return_value = 1010
+    assert cache.get("short") is None
+    assert cache.get("key") == "value"
+
+    clock.monotonic.return_value = 1061
+    assert cache.get("key") is None
+    assert len(cache) == 0
+
+def test_least_recently_used_is_evicted(clock):
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    # Reading "a" makes "b" the least recently used entry
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("a") == 1
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+
+def test_delete_and_clear(clock):
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+
+    cache.delete("a")
+    assert cache.get("a") is None
+
+    cache.clear()
+    assert len(cache) == 0
+
+def test_hits_and_misses_are_recorded():
+    with patch('modules.cache.metrics') as MockMetrics:
+        cache = TTLCache(maxsize=10, ttl=60, name="test_cache")
+        cache.get("key")
+        cache.set("key", "value")
+        cache.get("key")
+        MockMetrics.record_cache.assert_any_call("test_cache", False)
+        MockMetrics.record_cache.assert_any_call("test_cache", True)
+
+def test_invalidate_by_tag(clock):
+    cache = TTLCache(maxsize=10, ttl=60)
+    cache.set("a", 1, tags=["users"])
+    cache.set("b", 2, tags=["users", "orders"])
+    cache.set("c", 3, tags=["orders"])
+
+    assert cache.invalidate("users") == 2
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+    assert cache.get("c") == 3
+    assert cache.invalidate("users") == 0
+
+def test_shared_cache():
+    # Two workers with their own cache instance share the entries
+    server = FakeRedis()
+    first = TTLCache(ttl=60, name="shared", backend=RedisBackend(server))
+    second = TTLCache(ttl=60, name="shared", backend=RedisBackend(server))
+
+    first.set("select 1", {"rows": [(1,)]}, tags=["orders"])
+    first.set("select 2", {"rows": [(2,)]})
+    assert second.get("select 1") == {"rows": [(1,)]}
+    assert "select 2" in second
+    assert len(second) == 2
+
+    # Invalidation and clearing reach every worker
+    assert second.invalidate("orders") == 1
+    assert first.get("select 1") is None
+    assert len(first) == 1
+    second.clear()
+    assert first.get("select 2") is None
+
+    # A time to live of 0 disables the cache
+    first.set("select 3", "value", ttl=0)
+    assert second.get("select 3") is None
+
+def test_shared_cache_tags_expire():
+    server = FakeRedis()
+    cache = TTLCache(ttl=0.05, name="shared", backend=RedisBackend(server))
+    for index in range(3):
+        cache.set(f"select {index}", index, tags=["orders"])
+    time.sleep(0.06)
+    cache.set("select 3", 3, tags=["orders"])
+
+    # Only the live keys are listed, the tags do not keep every key ever cached
+    assert len(cache) == 1
+    assert len(server.data["cache-tag:shared:__all__"]) == 1
+    assert len(server.data["cache-tag:shared:orders"]) == 1
+
+def test_in_process_backend_keeps_local_cache():
+    cache = TTLCache(maxsize=1, ttl=60, backend=InProcessBackend())
+    assert cache.backend is None
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") is None
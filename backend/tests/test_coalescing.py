@@ -0,0 +1,131 @@
+import threading
+import time
+import pytest
+from modules.state import RedisBackend
+from tests.test_state import FakeRedis
+from modules.coalescing import SingleFlight, get_request_key, normalize_question
+
+def test_get_request_key():
+    history = [{"role": "user", "content": "hi!"}]
+    assert normalize_question("  What is the Capital of  France? ") == "what is the capital of france"
+    assert get_request_key("What is the capital of France?", history) == get_request_key("what is the capital of france", history)
+    assert get_request_key("What is the capital of France?", history) != get_request_key("What is the capital of France?", [])
+    assert get_request_key("What is the capital of France?", history) != get_request_key("What is the capital of Spain?", history)
+
+def test_single_flight_shares_result():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait(2)
+        return "result"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(single_flight.run("key", fn))) for _ in range(5)]
+    threads[0].start()
+    started.wait(2)
+
+    # The other callers join the call in flight
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(2)
+
+    assert results == ["result"] * 5
+    assert len(calls) == 1
+    assert single_flight.in_flight() == 0
+
+def test_single_flight_runs_again_after_completion():
+    single_flight = SingleFlight()
+    assert single_flight.run("key", lambda: 1) == 1
+    assert single_flight.run("key", lambda: 2) == 2
+
+def test_single_flight_shares_errors():
+    single_flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    def fail():
+        started.set()
+        release.wait(2)
+        raise ValueError("Mocked exception")
+
+    errors = []
+    def call():
+        try:
+            single_flight.run("key", fail)
+        except ValueError as e:
+            errors.append(e)
+
+    first = threading.Thread(target=call)
+    first.start()
+    started.wait(2)
+    second = threading.Thread(target=call)
+    second.start()
+    release.set()
+    first.join(2)
+    second.join(2)
+
+    assert len(errors) == 2
+    assert single_flight.in_flight() == 0
+    with pytest.raises(ValueError):
+        single_flight.run("key", fail)
+
+def test_single_flight_between_workers():
+    # Two workers (their own SingleFlight, the same Redis server) get the same question at the same time
+    server = FakeRedis()
+    first = SingleFlight("ask", RedisBackend(server), poll_interval=0.01)
+    second = SingleFlight("ask", RedisBackend(server), poll_interval=0.01)
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait(2)
+        return {"answer": "Paris"}
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(first.run("key", fn)))
+    leader.start()
+    started.wait(2)
+    follower = threading.Thread(target=lambda: results.append(second.run("key", fn)))
+    follower.start()
+    time.sleep(0.05)
+    release.set()
+    leader.join(2)
+    follower.join(2)
+
+    assert results == [{"answer": "Paris"}] * 2
+    assert len(calls) == 1
+
+    # Once finished, the next call runs again
+    assert second.run("key", lambda: {"answer": "Rome"}) == {"answer": "Rome"}
+
+def test_single_flight_between_workers_leader_fails():
+    server = FakeRedis()
+    first = SingleFlight("ask", RedisBackend(server), poll_interval=0.01)
+    second = SingleFlight("ask", RedisBackend(server), poll_interval=0.01)
+    started = threading.Event()
+    release = threading.Event()
+    def fail():
+        started.set()
+        release.wait(2)
+        raise ValueError("Mocked exception")
+
+    leader = threading.Thread(target=lambda: pytest.raises(ValueError, first.run, "key", fail))
+    leader.start()
+    started.wait(2)
+    results = []
+    follower = threading.Thread(target=lambda: results.append(second.run("key", lambda: "retried")))
+    follower.start()
+    release.set()
+    leader.join(2)
+    follower.join(2)
+
+    # The waiting worker runs the call itself
+    assert results == ["retried"]
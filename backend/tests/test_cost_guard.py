@@ -0,0 +1,61 @@
+import pytest
+from unittest.mock import MagicMock
+from sqlalchemy import create_engine
+from modules.cost_guard import estimate_cost, estimate_mssql, force_limit, guard_query
+from modules.sql_executor import execute_query
+
+@pytest.fixture
+def engine(tmp_path):
+    # SQLite stands in for SQL Server, with estimates derived from EXPLAIN QUERY PLAN
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+    with engine.begin() as connection:
+        connection.exec_driver_sql("CREATE TABLE products (id INTEGER PRIMARY KEY, name TEXT)")
+        connection.exec_driver_sql("CREATE TABLE sales (product_id INTEGER, amount REAL)")
+        connection.exec_driver_sql("INSERT INTO products VALUES " + ", ".join(f"({i}, 'product {i}')" for i in range(100)))
+        connection.exec_driver_sql("INSERT INTO sales VALUES " + ", ".join(f"({i % 100}, {i})" for i in range(1000)))
+    return engine
+
+def test_estimate_cost(engine):
+    assert estimate_cost(engine, "SELECT name FROM products")["rows"] == 100
+
+    # Searching by primary key is cheaper than a scan, a cross join multiplies the rows
+    assert estimate_cost(engine, "SELECT name FROM products WHERE id = 5")["cost"] < 100
+    assert estimate_cost(engine, "SELECT * FROM products, sales")["cost"] == 100000
+
+def test_guard_query(engine):
+    allowed = guard_query(engine, "SELECT name FROM products WHERE id = 5", max_cost=5000, max_rows=200)
+    assert allowed["decision"] == "allowed"
+
+    # Too many rows: a row limit is added
+    rewritten = guard_query(engine, "SELECT amount FROM sales;", max_cost=5000, max_rows=200)
+    assert rewritten["decision"] == "rewritten"
+    assert rewritten["query"] == "SELECT amount FROM sales LIMIT 201"
+
+    # The limited result is still reported as cut
+    result = execute_query(engine, rewritten["query"], max_rows=200)
+    assert len(result["rows"]) == 200
+    assert result["truncated"] == "rows"
+
+    # Too expensive: rejected
+    rejected = guard_query(engine, "SELECT * FROM products, sales", max_cost=5000, max_rows=200)
+    assert rejected["decision"] == "rejected"
+
+    # Queries that cannot be estimated are left to the execution
+    assert guard_query(engine, "SELECT * FROM missing", max_cost=5000, max_rows=200)["decision"] == "allowed"
+
+def test_force_limit():
+    assert force_limit("SELECT name FROM products;", "mssql", 200) == "SELECT TOP (200) name FROM products"
+    assert force_limit("select distinct name from products", "mssql", 200) == "select distinct TOP (200) name from products"
+    assert force_limit("SELECT TOP 5 name FROM products", "mssql", 200) == "SELECT TOP 5 name FROM products"
+    assert force_limit("SELECT name FROM products LIMIT 5", "sqlite", 200) == "SELECT name FROM products LIMIT 5"
+
+def test_estimate_mssql():
+    cursor = MagicMock()
+    cursor.fetchone.return_value = ["""<ShowPlanXML xmlns="http://schemas.microsoft.com/sqlserver/2004/07/showplan"><BatchSequence><Batch><Statements>
+        <StmtSimple StatementSubTreeCost="12.5" StatementEstRows="3400" />
+    </Statements></Batch></BatchSequence></ShowPlanXML>"""]
+
+    assert estimate_mssql(cursor, "SELECT name FROM products") == {"cost": 12.5, "rows": 3400}
+
+    # The plan is only estimated, and SHOWPLAN is switched off again
+    assert [call[0][0] for call in cursor.execute.call_args_list] == ["SET SHOWPLAN_XML ON", "SELECT name FROM products", "SET SHOWPLAN_XML OFF"]
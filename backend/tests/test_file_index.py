@@ -0,0 +1,39 @@
+import pandas as pd
+from unittest.mock import MagicMock
+from modules.file_index import FileIndex, tokenize
+
+def make_index(embeddings=None):
+    return FileIndex.from_frame(pd.DataFrame({
+        "FILE_NAME": ["marvel.csv", "dc.csv", "movies.csv"],
+        "SUMMARY": ["Marvel comic characters", "DC comic characters", "Box office of superhero movies"],
+        "COLUMNS": ["name, ALIGN, EYE, HAIR, SEX, APPEARANCES, Year", "name, ALIGN, EYE, HAIR, SEX, APPEARANCES, YEAR", "title, studio, grossUSD, releaseYear"]
+    }), embeddings)
+
+def test_tokenize():
+    assert tokenize("How many FIRST_APPEARANCE values in releaseYear?") == ["first", "appearance", "value", "release", "year"]
+    assert tokenize("Which class has the most Heroes") == ["class", "most", "heroe"]
+
+def test_search():
+    index = make_index()
+
+    # Scores come with the files, best first, and files without any match are left out
+    results = index.search("How many Marvel characters have blue eyes?")
+    assert [file for file, _ in results] == ["marvel.csv", "dc.csv"]
+    assert results[0][1] > results[1][1] > 0
+
+    # Column names are searched too
+    assert index.search("Which studio grossed the most?")[0][0] == "movies.csv"
+    assert index.search("hello there") == []
+    assert len(index.search("comic characters", top_k=1)) == 1
+
+def test_search_with_embeddings():
+    embeddings = MagicMock()
+    embeddings.embed_documents.return_value = [[1, 0], [0, 1], [0.5, 0.5]]
+    embeddings.embed_query.return_value = [0, 1]
+
+    index = make_index(embeddings)
+
+    # Without any keyword in common the similarity alone finds the file, unrelated files do not count
+    results = index.search("the caped crusader")
+    assert results == [("dc.csv", 0.5)]
+    embeddings.embed_documents.assert_called_once()
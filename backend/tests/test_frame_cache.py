@@ -0,0 +1,108 @@
+import pandas as pd
+import pytest
+from unittest.mock import MagicMock
+from modules.frame_cache import FrameCache, compact_frame, get_size
+
+def make_frame(rows=100):
+    return pd.DataFrame({
+        "name": [f"character {i}" for i in range(rows)],
+        "alignment": ["Good Characters", "Bad Characters"] * (rows // 2),
+        "year": [1939.0 + i for i in range(rows)],
+        "appearances": list(range(rows)),
+        "ratio": [i / 3 for i in range(rows)]
+    })
+
+def test_compact_frame():
+    frame = make_frame()
+
+    # Numbers keep their 64-bit types by default, so the arithmetic of the generated code does not change
+    compacted = compact_frame(frame)
+    assert compacted["appearances"].dtype == "int64"
+    assert compacted["year"].dtype == "float64"
+    large = pd.DataFrame({"ID": [2147416646, 1], "year": [1975.9975207816829, 1.0]})
+    assert (compact_frame(large)["ID"] * 2).max() == 4294833292
+    assert compact_frame(large)["year"].mean() == large["year"].mean()
+
+def test_compact_frame_downcast():
+    frame = make_frame()
+    size = get_size(frame)
+
+    compacted = compact_frame(frame, downcast=True)
+
+    # When asked for, numbers get smaller types without changing, strings are kept as they are
+    assert compacted["alignment"].dtype == object
+    assert compacted["name"].dtype == object
+    assert compacted["appearances"].dtype == "int32"
+    assert compacted["year"].dtype == "float32"
+    assert compacted["ratio"].dtype == "float64"
+    assert get_size(compacted) < size
+    assert compacted["appearances"].sum() == frame["appearances"].sum()
+
+    # The parsed frame is not modified
+    assert frame["appearances"].dtype == "int64"
+
+def summarize_good_characters(frame):
+    # Typical generated code on a filtered frame
+    filtered = frame[frame["alignment"] == "Good Characters"]
+    return filtered["hair"].value_counts(), filtered.groupby("hair")["appearances"].sum(), filtered.groupby(["alignment", "hair"]).size()
+
+def test_compact_frame_gives_the_same_results():
+    frame = make_frame()
+    frame["hair"] = ["Black", "Blond", "Red", "Bald"] * 25
+    compacted = compact_frame(frame, downcast=True)
+
+    # Only the values seen in the filtered rows, with the same counts and sums
+    for raw, compact in zip(summarize_good_characters(frame), summarize_good_characters(compacted)):
+        pd.testing.assert_series_equal(raw, compact, check_dtype=False)
+        assert len(compact) == 2
+    assert compacted[compacted["alignment"] == "Good Characters"]["hair"].unique().tolist() == ["Black", "Red"]
+
+def test_frame_cache_hits_and_versions():
+    cache = FrameCache()
+    load = MagicMock(side_effect=lambda: make_frame())
+
+    first = cache.get(("container", "marvel.csv"), "v1", load)
+    second = cache.get(("container", "marvel.csv"), "v1", load)
+
+    # The file is parsed once per version
+    assert load.call_count == 1
+    assert first.equals(second)
+    cache.get(("container", "marvel.csv"), "v2", load)
+    assert load.call_count == 2
+    assert len(cache) == 1
+
+@pytest.mark.parametrize("copy_on_write", [True, False])
+def test_frame_cache_views_are_read_only(copy_on_write):
+    cache = FrameCache(copy_on_write=copy_on_write)
+    with pd.option_context("mode.copy_on_write", False):
+        view = cache.get("marvel.csv", "v1", make_frame)
+        assert pd.get_option("mode.copy_on_write") is copy_on_write
+
+        # Changes made by the generated code stay in its own view
+        view.loc[0, "appearances"] = 1000
+        view["appearances"] *= 2
+        view.drop(columns=["name"], inplace=True)
+
+    cached = cache.get("marvel.csv", "v1", make_frame)
+    assert cached.loc[0, "appearances"] == 0
+    assert cached["appearances"].sum() == sum(range(100))
+    assert "name" in cached.columns
+
+def test_frame_cache_memory_budget():
+    size = get_size(make_frame())
+    cache = FrameCache(max_bytes=size * 2)
+
+    cache.get("a.csv", "v1", make_frame)
+    cache.get("b.csv", "v1", make_frame)
+    cache.get("a.csv", "v1", make_frame)
+    cache.get("c.csv", "v1", make_frame)
+
+    # The least recently used frame is evicted
+    assert set(cache.entries) == {"a.csv", "c.csv"}
+    assert cache.bytes == size * 2
+
+    # A frame over the whole budget is not kept
+    cache.resize(size - 1)
+    assert len(cache) == 0
+    assert cache.get("a.csv", "v1", make_frame)["appearances"].sum() == sum(range(100))
+    assert len(cache) == 0
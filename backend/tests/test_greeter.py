@@ -16,19 +16,58 @@ def greeter():
         agent_2.skills = "Agent 2 skills"
         agents = [agent_1, agent_2]
 
-        return Greeter(agents)
+        return Greeter(agents, {"pool_size": 2, "refresh_interval": 0})
 
 def test_generate_answer(greeter):
     # Mock LLM response
-    mock_answer = "This is a test answer"
-    greeter.llm.return_value = mock_answer
+    greeter.llm.side_effect = ["Greeting 1", "Greeting 2"]
 
-    # Call the method under test
-    response = greeter.generate_answer()
+    # Generate the pool of greetings
+    assert greeter.refresh() == ["Greeting 1", "Greeting 2"]
     
     # Assert that the skills of each agent were used when generating an answer
     assert "Agent 1 skills" in greeter.llm.call_args[0][0].messages[0].content
     assert "Agent 2 skills" in greeter.llm.call_args[0][0].messages[0].content
 
-    # Assert the final answer
-    assert response == {"answer": mock_answer}
\ No newline at end of file
+    # Each variant answers a different question
+    assert greeter.llm.call_args_list[0][0][0].messages[1].content != greeter.llm.call_args_list[1][0][0].messages[1].content
+
+    # Assert the final answer is served from the pool without calling the LLM
+    response = greeter.generate_answer()
+    assert response["answer"] in ["Greeting 1", "Greeting 2"]
+    assert greeter.llm.call_count == 2
+
+def test_generate_answer_before_refresh(greeter):
+    response = greeter.generate_answer()
+
+    # The skills are listed while the pool is being generated
+    assert "Agent 1 skills" in response["answer"]
+    greeter.llm.assert_not_called()
+
+def test_refresh_failure_keeps_greetings(greeter):
+    greeter.llm.side_effect = ["Greeting 1", "Greeting 2"]
+    greeter.refresh()
+
+    greeter.llm.side_effect = Exception("LLM error")
+    assert greeter.refresh() == []
+    assert greeter.generate_answer()["answer"] in ["Greeting 1", "Greeting 2"]
+
+def test_refresh_when_skills_change(greeter):
+    greeter.llm.side_effect = ["Greeting 1", "Greeting 2"]
+    greeter.refresh()
+    assert not greeter.wake.is_set()
+
+    # The stale greetings are still served while the refresh is scheduled
+    greeter.agent_list[0].skills = "New skills"
+    assert greeter.generate_answer()["answer"] in ["Greeting 1", "Greeting 2"]
+    assert greeter.wake.is_set()
+
+def test_background_refresh(greeter):
+    greeter.llm.side_effect = ["Greeting 1", "Greeting 2", "Greeting 3", "Greeting 4"]
+    with patch.object(greeter, "refresh", wraps=greeter.refresh) as refresh:
+        greeter.start()
+        greeter.set_agents(greeter.agent_list)
+        greeter.stop()
+        greeter.worker.join(2)
+    assert not greeter.worker.is_alive()
+    assert refresh.call_count >= 1
@@ -0,0 +1,101 @@
+import time
+import pytest
+from unittest.mock import MagicMock
+from modules.health import HealthMonitor
+
+def make_agent(name, healthy=True, delay=0):
+    agent = MagicMock()
+    agent.name = name
+    def check_connection():
+        time.sleep(delay)
+        return {"healthy": healthy, "info": "up and running" if healthy else "down"}
+    agent.check_connection = MagicMock(side_effect=check_connection)
+    return agent
+
+@pytest.fixture
+def config():
+    return {"ttl": 30, "timeout": 1}
+
+def test_check_all(config):
+    agents = [make_agent("agent1"), make_agent("agent2", healthy=False)]
+    health = HealthMonitor(agents, config)
+
+    response = health.check_all()
+
+    assert response == [
+        {"agent": "agent1", "healthy": True, "ready": True, "info": "up and running"},
+        {"agent": "agent2", "healthy": False, "ready": True, "info": "down"}
+    ]
+
+def test_checks_run_concurrently(config):
+    agents = [make_agent(f"agent{i}", delay=0.3) for i in range(4)]
+    health = HealthMonitor(agents, config)
+
+    start = time.monotonic()
+    health.check_all()
+
+    # Four checks of 0.3s each take far less than their sum
+    assert time.monotonic() - start < 0.9
+
+def test_results_are_cached(config):
+    agents = [make_agent("agent1"), make_agent("agent2")]
+    health = HealthMonitor(agents, config)
+
+    health.check_all()
+    health.check_all()
+    for agent in agents:
+        agent.check_connection.assert_called_once()
+
+    # Forcing a check ignores the cache
+    health.check_all(force=True)
+    for agent in agents:
+        assert agent.check_connection.call_count == 2
+
+def test_slow_agent_times_out(config):
+    agents = [make_agent("agent1"), make_agent("agent2", delay=0.5)]
+    health = HealthMonitor(agents, {"ttl": 30, "timeout": 0.1})
+
+    response = health.check_all()
+
+    assert response[0]["healthy"] is True
+    assert response[1]["healthy"] is False
+    assert "timed out" in response[1]["info"]
+
+    # The slow check keeps running and its result is cached once it finishes
+    time.sleep(0.6)
+    assert health.check_all()[1]["healthy"] is True
+    agents[1].check_connection.assert_called_once()
+
+def test_failing_check(config):
+    agent = make_agent("agent1")
+    agent.check_connection = MagicMock(side_effect=Exception("boom"))
+    health = HealthMonitor([agent], config)
+
+    assert health.check_all() == [{"agent": "agent1", "healthy": False, "ready": True, "info": "boom"}]
+
+def test_background_prober():
+    agents = [make_agent("agent1")]
+    health = HealthMonitor(agents, {"ttl": 30, "timeout": 1, "probe_interval": 0.05})
+
+    health.start()
+    time.sleep(0.2)
+    health.stop()
+
+    # The prober refreshed the status several times and the endpoint answers from cache
+    calls = agents[0].check_connection.call_count
+    assert calls >= 2
+    health.check_all()
+    assert agents[0].check_connection.call_count == calls
+
+def test_readiness_of_lazy_agents(config):
+    agent = make_agent("agent1", delay=0.5)
+    agent.ready = False
+    health = HealthMonitor([agent], {"ttl": 30, "timeout": 0.1})
+
+    # The agent is still initializing its resources when the check times out
+    response = health.check_all()
+    assert response[0]["ready"] is False
+
+    agent.ready = True
+    time.sleep(0.6)
+    assert health.check_all()[0]["ready"] is True
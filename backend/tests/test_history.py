@@ -0,0 +1,97 @@
+import pytest
+from unittest.mock import MagicMock, patch
+from datetime import datetime
+from modules.history import HistorySummarizer
+from modules.utils import window_history, compact_history
+
+class MockEntity(dict):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.__dict__ = self
+
+@pytest.fixture(autouse=True)
+def estimated_tokens():
+    # Use the character based estimate so the tests do not need the tokenizer files
+    with patch('modules.serializer.get_encoder', return_value=None):
+        yield
+
+@pytest.fixture
+def summarizer():
+    with patch('modules.history.AzureChatOpenAI') as MockLLM:
+        MockLLM.return_value = MagicMock()
+        return HistorySummarizer(MagicMock(), {"max_entries": 2})
+
+def make_entities(count):
+    return [
+        MockEntity(PartitionKey="123", RowKey=str(i), role="user" if i % 2 == 0 else "bot", content=f"message {i}", metadata={"timestamp": datetime(2024, 12, 18, 12, 0, i)})
+        for i in range(count)
+    ]
+
+def test_window_history():
+    history = [{"role": "user", "content": "x" * 400}, {"role": "bot", "content": "y" * 400}, {"role": "user", "content": "z" * 40}]
+
+    # The most recent entries within the budget
+    assert window_history(history, 120) == history[1:]
+    assert window_history(history, 1000, max_entries=1) == history[2:]
+
+    # Long entries are shortened before being counted
+    window = window_history(history, 1000, max_entry_tokens=50)
+    assert len(window) == 3
+    assert window[0]["content"].endswith("chars truncated]")
+
+    # The summary is always kept
+    assert window_history([{"role": "summary", "content": "summary"}] + history, 20) == [{"role": "summary", "content": "summary"}, history[2]]
+
+def test_compact_history():
+    history = [{"role": "user", "content": "hi!"}, {"role": "bot", "content": "hello", "agent_sql": "hello from sql"}]
+    assert compact_history(history, 100) == [{"role": "user", "content": "hi!"}, {"role": "bot", "content": "hello"}]
+
+def test_update(summarizer):
+    summarizer.table.query_entities.return_value = make_entities(5)
+    summarizer.llm.return_value = "The user sent messages 0 to 2."
+
+    # Entries older than the window are summarized
+    assert summarizer.update("123") == "The user sent messages 0 to 2."
+    assert "message 2" in summarizer.llm.call_args[0][0].messages[1].content
+    assert "message 3" not in summarizer.llm.call_args[0][0].messages[1].content
+    entity = summarizer.table.upsert_entity.call_args[1]["entity"]
+    assert entity["RowKey"] == "summary" and entity["turns"] == 3
+
+    # Next time only the new entries are added to the summary
+    summarizer.table.query_entities.return_value = [MockEntity(PartitionKey="123", RowKey="summary", role="summary", content="The user sent messages 0 to 2.", turns=3)] + make_entities(7)
+    summarizer.update("123")
+    assert "The user sent messages 0 to 2." in summarizer.llm.call_args[0][0].messages[0].content
+    assert "message 2" not in summarizer.llm.call_args[0][0].messages[1].content
+    assert "message 4" in summarizer.llm.call_args[0][0].messages[1].content
+    assert summarizer.table.upsert_entity.call_args[1]["entity"]["turns"] == 5
+
+    # Nothing to do while everything fits in the window
+    summarizer.llm.reset_mock()
+    summarizer.table.query_entities.return_value = make_entities(2)
+    assert summarizer.update("123") is None
+    summarizer.llm.assert_not_called()
+
+def test_update_token_window(summarizer):
+    # Four long entries fit the entry limit but not the token budget
+    summarizer.max_entries, summarizer.max_tokens, summarizer.max_entry_tokens = 4, 250, 100
+    entities = make_entities(4)
+    for entity in entities:
+        entity["content"] = f"{entity['content']} " + "x" * 400
+    summarizer.table.query_entities.return_value = entities
+    summarizer.llm.return_value = "The user sent messages 0 and 1."
+
+    # The entries the window drops for tokens are summarized too, none of them is lost
+    window = window_history(entities, 250, 4, 100)
+    assert len(window) == 2
+    summarizer.update("123")
+    assert "message 1" in summarizer.llm.call_args[0][0].messages[1].content
+    assert "message 2" not in summarizer.llm.call_args[0][0].messages[1].content
+    assert summarizer.table.upsert_entity.call_args[1]["entity"]["turns"] == 2
+
+def test_schedule(summarizer):
+    summarizer.update = MagicMock(side_effect=Exception("Storage error"))
+    summarizer.schedule("123")
+    summarizer.executor.shutdown(wait=True)
+
+    # Errors are logged, not raised
+    summarizer.update.assert_called_once_with("123")
@@ -0,0 +1,104 @@
+import pytest
+from unittest.mock import patch
+from requests.adapters import BaseAdapter
+from requests.models import Response
+from modules.http_cache import CachedSession, parse_cache_control
+
+class FakeAdapter(BaseAdapter):
+    # Serves canned responses and records the requests it receives
+    def __init__(self, responses):
+        super().__init__()
+        self.responses = responses
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        status_code, headers, body = self.responses.pop(0)
+        response = Response()
+        response.status_code = status_code
+        response.headers.update(headers)
+        response._content = body
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def clock():
+    with patch('modules.http_cache.time') as MockTime:
+        MockTime.monotonic.return_value = 1000
+        yield MockTime
+
+def make_session(responses):
+    session = CachedSession()
+    adapter = FakeAdapter(responses)
+    session.mount("https://", adapter)
+    return session, adapter
+
+def test_parse_cache_control():
+    assert parse_cache_control("public, max-age=60, s-maxage=60") == {"public": "", "max-age": "60", "s-maxage": "60"}
+    assert parse_cache_control(None) == {}
+
+def test_fresh_responses_are_served_locally(clock):
+    session, adapter = make_session([(200, {"Cache-Control": "max-age=60"}, b'{"login": "octocat"}')])
+
+    first = session.get("https://api.github.com/users/octocat")
+    clock.monotonic.return_value = 1030
+    second = session.get("https://api.github.com/users/octocat")
+
+    assert len(adapter.requests) == 1
+    assert second.json() == first.json() == {"login": "octocat"}
+
+def test_stale_responses_are_revalidated(clock):
+    session, adapter = make_session([
+        (200, {"Cache-Control": "max-age=60", "ETag": '"v1"'}, b'{"login": "octocat"}'),
+        (304, {"Cache-Control": "max-age=60"}, b""),
+        (200, {"Cache-Control": "max-age=60", "ETag": '"v2"'}, b'{"login": "octocat", "name": "Mona"}')
+    ])
+    session.get("https://api.github.com/users/octocat")
+
+    # Once stale the ETag is sent and a 304 returns the cached body
+    clock.monotonic.return_value = 1061
+    response = session.get("https://api.github.com/users/octocat")
+    assert adapter.requests[1].headers["If-None-Match"] == '"v1"'
+    assert response.status_code == 200
+    assert response.json() == {"login": "octocat"}
+
+    # The 304 refreshed the entry
+    clock.monotonic.return_value = 1100
+    session.get("https://api.github.com/users/octocat")
+    assert len(adapter.requests) == 2
+
+    # A changed resource replaces the cached one
+    clock.monotonic.return_value = 1200
+    response = session.get("https://api.github.com/users/octocat")
+    assert response.json()["name"] == "Mona"
+
+def test_uncacheable_responses(clock):
+    session, adapter = make_session([
+        (200, {"Cache-Control": "no-store", "ETag": '"v1"'}, b"{}"),
+        (200, {"Cache-Control": "no-store", "ETag": '"v1"'}, b"{}"),
+        (404, {"Cache-Control": "max-age=60"}, b"{}"),
+        (404, {"Cache-Control": "max-age=60"}, b"{}")
+    ])
+    session.get("https://api.github.com/users/octocat")
+    session.get("https://api.github.com/users/octocat")
+    session.get("https://api.github.com/users/missing")
+    session.get("https://api.github.com/users/missing")
+
+    assert len(adapter.requests) == 4
+    assert "If-None-Match" not in adapter.requests[1].headers
+
+def test_cache_key_includes_params_and_authorization(clock):
+    session, adapter = make_session([
+        (200, {"Cache-Control": "max-age=60"}, b"[1]"),
+        (200, {"Cache-Control": "max-age=60"}, b"[2]"),
+        (200, {"Cache-Control": "max-age=60"}, b"[3]")
+    ])
+    assert session.get("https://api.github.com/users/octocat/repos", params={"page": 1}).json() == [1]
+    assert session.get("https://api.github.com/users/octocat/repos", params={"page": 2}).json() == [2]
+    assert session.get("https://api.github.com/users/octocat/repos", params={"page": 1}, headers={"Authorization": "token abc"}).json() == [3]
+    assert session.get("https://api.github.com/users/octocat/repos", params={"page": 1}).json() == [1]
+    assert len(adapter.requests) == 3
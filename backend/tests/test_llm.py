@@ -0,0 +1,112 @@
+import httpx
+import pytest
+from unittest.mock import patch
+from langchain_openai import AzureChatOpenAI
+from modules.llm import LLMTransport, LLMClientFactory, DEFAULT_CONFIG, get_retry_after
+
+COMPLETION = {
+    "id": "1", "object": "chat.completion", "created": 0, "model": "gpt-4o",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "Hello"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 5, "completion_tokens": 1, "total_tokens": 6}
+}
+
+@pytest.fixture(autouse=True)
+def no_sleep():
+    with patch('modules.llm.time.sleep') as MockSleep:
+        yield MockSleep
+
+def make_transport(responses, **config):
+    calls = []
+    def handler(request):
+        calls.append(request)
+        response = responses[min(len(calls) - 1, len(responses) - 1)]
+        if isinstance(response, Exception):
+            raise response
+        return response
+    return LLMTransport(httpx.MockTransport(handler), { **DEFAULT_CONFIG, **config }), calls
+
+def test_retries_honour_retry_after(no_sleep):
+    transport, calls = make_transport([httpx.Response(429, headers={"retry-after-ms": "1500"}), httpx.Response(503, headers={"Retry-After": "2"}), httpx.Response(200, json=COMPLETION)])
+    client = httpx.Client(transport=transport)
+
+    response = client.post("https://example.openai.azure.com/openai/deployments/gpt-4o/chat/completions", json={"messages": []})
+
+    assert response.status_code == 200
+    assert len(calls) == 3
+    assert [call[0][0] for call in no_sleep.call_args_list] == [1.5, 2.0]
+
+    # The body is sent again on every attempt
+    assert calls[2].content == calls[0].content
+
+def test_backoff_and_give_up(no_sleep):
+    transport, calls = make_transport([httpx.ConnectError("refused"), httpx.Response(500)], max_retries=2, backoff_base=1)
+    client = httpx.Client(transport=transport)
+
+    # After the last retry the error is returned to the caller
+    assert client.get("https://example.openai.azure.com/openai/deployments/gpt-4o/chat/completions").status_code == 500
+    assert len(calls) == 3
+
+    # Jittered exponential delays
+    delays = [call[0][0] for call in no_sleep.call_args_list]
+    assert 0.5 <= delays[0] <= 1 and 1 <= delays[1] <= 2
+
+def test_client_errors_are_not_retried():
+    transport, calls = make_transport([httpx.Response(400)])
+    assert httpx.Client(transport=transport).get("https://example.openai.azure.com/openai/deployments/gpt-4o/x").status_code == 400
+    assert len(calls) == 1
+
+def test_concurrency_per_deployment():
+    transport, _ = make_transport([httpx.Response(200)], max_concurrency=4, concurrency={"gpt-4o-mini": 2})
+    assert transport.get_semaphore("gpt-4o")._initial_value == 4
+    assert transport.get_semaphore("gpt-4o-mini")._initial_value == 2
+    assert transport.get_semaphore("gpt-4o") is transport.get_semaphore("gpt-4o")
+
+def test_get_retry_after():
+    assert get_retry_after(httpx.Response(429)) is None
+    assert get_retry_after(httpx.Response(429, headers={"Retry-After": "3"})) == 3
+    assert get_retry_after(httpx.Response(429, headers={"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"})) == 0
+
+def test_shared_client(monkeypatch):
+    monkeypatch.setenv("AZURE_OPENAI_API_KEY", "key")
+    monkeypatch.setenv("AZURE_OPENAI_ENDPOINT", "https://example.openai.azure.com")
+    factory = LLMClientFactory()
+    factory.configure({"max_retries": 1})
+
+    # Every model uses the same pooled client and leaves the retries to it
+    first = AzureChatOpenAI(**factory.get_llm_kwargs("answer_generator_chain"))
+    second = AzureChatOpenAI(**factory.get_llm_kwargs("entry_point_chain"))
+    assert first.http_client is second.http_client
+    assert first.max_retries == 0
+
+    # End to end through the retrying transport
+    transport, calls = make_transport([httpx.Response(429), httpx.Response(200, json=COMPLETION)])
+    factory.http_client = httpx.Client(transport=transport)
+    assert AzureChatOpenAI(**factory.get_llm_kwargs("answer_generator_chain")).invoke("hi").content == "Hello"
+    assert len(calls) == 2
+
+def test_timeout(monkeypatch):
+    monkeypatch.setenv("AZURE_OPENAI_API_KEY", "key")
+    monkeypatch.setenv("AZURE_OPENAI_ENDPOINT", "https://example.openai.azure.com")
+    factory = LLMClientFactory()
+    factory.configure({"timeout": 12})
+    transport, calls = make_transport([httpx.Response(200, json=COMPLETION)])
+    factory.http_client = httpx.Client(transport=transport)
+
+    # The configured timeout reaches the requests sent by the model client
+    AzureChatOpenAI(**factory.get_llm_kwargs("answer_generator_chain")).invoke("hi")
+    assert calls[0].extensions["timeout"] == {"connect": 12, "read": 12, "write": 12, "pool": 12}
+
+def test_chain_settings():
+    factory = LLMClientFactory()
+    factory.configure({"deployment": "gpt-4o", "chains": {"entry_point_chain": {"deployment": "gpt-4o-mini", "max_tokens": 50, "priority": "routing"}}})
+
+    kwargs = factory.get_llm_kwargs("entry_point_chain")
+    assert kwargs["deployment_name"] == "gpt-4o-mini"
+    assert kwargs["max_tokens"] == 50
+    assert kwargs["default_headers"] == {"X-LLM-Priority": "routing"}
+
+    # Chains without settings use the default deployment and no output limit
+    kwargs = factory.get_llm_kwargs("answer_generator_chain")
+    assert kwargs["deployment_name"] == "gpt-4o"
+    assert "max_tokens" not in kwargs
+    assert kwargs["default_headers"] == {"X-LLM-Priority": "answer"}
@@ -0,0 +1,83 @@
+import json
+import httpx
+import pytest
+from unittest.mock import patch
+from loadtest import LatencyModel, SimulatedOpenAITransport, InMemoryTable, Sample, get_parser, parse_mix, percentile, summarize, format_report, run_load_test
+
+def complete(transport, system):
+    client = httpx.Client(transport=transport)
+    response = client.post("https://simulated.openai.azure.com/openai/deployments/gpt-4o/chat/completions", json={"messages": [{"role": "system", "content": system}, {"role": "user", "content": "hi"}]})
+    return response.status_code, response.json()
+
+def test_simulated_replies():
+    transport = SimulatedOpenAITransport(LatencyModel(0), history_answer_rate=0)
+
+    # The supervisor gets agent names taken from its own prompt
+    status, body = complete(transport, "You are a supervisor tasked with managing a conversation between the following agents: [{'agent_name': 'agent_rag', 'agent_skills': 'x'}, {'agent_name': 'agent_sql', 'agent_skills': 'y'}].")
+    assert status == 200
+    assert set(body["choices"][0]["message"]["content"].split(", ")) <= {"agent_rag", "agent_sql"}
+
+    # The entry points always continue when no answer comes from the history
+    assert complete(transport, "If you are not sure, then answer with 'CONTINUE', nothing else.")[1]["choices"][0]["message"]["content"] == "CONTINUE"
+    assert complete(transport, "You are an AI assistant tasked with summarizing a list of responses.")[1]["usage"]["completion_tokens"] > 0
+
+def test_simulated_throttling():
+    transport = SimulatedOpenAITransport(LatencyModel(0), error_rate=1)
+    assert complete(transport, "")[0] == 429
+
+def test_latency_model():
+    with patch('loadtest.random.gauss', return_value=0):
+        assert LatencyModel(0.5).sample() == 0.5
+    with patch('loadtest.random.gauss', return_value=100):
+        assert LatencyModel(0.5, maximum=10).sample() == 10
+    assert LatencyModel(0).sample() == 0
+
+def test_in_memory_table():
+    table = InMemoryTable()
+    table.create_entity({"PartitionKey": "likes", "RowKey": "1"})
+    table.create_entity({"PartitionKey": "hates", "RowKey": "2"})
+    table.upsert_entity({"PartitionKey": "s1", "RowKey": "summary", "content": "a"})
+    table.upsert_entity({"PartitionKey": "s1", "RowKey": "summary", "content": "b"})
+
+    with pytest.raises(ValueError):
+        table.create_entity({"PartitionKey": "likes", "RowKey": "1"})
+
+    assert len(table.query_entities("PartitionKey eq 'likes' or PartitionKey eq 'hates'")) == 2
+    entities = table.query_entities(query_filter="PartitionKey eq 's1'")
+    assert entities == [{"PartitionKey": "s1", "RowKey": "summary", "content": "b"}]
+    assert entities[0].metadata["timestamp"] is not None
+
+    table.delete_entity(partition_key="s1", row_key="summary")
+    assert table.query_entities("PartitionKey eq 's1'") == []
+
+def test_parse_mix():
+    assert parse_mix("chat=2,status") == {"chat": 2.0, "status": 1.0}
+    with pytest.raises(ValueError):
+        parse_mix("unknown=1")
+
+def test_summarize():
+    assert percentile([1, 2, 3, 4], 50) == 2
+    assert percentile([1, 2, 3, 4], 99) == 4
+    assert percentile([], 50) == 0
+
+    samples = [Sample("ask", 0, 1.0, 200, True), Sample("ask", 0, 3.0, 500, False), Sample("history", 0, 0.1, 200, True)]
+    report = summarize(samples, 2, [(4, 4), (2, 4)])
+
+    assert report["total"]["requests"] == 3
+    assert report["total"]["throughput"] == 1.5
+    assert report["endpoints"]["ask"]["error_rate"] == 0.5
+    assert report["endpoints"]["ask"]["latency"]["p50"] == 1.0
+    assert report["endpoints"]["ask"]["status"] == {"200": 1, "500": 1}
+    assert report["workers"] == {"threads": 4, "busy_mean": 3, "busy_max": 4, "saturated": 0.5}
+    assert "ask" in format_report(report)
+    json.dumps(report)
+
+def test_load_test_with_simulated_backends():
+    options = get_parser().parse_args(["--users", "3", "--ramp", "0", "--duration", "1", "--think-time", "0", "--llm-latency", "0.01", "--fetch-latency", "0.01", "--threads", "4", "--sample-interval", "0.05"])
+
+    report = run_load_test(options)
+
+    assert report["total"]["requests"] > 0
+    assert report["total"]["errors"] == 0
+    assert report["workers"]["threads"] == 4
+    assert set(report["endpoints"]) <= {"greetings", "ask", "history", "feedback", "feedback_count", "agents"}
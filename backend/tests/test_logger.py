@@ -0,0 +1,70 @@
+import json
+import logging
+import pytest
+from modules.logger import setup_logging, stop_logging, request_id, SamplingFilter, TruncateFilter
+
+@pytest.fixture
+def log_output(capsys):
+    def read(config, emit):
+        setup_logging(config)
+        emit(logging.getLogger("modules.test"))
+        # Stopping the listener flushes the queue
+        stop_logging()
+        return capsys.readouterr().out.strip().split("\n")
+    return read
+
+def test_json_records_include_request_id(log_output):
+    def emit(logger):
+        token = request_id.set("abc123")
+        logger.info("%s says: hello", "agent_test")
+        request_id.reset(token)
+
+    lines = log_output({"level": "INFO", "format": "json"}, emit)
+    record = json.loads(lines[0])
+
+    assert record["level"] == "INFO"
+    assert record["logger"] == "modules.test"
+    assert record["request_id"] == "abc123"
+    assert record["message"] == "agent_test says: hello"
+
+def test_debug_payloads_are_skipped_below_level(log_output):
+    class Payload:
+        rendered = False
+        def __str__(self):
+            Payload.rendered = True
+            return "huge payload"
+
+    def emit(logger):
+        logger.debug("%s says: %s", "agent_test", Payload())
+        logger.info("visible")
+
+    lines = log_output({"level": "INFO", "format": "json"}, emit)
+
+    # The payload is never rendered when debug is disabled
+    assert len(lines) == 1
+    assert Payload.rendered is False
+
+def test_payloads_are_truncated(log_output):
+    def emit(logger):
+        logger.debug("%s says: %s", "agent_test", "x" * 500)
+
+    lines = log_output({"level": "DEBUG", "format": "json", "max_chars": 100}, emit)
+    message = json.loads(lines[0])["message"]
+
+    assert message.startswith("agent_test says: xxx")
+    assert message.endswith("chars truncated]")
+    assert len(message) < 150
+
+def test_sampling_filter():
+    debug_record = logging.LogRecord("modules.test", logging.DEBUG, "", 0, "debug", None, None)
+    error_record = logging.LogRecord("modules.test", logging.ERROR, "", 0, "error", None, None)
+
+    # Nothing below the threshold goes through with a zero rate, errors always do
+    assert SamplingFilter(0).filter(debug_record) is False
+    assert SamplingFilter(0).filter(error_record) is True
+    assert SamplingFilter(1).filter(debug_record) is True
+
+def test_truncate_filter_keeps_short_messages():
+    record = logging.LogRecord("modules.test", logging.INFO, "", 0, "%s says: %s", ("agent_test", "ok"), None)
+    TruncateFilter(100).filter(record)
+    assert record.getMessage() == "agent_test says: ok"
@@ -1,7 +1,14 @@
 import pytest
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import MagicMock, patch, call
-from main import generate_answer, store_feedback, get_feedback_count, get_chat_history, add_to_chat_history, delete_chat_history, ping_agents
+from main import app, generate_answer, store_feedback, get_feedback_count, get_chat_history, add_to_chat_history, delete_chat_history, ping_agents, get_metrics
+from fastapi.testclient import TestClient
 from modules.models import QuestionModel, AnswerModel, FeedbackModel
+from modules.health import HealthMonitor
+from modules.cache import TTLCache
+from modules.coalescing import SingleFlight
 from datetime import datetime
 
 
@@ -12,6 +19,7 @@ def mock_setup():
     mock_setup["graph"] = MagicMock()
     mock_setup["feedback_table"] = MagicMock()
     mock_setup["history_table"] = MagicMock()
+    mock_setup["history_summarizer"] = MagicMock()
     MockAgent1 = MagicMock(check_connection=MagicMock())
     MockAgent2 = MagicMock(check_connection=MagicMock())
     agent_1 = MockAgent1.return_value
@@ -21,6 +29,9 @@ def mock_setup():
     agent_2.name = "agent2"
     agent_2.check_connection.return_value = {"healthy": False, "info": ""} 
     mock_setup["agents"] = [agent_1, agent_2]
+    mock_setup["health"] = HealthMonitor(mock_setup["agents"], {"ttl": 30, "timeout": 1})
+    mock_setup["single_flight"] = SingleFlight("ask")
+    mock_setup["idempotency_cache"] = TTLCache(ttl=60, name="idempotency")
     return mock_setup
 
 # Fixtures to moch the payloads
@@ -44,8 +55,8 @@ class MockEntity(dict):
 def test_ping_agents(mock_setup):
     response = ping_agents(setup=mock_setup)
     assert len(response) == 2
-    assert response[0] == {"agent": "agent1", "healthy": True, "info":""}
-    assert response[1] == {"agent": "agent2", "healthy": False, "info":""}
+    assert response[0] == {"agent": "agent1", "healthy": True, "ready": True, "info":""}
+    assert response[1] == {"agent": "agent2", "healthy": False, "ready": True, "info":""}
 
 def test_generate_answer(mock_setup):
     mock_question = "What is the capital of France?"
@@ -77,7 +88,61 @@ def test_generate_answer(mock_setup):
         MockGetChatHistory.assert_called_once()
 
         # Assert that a call to store the new chat in the history was made
-        MockAddToChatHistory.assert_called_once()        
+        MockAddToChatHistory.assert_called_once()
+
+        # Assert that the session summary update was scheduled
+        mock_setup["history_summarizer"].schedule.assert_called_once_with(mock_session_id)
+
+def test_generate_answer_coalesced(mock_setup):
+    mock_graph = mock_setup["graph"]
+    started = threading.Event()
+    release = threading.Event()
+    def invoke(state):
+        started.set()
+        release.wait(2)
+        return { "question": state["question"], "answer": "Paris", "agents": {} }
+    mock_graph.invoke.side_effect = invoke
+
+    with patch('main.get_chat_history', return_value=[]), \
+         patch('main.add_to_chat_history'):
+        # Two sessions ask the same question at the same time
+        with ThreadPoolExecutor() as executor:
+            first = executor.submit(generate_answer, body=QuestionModel(session_id="1", question="What is the capital of France?"), setup=mock_setup)
+            started.wait(2)
+            while mock_setup["single_flight"].in_flight() == 0:
+                time.sleep(0.001)
+            second = executor.submit(generate_answer, body=QuestionModel(session_id="2", question="what is the capital of  france"), setup=mock_setup)
+            time.sleep(0.05)
+            release.set()
+            responses = [first.result(2), second.result(2)]
+
+    # The graph ran once, each session got its own response
+    mock_graph.invoke.assert_called_once()
+    assert [response["session_id"] for response in responses] == ["1", "2"]
+    assert all(response["answer"] == "Paris" for response in responses)
+
+def test_generate_answer_idempotency_key(mock_setup):
+    mock_graph = mock_setup["graph"]
+    mock_graph.invoke.return_value = { "question": "Q", "answer": "First answer", "agents": {} }
+
+    with patch('main.get_chat_history', return_value=[]), \
+         patch('main.add_to_chat_history') as MockAddToChatHistory:
+        body = QuestionModel(session_id="1234", question="Q")
+        first = generate_answer(body=body, setup=mock_setup, idempotency_key="abc")
+
+        # The retry returns the stored response without running the graph or writing the history again
+        mock_graph.invoke.return_value = { "question": "Q", "answer": "Second answer", "agents": {} }
+        assert generate_answer(body=body, setup=mock_setup, idempotency_key="abc") == first
+        mock_graph.invoke.assert_called_once()
+        MockAddToChatHistory.assert_called_once()
+
+        # Another key is a new request
+        assert generate_answer(body=body, setup=mock_setup, idempotency_key="def")["answer"] == "Second answer"
+
+        # The same key with another question is rejected instead of getting the first answer
+        response = generate_answer(body=QuestionModel(session_id="1234", question="Another question"), setup=mock_setup, idempotency_key="abc")
+        assert response.status_code == 422
+        assert mock_graph.invoke.call_count == 2
 
 def test_store_feedback(mock_setup, mock_feedback):
     with patch('main.uuid') as MockId:
@@ -169,6 +234,22 @@ def test_get_chat_history(mock_setup):
     response = get_chat_history(mock_session_id, setup=mock_setup)
     assert len(response) == 0
 
+def test_get_chat_history_summary(mock_setup):
+    mock_history_table = mock_setup["history_table"]
+    mock_session_id = "123"
+
+    # The summary goes first, then the latest entries within the token budget (very long answers are shortened)
+    mock_history_table.query_entities.return_value = [
+        MockEntity(PartitionKey=mock_session_id, RowKey="summary", role="summary", content="The user asked about France.", turns=2),
+        MockEntity(PartitionKey=mock_session_id, RowKey="3", role="user", content="Have you ever been to Paris?", metadata={"timestamp": datetime(2024, 12, 18, 12, 0, 2)}),
+        MockEntity(PartitionKey=mock_session_id, RowKey="4", role="bot", content="No " * 5000, metadata={"timestamp": datetime(2024, 12, 18, 12, 0, 3)}),
+    ]
+    response = get_chat_history(mock_session_id, setup=mock_setup)
+    assert len(response) == 3
+    assert response[0] == {"role": "summary", "content": "The user asked about France."}
+    assert response[1]["content"] == "Have you ever been to Paris?"
+    assert response[2]["content"].endswith("chars truncated]")
+
 def test_add_to_chat_history(mock_setup, mock_answer):
     with patch('main.uuid') as MockId:  
         mock_history_table = mock_setup["history_table"]
@@ -203,4 +284,20 @@ def test_delete_chat_history(mock_setup):
     # Assertions to verify expected behavior
     mock_history_table.query_entities.assert_called_once_with(f"PartitionKey eq '{mock_session_id}'")
     mock_history_table.delete_entity.assert_has_calls([call(partition_key=mock_session_id, row_key="2"), call(partition_key=mock_session_id, row_key="1")])
-    assert response == {"message": "Deleted 2 records successfully."}
\ No newline at end of file
+    assert response == {"message": "Deleted 2 records successfully."}
+def test_get_metrics():
+    with patch('main.metrics') as MockMetrics:
+        MockMetrics.render.return_value = "graph_invoke_duration_seconds_count 1\n"
+        response = get_metrics()
+        assert response == "graph_invoke_duration_seconds_count 1\n"
+
+def test_request_id_header():
+    client = TestClient(app)
+
+    # The correlation id provided by the caller is echoed back
+    response = client.get("/api/ping", headers={"X-Request-ID": "my-request"})
+    assert response.headers["X-Request-ID"] == "my-request"
+
+    # Otherwise a new one is generated
+    response = client.get("/api/ping")
+    assert len(response.headers["X-Request-ID"]) == 32
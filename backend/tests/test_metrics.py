@@ -0,0 +1,100 @@
+import pytest
+from unittest.mock import MagicMock
+from langchain_core.language_models.fake_chat_models import GenericFakeChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import RunnableLambda
+from modules.metrics import Metrics, Tracer
+from modules.graph import Graph
+
+@pytest.fixture
+def registry():
+    return Metrics()
+
+def test_render_counters_and_gauges(registry):
+    registry.describe("requests_total", "Number of requests.")
+    registry.inc("requests_total", {"endpoint": "/api/ask"})
+    registry.inc("requests_total", {"endpoint": "/api/ask"}, 2)
+    registry.set_gauge("queue_depth", 7)
+
+    output = registry.render()
+
+    assert "# HELP requests_total Number of requests." in output
+    assert "# TYPE requests_total counter" in output
+    assert 'requests_total{endpoint="/api/ask"} 3' in output
+    assert "# TYPE queue_depth gauge" in output
+    assert "queue_depth 7" in output
+
+def test_render_histogram(registry):
+    registry.observe("latency_seconds", 0.3, {"node": "agent_sql_node"}, buckets=(0.1, 0.5, 1))
+    registry.observe("latency_seconds", 0.7, {"node": "agent_sql_node"}, buckets=(0.1, 0.5, 1))
+
+    output = registry.render()
+
+    # Buckets are cumulative
+    assert 'latency_seconds_bucket{node="agent_sql_node",le="0.1"} 0' in output
+    assert 'latency_seconds_bucket{node="agent_sql_node",le="0.5"} 1' in output
+    assert 'latency_seconds_bucket{node="agent_sql_node",le="1"} 2' in output
+    assert 'latency_seconds_bucket{node="agent_sql_node",le="+Inf"} 2' in output
+    assert 'latency_seconds_count{node="agent_sql_node"} 2' in output
+
+def test_record_cache(registry):
+    registry.record_cache("sql_results", True)
+    registry.record_cache("sql_results", False)
+    registry.record_cache("sql_results", False)
+
+    output = registry.render()
+
+    assert 'cache_requests_total{cache="sql_results",result="hit"} 1' in output
+    assert 'cache_requests_total{cache="sql_results",result="miss"} 2' in output
+
+def test_tracer_records_graph_nodes_chains_and_tokens(registry):
+    # A fake agent whose node invokes a named chain backed by a chat model reporting token usage
+    llm = GenericFakeChatModel(messages=iter([AIMessage(content="42", usage_metadata={"input_tokens": 10, "output_tokens": 3, "total_tokens": 13})]))
+    chain = (RunnableLambda(lambda inputs: inputs["question"]) | llm | StrOutputParser()).with_config(run_name="answer_generator_chain")
+
+    agent = MagicMock()
+    agent.name = "agent_test"
+    def agent_answer(state):
+        return { "agents": { "agent_test": chain.invoke(state) } }
+    agent.generate_answer = agent_answer
+
+    supervisor = MagicMock()
+    supervisor.get_relevant_agents = lambda state: { "relevant_agents": ["agent_test"] }
+    supervisor.generate_answer = lambda state: { "next": "agent_test" if "agent_test" not in (state.get("agents") or {}) else "FINISH" }
+
+    summarizer = MagicMock()
+    summarizer.generate_answer = lambda state: { "answer": state["agents"]["agent_test"] }
+
+    graph = Graph(supervisor, summarizer, [agent])
+    graph.tracer = Tracer(registry)
+    result = graph.invoke({"question": "what is the answer?", "history": []})
+
+    assert result["answer"] == "42"
+
+    # All the spans belong to the same trace
+    spans = registry.get_spans()
+    assert len({span["trace_id"] for span in spans}) == 1
+    names = [span["name"] for span in spans]
+    assert "supervisor_agent_filter_node" in names
+    assert "agent_test_node" in names
+    assert "summarizer_node" in names
+    assert "answer_generator_chain" in names
+
+    # The LLM span is nested in the chain, which is nested in the agent node
+    llm_span = next(span for span in spans if span["kind"] == "llm")
+    chain_span = next(span for span in spans if span["name"] == "answer_generator_chain")
+    assert llm_span["attributes"]["node"] == "agent_test_node"
+    assert llm_span["attributes"]["chain"] == "answer_generator_chain"
+    assert llm_span["attributes"]["prompt_tokens"] == 10
+    assert llm_span["parent_span_id"] == chain_span["span_id"]
+
+    output = registry.render()
+    assert 'graph_node_duration_seconds_count{node="agent_test_node"} 1' in output
+    assert 'llm_tokens_total{chain="answer_generator_chain",node="agent_test_node",type="prompt"} 10' in output
+    assert 'llm_tokens_total{chain="answer_generator_chain",node="agent_test_node",type="completion"} 3' in output
+    assert "graph_invoke_duration_seconds_count 1" in output
+
+def test_tracer_token_usage_from_llm_output():
+    response = MagicMock(llm_output={"token_usage": {"prompt_tokens": 100, "completion_tokens": 20, "prompt_tokens_details": {"cached_tokens": 64}}})
+    assert Tracer.get_token_usage(response) == {"prompt_tokens": 100, "completion_tokens": 20, "cached_tokens": 64}
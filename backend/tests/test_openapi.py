@@ -0,0 +1,104 @@
+import json
+import os
+import pytest
+from modules.openapi import resolve_refs, build_index, SpecCache, get_operation_signature, validate_call, build_request
+
+@pytest.fixture
+def spec():
+    return {
+        "servers": [{"url": "https://api.example.com"}],
+        "paths": {
+            "/users/{username}": {
+                "parameters": [{"$ref": "#/components/parameters/username"}],
+                "get": {
+                    "operationId": "users/get-by-username",
+                    "summary": "Get a user",
+                    "responses": {"200": {"content": {"application/json": {"schema": {"$ref": "#/components/schemas/user"}}}}}
+                },
+                "patch": {"summary": "Update a user"}
+            },
+            "/repos": {
+                "get": {"summary": "List repositories"}
+            }
+        },
+        "components": {
+            "parameters": {
+                "username": {"name": "username", "in": "path", "required": True, "schema": {"type": "string"}}
+            },
+            "schemas": {
+                "user": {"type": "object", "properties": {"login": {"type": "string"}, "manager": {"$ref": "#/components/schemas/user"}}}
+            }
+        }
+    }
+
+def test_resolve_refs(spec):
+    resolved = resolve_refs({"$ref": "#/components/schemas/user"}, spec)
+    assert resolved["properties"]["login"] == {"type": "string"}
+
+    # Recursive references are kept as references
+    assert resolved["properties"]["manager"] == {"$ref": "#/components/schemas/user"}
+
+def test_build_index(spec):
+    operations = build_index(spec, ["/users/{username}"])
+
+    # Only the GET operations of the filtered paths are indexed
+    assert list(operations) == ["/users/{username}"]
+    assert list(operations["/users/{username}"]) == ["get"]
+
+    # Path level parameters and references are resolved into the operation
+    operation = operations["/users/{username}"]["get"]
+    assert operation["parameters"] == [{"name": "username", "in": "path", "required": True, "schema": {"type": "string"}}]
+    assert operation["responses"]["200"]["content"]["application/json"]["schema"]["type"] == "object"
+
+    # No filter means every path
+    assert list(build_index(spec, [])) == ["/users/{username}", "/repos"]
+
+def test_spec_cache(tmp_path):
+    cache = SpecCache(str(tmp_path / "cache"))
+    assert cache.load("key") is None
+
+    cache.save("key", {"etag": "v1", "operations": {}})
+    assert cache.load("key") == {"etag": "v1", "operations": {}}
+    assert cache.load("other-key") is None
+
+    # Stored as plain JSON in a directory only its owner can use
+    assert os.stat(tmp_path / "cache").st_mode & 0o777 == 0o700
+    assert json.loads(open(cache.get_path("key")).read())["etag"] == "v1"
+
+def test_spec_cache_shared_directory(tmp_path):
+    cache = SpecCache(str(tmp_path / "cache"))
+    cache.save("key", {"etag": "v1", "operations": {}})
+
+    # Files in a directory others can write may have been planted, they are neither read nor written
+    os.chmod(tmp_path / "cache", 0o777)
+    assert cache.load("key") is None
+    cache.save("other-key", {"etag": "v2", "operations": {}})
+    assert not os.path.exists(cache.get_path("other-key"))
+
+def test_get_operation_signature(spec):
+    operation = build_index(spec, ["/users/{username}"])["/users/{username}"]["get"]
+    signature = get_operation_signature(operation)
+
+    # Response schemas are left out
+    assert signature == {"operationId": "users/get-by-username", "summary": "Get a user", "parameters": [{"name": "username", "in": "path", "required": True, "type": "string"}]}
+
+def test_validate_call(spec):
+    operations = build_index(spec, [])
+
+    # Operations can be referenced by operationId or by path
+    path, _, errors = validate_call({"operation": "users/get-by-username", "parameters": {"username": "octocat"}}, operations)
+    assert path == "/users/{username}" and errors == []
+    assert validate_call({"operation": "/repos", "parameters": {}}, operations)[2] == []
+
+    assert validate_call({"operation": "unknown"}, operations)[2] == ["unknown operation 'unknown'"]
+    assert validate_call({"operation": "/users/{username}", "parameters": {"page": 1}}, operations)[2] == ["missing required parameter 'username'", "unknown parameter 'page'"]
+    assert validate_call(["not", "a", "plan"], operations)[2] == ["the plan must be an object with an 'operation' field"]
+
+def test_build_request(spec):
+    operation = build_index(spec, [])["/users/{username}"]["get"]
+    url, query, headers = build_request("https://api.example.com/", "/users/{username}", operation, {"username": "octo cat", "page": 2})
+
+    # Path parameters are quoted, unknown locations go to the query string
+    assert url == "https://api.example.com/users/octo%20cat"
+    assert query == {"page": 2}
+    assert headers == {}
@@ -0,0 +1,100 @@
+import json
+import os
+from modules.plan_cache import PlanCache, normalize_question, extract_literals, parameterize_query
+
+def test_normalize_question():
+    assert normalize_question("Top 5 products by sales in 2013?") == "top <0> products by sales in <1>"
+    assert normalize_question("Which products are in the 'Road Bikes' category?") == "which products are in the <0> category"
+    assert extract_literals("Top 5 products by sales in 2013, top 5 only") == ["5", "2013"]
+
+def test_parameterize_query():
+    assert parameterize_query("SELECT TOP(5) Name FROM Sales WHERE YEAR(OrderDate) = 2013", ["5", "2013"]) == ("SELECT TOP({0}) Name FROM Sales WHERE YEAR(OrderDate) = {1}", ["number", "number"])
+    assert parameterize_query("SELECT Name FROM Products WHERE Category = 'Road Bikes' AND Year = 2013", ["2013", "Road Bikes"]) == ("SELECT Name FROM Products WHERE Category = '{1}' AND Year = {0}", ["number", "string"])
+
+    # Values outside of a string literal that are not numbers are part of the query itself
+    assert parameterize_query("SELECT Name FROM Sales", ["Sales"]) is None
+
+    # Parameters that do not appear in the query cannot be replaced
+    assert parameterize_query("SELECT TOP(5) Name FROM Sales", ["5", "2013"]) is None
+
+def test_lookup(tmp_path):
+    cache = PlanCache(str(tmp_path / "plans.json"))
+    cache.add("Top 5 products by sales in 2013?", "SELECT TOP(5) Name FROM Sales WHERE YEAR(OrderDate) = 2013")
+
+    # Same shape, different parameters
+    assert cache.lookup("top 10 products by sales in 2014") == "SELECT TOP(10) Name FROM Sales WHERE YEAR(OrderDate) = 2014"
+    assert cache.lookup("top 5 products by revenue in 2014") is None
+
+    # The pairs survive a restart
+    assert PlanCache(str(tmp_path / "plans.json")).lookup("Top 5 products by sales in 2013") == "SELECT TOP(5) Name FROM Sales WHERE YEAR(OrderDate) = 2013"
+
+def test_short_questions_are_not_reused(tmp_path):
+    cache = PlanCache(str(tmp_path / "plans.json"))
+    cache.add("and in 2013?", "SELECT TOP(5) Name FROM Sales WHERE YEAR(OrderDate) = 2013")
+
+    # Follow-up questions depend on the conversation
+    assert cache.lookup("and in 2014?") is None
+
+def test_examples(tmp_path):
+    cache = PlanCache(str(tmp_path / "plans.json"), max_entries=2)
+    cache.add("Top 5 products by sales in 2013", "SELECT 1")
+    cache.add("How many customers are there?", "SELECT 2")
+    cache.add("Top 3 products by sales in 2012 and 2013", "SELECT 3")
+
+    # The least recently used pair was dropped
+    assert len(cache.entries) == 2
+
+    examples = cache.examples("top 3 products by sales in 2014")
+    assert examples == [{"question": "Top 3 products by sales in 2012 and 2013", "query": "SELECT 3"}]
+
+def test_ambiguous_parameters_are_not_replaced(tmp_path):
+    # The 1 of "top 1" also appears as a flag, replacing both would change the query
+    assert parameterize_query("SELECT TOP(1) Name FROM Sales WHERE OnlineOrderFlag = 1 AND YEAR(OrderDate) = 2013", ["1", "2013"]) is None
+
+    cache = PlanCache(str(tmp_path / "plans.json"))
+    cache.add("Top 1 product by sales in 2013", "SELECT TOP(1) Name FROM Sales WHERE OnlineOrderFlag = 1 AND YEAR(OrderDate) = 2013")
+    assert cache.lookup("Top 10 product by sales in 2013") is None
+    assert cache.examples("Top 10 product by sales in 2013")[0]["question"] == "Top 1 product by sales in 2013"
+
+def test_conversations_are_not_reused(tmp_path):
+    cache = PlanCache(str(tmp_path / "plans.json"))
+    history = [{"role": "user", "content": "Only online orders"}]
+    cache.add("Top 5 products by sales in 2013", "SELECT TOP(5) Name FROM Sales WHERE YEAR(OrderDate) = 2013")
+    cache.add("Top 3 customers by sales in 2013", "SELECT TOP(3) Name FROM Customers WHERE OnlineOrderFlag = 1 AND YEAR(OrderDate) = 2013", history)
+
+    # The same question in a conversation may mean something else, and a query written for one may depend on it
+    assert cache.lookup("Top 5 products by sales in 2014", history) is None
+    assert cache.lookup("Top 3 customers by sales in 2014") is None
+    assert cache.lookup("Top 5 products by sales in 2014") == "SELECT TOP(5) Name FROM Sales WHERE YEAR(OrderDate) = 2014"
+
+def test_workers_share_the_file(tmp_path):
+    first = PlanCache(str(tmp_path / "plans.json"))
+    second = PlanCache(str(tmp_path / "plans.json"))
+    first.add("Top 5 products by sales in 2013", "SELECT 1")
+    second.add("How many customers are there?", "SELECT 2")
+
+    # The second writer keeps the pairs of the first one
+    assert len(PlanCache(str(tmp_path / "plans.json")).entries) == 2
+
+def test_parameters_cannot_change_the_query(tmp_path):
+    cache = PlanCache(str(tmp_path / "plans.json"))
+    cache.add("Top 5 orders by total due in 2013", "SELECT TOP 5 SalesOrderID FROM Sales.SalesOrderHeader WHERE YEAR(OrderDate) = 2013 ORDER BY TotalDue DESC")
+    cache.add("Which products are in the 'Road Bikes' category?", "SELECT Name FROM Products WHERE Category = 'Road Bikes'")
+
+    # A quoted value in a numeric slot is not reused, the query is generated instead
+    assert cache.lookup('top "5 FirstName, LastName FROM Person.Person --" orders by total due in 2013') is None
+
+    # Values in string slots stay inside the SQL string
+    assert cache.lookup("Which products are in the \"x' OR 1=1 --\" category?") == "SELECT Name FROM Products WHERE Category = 'x'' OR 1=1 --'"
+
+def test_plan_file_must_be_private(tmp_path):
+    cache = PlanCache(str(tmp_path / "cache" / "plans.json"))
+    cache.add("Top 5 products by sales in 2013", "SELECT 1")
+    assert os.stat(tmp_path / "cache").st_mode & 0o777 == 0o700
+    assert os.listdir(tmp_path / "cache") == ["plans.json"]
+
+    # Pairs in a directory others can write may have been planted, they are neither read nor written
+    os.chmod(tmp_path / "cache", 0o777)
+    assert PlanCache(str(tmp_path / "cache" / "plans.json")).entries == {}
+    cache.add("How many customers are there?", "SELECT 2")
+    assert len(json.load(open(tmp_path / "cache" / "plans.json"))) == 1
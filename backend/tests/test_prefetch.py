@@ -0,0 +1,58 @@
+import threading
+import pytest
+from unittest.mock import MagicMock
+from modules.prefetch import Prefetch
+from modules.logger import request_id
+from modules.metrics import metrics
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+def test_result():
+    fetch = MagicMock(return_value="schema")
+    prefetch = Prefetch("agent", fetch, "a", "b")
+    assert prefetch.result() == "schema"
+    fetch.assert_called_once_with("a", "b")
+    assert 'agent_prefetch_total{agent="agent",result="used"} 1' in metrics.render()
+
+def test_result_error():
+    prefetch = Prefetch("agent", MagicMock(side_effect=Exception("Mocked exception")))
+    with pytest.raises(Exception, match="Mocked exception"):
+        prefetch.result()
+
+def test_request_context():
+    token = request_id.set("abc")
+    try:
+        prefetch = Prefetch("agent", request_id.get)
+    finally:
+        request_id.reset(token)
+    assert prefetch.result() == "abc"
+
+def test_discard():
+    started = threading.Event()
+    release = threading.Event()
+    def fetch():
+        started.set()
+        release.wait(2)
+        raise Exception("Mocked exception")
+
+    # A running fetch finishes in the background and its error is dropped
+    prefetch = Prefetch("agent", fetch)
+    started.wait(2)
+    prefetch.discard()
+    release.set()
+    prefetch.future.exception(2)
+    assert 'agent_prefetch_total{agent="agent",result="discarded"} 1' in metrics.render()
+
+def test_disabled():
+    fetch = MagicMock(return_value="index")
+    prefetch = Prefetch("agent", fetch, enabled=False)
+
+    # Nothing runs until the result is needed
+    fetch.assert_not_called()
+    prefetch.discard()
+    assert prefetch.result() == "index"
+    fetch.assert_called_once()
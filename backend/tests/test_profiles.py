@@ -0,0 +1,54 @@
+import pytest
+from modules.profiles import answer_from_profiles, format_profile
+
+@pytest.fixture
+def profiles():
+    columns = [
+        {"name": "Name", "dtype": "object", "null_rate": 0.0, "distinct": 13852, "top": [["Charlie", 10], ["Peter Parker", 9]]},
+        {"name": "Alignment", "dtype": "object", "null_rate": 0.0, "distinct": 3, "top": [["Bad", 7258], ["Good", 5083], ["Neutral", 2324]]},
+        {"name": "Eyes", "dtype": "object", "null_rate": 0.1, "distinct": 24, "top": [["Blue", 4541], ["Black", 1330]]},
+        {"name": "Hair", "dtype": "object", "null_rate": 0.0, "distinct": 20, "top": [["Black", 4576], ["Brown", 2955]]},
+        {"name": "Appearances", "dtype": "int64", "null_rate": 0.0, "distinct": 354, "min": 1, "max": 4043, "mean": 17.3601, "sum": 254586}
+    ]
+    return {"marvel.csv": {"rows": 14665, "columns": columns}, "dc.csv": {"rows": 6896, "columns": columns}}
+
+@pytest.fixture
+def descriptions():
+    return {"marvel.csv": "Marvel comic characters with their alignment and appearances", "dc.csv": "DC comic characters with their alignment and appearances"}
+
+@pytest.mark.parametrize("question, expected", [
+    ("How many Marvel characters are there?", {"rows": 14665}),
+    ("How many rows does the marvel file have?", {"rows": 14665}),
+    ("What columns are in marvel?", {"columns": ["Name", "Alignment", "Eyes", "Hair", "Appearances"]}),
+    ("What is the average number of appearances?", {"column": "Appearances", "mean": 17.3601}),
+    ("What is the highest appearances value?", {"column": "Appearances", "max": 4043}),
+    ("How many distinct eyes values are there?", {"column": "Eyes", "distinct": 24}),
+    ("How many Marvel characters are good?", {"column": "Alignment", "value": "Good", "rows": 5083}),
+    ("How many characters have black hair?", {"column": "Hair", "value": "Black", "rows": 4576}),
+])
+def test_answers(profiles, descriptions, question, expected):
+    assert answer_from_profiles(question, ["marvel.csv"], profiles, descriptions) == {"marvel.csv": expected}
+
+@pytest.mark.parametrize("question", [
+    "Who has the most appearances?",
+    "How many characters are not good?",
+    "How many good characters have blue eyes?",
+    "What is the average appearances of good characters?",
+    "How many characters have more than 100 appearances?",
+    "How many characters are black?",
+    "What is the average eyes?",
+    "Tell me about the marvel file",
+])
+def test_questions_needing_code(profiles, descriptions, question):
+    assert answer_from_profiles(question, ["marvel.csv"], profiles, descriptions) is None
+
+def test_every_file_must_answer(profiles, descriptions):
+    assert answer_from_profiles("How many rows are there?", ["marvel.csv", "dc.csv"], profiles) == {"marvel.csv": {"rows": 14665}, "dc.csv": {"rows": 6896}}
+    assert answer_from_profiles("How many rows are there?", ["marvel.csv", "movies.csv"], profiles) is None
+    assert answer_from_profiles("How many rows are there?", [], profiles) is None
+
+def test_format_profile(profiles):
+    text = format_profile("marvel.csv", profiles["marvel.csv"])
+    assert text.splitlines()[0] == "marvel.csv: 14665 rows"
+    assert "- Eyes (object): 24 distinct; 10% null; most frequent: Blue (4541), Black (1330)" in text
+    assert "- Appearances (int64): 354 distinct; min 1, max 4043, mean 17.3601" in text
@@ -0,0 +1,127 @@
+import threading
+import time
+import httpx
+import pytest
+from unittest.mock import patch
+from modules.scheduler import LLMScheduler, TokenBucket, SharedTokenBucket, llm_session
+from modules.state import RedisBackend
+from tests.test_state import FakeRedis
+from modules.llm import LLMTransport, DEFAULT_CONFIG, PRIORITY_HEADER
+from modules.metrics import metrics
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    metrics.reset()
+    yield
+    metrics.reset()
+
+def wait_for_depth(scheduler, count):
+    deadline = time.monotonic() + 2
+    while len(scheduler.queue) < count and time.monotonic() < deadline:
+        time.sleep(0.001)
+
+def run_queued(scheduler, calls):
+    # Queues the calls while the bucket is empty, then refills it and returns the order they were served in
+    order = []
+    threads = []
+    for priority, session in calls:
+        thread = threading.Thread(target=lambda p=priority, s=session: (scheduler.acquire(10, p, s), order.append((p, s))))
+        thread.start()
+        threads.append(thread)
+        wait_for_depth(scheduler, len(threads))
+    with scheduler.condition:
+        scheduler.tokens.level = scheduler.tokens.capacity
+        scheduler.tokens.capacity = 0  # unlimited from now on, the order was already decided
+        scheduler.condition.notify_all()
+    for thread in threads:
+        thread.join(2)
+    return order
+
+def test_token_bucket():
+    bucket = TokenBucket(600)
+    bucket.take(600)
+    assert bucket.get_wait(100) == pytest.approx(10)
+    bucket.refill(bucket.updated + 10)
+    assert bucket.get_wait(100) == 0
+
+    # The reserve is left for higher priorities
+    assert bucket.get_wait(50, reserve=0.5) == pytest.approx(25)
+
+    # Unlimited
+    assert TokenBucket(0).get_wait(10 ** 6) == 0
+
+def test_acquire_within_quota():
+    scheduler = LLMScheduler({"tokens_per_minute": 1000, "requests_per_minute": 10})
+    scheduler.acquire(200, "answer", "a")
+    assert scheduler.tokens.level == pytest.approx(800, abs=1)
+    assert scheduler.requests.level == pytest.approx(9, abs=0.1)
+    assert 'llm_queue_wait_seconds_count{priority="answer"} 1' in metrics.render()
+    assert 'llm_queue_depth{priority="answer"} 0' in metrics.render()
+
+def test_priority_order():
+    scheduler = LLMScheduler({"tokens_per_minute": 60})
+    scheduler.tokens.level = 0
+    order = run_queued(scheduler, [("greeting", "a"), ("routing", "b"), ("answer", "c"), ("summarizer", "d")])
+    assert [priority for priority, _ in order] == ["summarizer", "answer", "routing", "greeting"]
+
+def test_fair_between_sessions():
+    scheduler = LLMScheduler({"tokens_per_minute": 60})
+    scheduler.tokens.level = 0
+    # A busy session queues three calls before another session asks once
+    order = run_queued(scheduler, [("answer", "busy"), ("answer", "busy"), ("answer", "busy"), ("answer", "quiet")])
+    assert order.index(("answer", "quiet")) == 1
+
+def test_queue_timeout():
+    scheduler = LLMScheduler({"tokens_per_minute": 60, "queue_timeout": 0.05})
+    scheduler.tokens.level = 0
+    with pytest.raises(TimeoutError):
+        scheduler.acquire(30, "greeting", "a")
+    assert scheduler.queue == []
+    assert 'llm_queue_timeouts_total{priority="greeting"} 1' in metrics.render()
+
+def test_pause():
+    scheduler = LLMScheduler({})
+    scheduler.pause(0.05)
+    start = time.monotonic()
+    scheduler.acquire(10)
+    assert time.monotonic() - start >= 0.04
+
+def test_transport_uses_scheduler():
+    calls = []
+    scheduler = LLMScheduler({})
+    transport = LLMTransport(httpx.MockTransport(lambda request: calls.append(request) or httpx.Response(429 if len(calls) == 1 else 200)), DEFAULT_CONFIG, scheduler)
+    client = httpx.Client(transport=transport, headers={PRIORITY_HEADER: "routing"})
+
+    token = llm_session.set("123")
+    try:
+        with patch.object(scheduler, "acquire", wraps=scheduler.acquire) as acquire, \
+             patch.object(scheduler, "pause") as pause, \
+             patch('modules.llm.time.sleep'):
+            client.post("https://example.openai.azure.com/openai/deployments/gpt-4o/chat/completions", json={"messages": [], "max_tokens": 100})
+    finally:
+        llm_session.reset(token)
+
+    # Every attempt goes through the scheduler, a throttled one pauses everybody
+    assert acquire.call_count == 2
+    tokens, priority = acquire.call_args[0]
+    assert priority == "routing" and tokens > 100
+    pause.assert_called_once()
+
+    # The priority never leaves the process
+    assert PRIORITY_HEADER not in calls[0].headers
+    assert 'llm_scheduled_tokens_total{priority="routing"}' in metrics.render()
+
+def test_shared_quota():
+    # Two workers draw from the same per-minute quota
+    server = FakeRedis()
+    first = LLMScheduler({"tokens_per_minute": 100, "queue_timeout": 0.05}, RedisBackend(server))
+    second = LLMScheduler({"tokens_per_minute": 100, "queue_timeout": 0.05}, RedisBackend(server))
+    assert isinstance(first.tokens, SharedTokenBucket)
+
+    # Frozen inside one window
+    with patch('modules.scheduler.time.time', return_value=6000.0):
+        first.acquire(60, "answer", "a")
+        with pytest.raises(TimeoutError):
+            second.acquire(60, "answer", "b")
+        second.acquire(40, "answer", "b")
+        assert first.tokens.get_wait(1) == 60
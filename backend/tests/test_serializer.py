@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+from unittest.mock import patch
+from modules.serializer import count_tokens, serialize_result, project_json, summarize_columns
+
+@pytest.fixture(autouse=True)
+def estimated_tokens():
+    # Use the character based estimate so the tests do not need the tokenizer files
+    with patch('modules.serializer.get_encoder', return_value=None):
+        yield
+
+def test_count_tokens():
+    assert count_tokens("") == 0
+    assert count_tokens("x" * 400) == 100
+
+def test_small_results_are_kept():
+    assert serialize_result(1, 100) == "1"
+    assert serialize_result({"columns": ["name"], "rows": [("Alice",), ("Bob",)], "truncated": None}, 100) == "Columns: ['name'] Rows: [('Alice',), ('Bob',)]"
+    assert serialize_result({"columns": ["name"], "rows": [], "truncated": None}, 100) == "no rows"
+
+def test_large_tables_are_summarized():
+    rows = [(i, f"product {i}") for i in range(1000)]
+    text = serialize_result({"columns": ["id", "name"], "rows": rows, "truncated": "rows"}, 300)
+
+    assert count_tokens(text) <= 300
+    assert "First rows: [(0, 'product 0')" in text
+    assert "(999, 'product 999')" in text
+    assert "Row count: 1000" in text
+    assert "'id': {'min': 0, 'max': 999, 'mean': 499.5, 'sum': 499500}" in text
+    assert "the result was cut at the row limit" in text
+
+def test_dataframes():
+    frame = pd.DataFrame({"name": [f"hero {i}" for i in range(500)], "power": range(500)})
+    text = serialize_result(frame, 200)
+    assert count_tokens(text) <= 200
+    assert "Row count: 500" in text
+
+    # Small frames and series are shown whole
+    assert serialize_result(frame.head(2), 200) == "Columns: ['name', 'power'] Rows: [('hero 0', 0), ('hero 1', 1)]"
+    assert "hero 1" in serialize_result(frame.set_index("name")["power"].head(2), 200)
+
+def test_json_projection():
+    payload = {"login": "octocat", "id": 1, "avatar_url": "https://x", "url": "https://y", "bio": None, "repos": [{"name": "hello", "html_url": "https://z"}]}
+    excluded_keys = [r".*_url$", r"^url$"]
+    assert project_json(payload, excluded_keys=excluded_keys) == {"login": "octocat", "id": 1, "repos": [{"name": "hello"}]}
+    assert project_json(payload, fields=["login", "name"]) == {"login": "octocat", "repos": [{"name": "hello"}]}
+
+    # Small payloads are shown whole, the links may be what the question is about
+    assert "https://x" in serialize_result(payload, 200, excluded_keys=excluded_keys)
+    assert serialize_result(payload, 200, fields=["login"]) == '{"login": "octocat", "repos": [{}]}'
+
+def test_large_json_is_shrunk():
+    payload = [{"name": f"repository {i}", "stars": i, "description": "x" * 50, "html_url": "https://x"} for i in range(500)]
+    text = serialize_result(payload, 500, excluded_keys=[r".*_url$"])
+    assert count_tokens(text) <= 500
+    assert "repository 0" in text
+    assert "more items" in text
+    assert "html_url" not in text
+
+def test_summarize_columns():
+    assert summarize_columns(["value", "label"], [(1, "a"), (3, "a"), (None, "b")]) == {"value": {"min": 1, "max": 3, "mean": 2.0, "sum": 4, "nulls": 1}, "label": {"distinct": 2}}
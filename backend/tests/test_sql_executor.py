@@ -0,0 +1,37 @@
+import pytest
+from sqlalchemy import create_engine
+from modules.sql_executor import execute_query, get_engine_args
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}", **get_engine_args({"pool_size": 2}))
+    with engine.begin() as connection:
+        connection.exec_driver_sql("CREATE TABLE numbers (value INTEGER, label TEXT)")
+        connection.exec_driver_sql("INSERT INTO numbers VALUES " + ", ".join(f"({i}, 'number {i}')" for i in range(100)))
+    return engine
+
+def test_execute_query(engine):
+    result = execute_query(engine, "SELECT value, label FROM numbers WHERE value < 3 ORDER BY value")
+    assert result == {"columns": ["value", "label"], "rows": [(0, "number 0"), (1, "number 1"), (2, "number 2")], "truncated": None}
+
+def test_row_cap(engine):
+    result = execute_query(engine, "SELECT value FROM numbers ORDER BY value", max_rows=10, fetch_size=3)
+    assert result["rows"] == [(i,) for i in range(10)]
+    assert result["truncated"] == "rows"
+
+    # Exactly the cap is not a truncation
+    assert execute_query(engine, "SELECT value FROM numbers WHERE value < 10", max_rows=10)["truncated"] is None
+
+def test_byte_cap(engine):
+    result = execute_query(engine, "SELECT label FROM numbers ORDER BY value", max_bytes=100)
+    assert 0 < len(result["rows"]) < 10
+    assert result["truncated"] == "bytes"
+
+def test_timeout_cancels_query(engine):
+    # A query that would run for a very long time
+    endless = "WITH RECURSIVE counter(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM counter) SELECT COUNT(*) FROM counter"
+    with pytest.raises(TimeoutError):
+        execute_query(engine, endless, timeout=0.2)
+
+    # The pooled connection is still usable afterwards
+    assert execute_query(engine, "SELECT COUNT(*) FROM numbers")["rows"] == [(100,)]
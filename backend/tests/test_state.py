@@ -0,0 +1,151 @@
+import time
+import pytest
+from unittest.mock import patch
+from modules.state import InProcessBackend, RedisBackend, setup_state, get_backend
+
+class FakeRedis:
+    # In-memory stand-in for the subset of the Redis commands the backend uses, with the same
+    # replies as redis-py (bytes values, integer counters, None for missing keys)
+
+    def __init__(self):
+        self.data = {}
+        self.expiry = {}
+
+    def expire_keys(self):
+        now = time.monotonic()
+        for key in [key for key, expires_at in self.expiry.items() if expires_at < now]:
+            self.data.pop(key, None)
+            self.expiry.pop(key, None)
+
+    def get(self, name):
+        self.expire_keys()
+        value = self.data.get(name)
+        return str(value).encode() if isinstance(value, int) else value
+
+    def set(self, name, value, px=None, nx=False):
+        self.expire_keys()
+        if nx and name in self.data:
+            return None
+        self.data[name] = value
+        self.expiry.pop(name, None)
+        if px:
+            self.expiry[name] = time.monotonic() + px / 1000
+        return True
+
+    def delete(self, *names):
+        self.expire_keys()
+        removed = sum(self.data.pop(name, None) is not None for name in names)
+        for name in names:
+            self.expiry.pop(name, None)
+        return removed
+
+    def incrby(self, name, amount):
+        self.expire_keys()
+        self.data[name] = int(self.data.get(name, 0)) + amount
+        return self.data[name]
+
+    def pexpire(self, name, milliseconds):
+        if name in self.data:
+            self.expiry[name] = time.monotonic() + milliseconds / 1000
+
+    def pexpireat(self, name, timestamp):
+        if name in self.data:
+            self.expiry[name] = time.monotonic() + timestamp / 1000 - time.time()
+
+    def persist(self, name):
+        return self.expiry.pop(name, None) is not None
+
+    def zadd(self, name, mapping):
+        self.expire_keys()
+        members = self.data.setdefault(name, {})
+        added = sum(value.encode() not in members for value in mapping)
+        members.update((value.encode(), float(score)) for value, score in mapping.items())
+        return added
+
+    def zrem(self, name, *values):
+        self.expire_keys()
+        members = self.data.get(name, {})
+        return sum(members.pop(value.encode(), None) is not None for value in values)
+
+    def zremrangebyscore(self, name, minimum, maximum):
+        self.expire_keys()
+        members = self.data.get(name, {})
+        removed = [value for value, score in members.items() if float(minimum) <= score <= float(maximum)]
+        for value in removed:
+            del members[value]
+        return len(removed)
+
+    def zrange(self, name, start, end, withscores=False):
+        self.expire_keys()
+        members = sorted(self.data.get(name, {}).items(), key=lambda item: item[1])
+        members = members[start:end + 1 if end != -1 else None]
+        return members if withscores else [value for value, _ in members]
+
+    def zrangebyscore(self, name, minimum, maximum):
+        self.expire_keys()
+        return [value for value, score in sorted(self.data.get(name, {}).items(), key=lambda item: item[1]) if float(minimum) <= score <= float(maximum)]
+
+@pytest.fixture(params=["memory", "redis"])
+def backend(request):
+    return InProcessBackend() if request.param == "memory" else RedisBackend(FakeRedis(), "test:")
+
+def test_get_set(backend):
+    assert backend.get("key") is None
+    backend.set("key", {"rows": [(1, "a")]})
+    assert backend.get("key") == {"rows": [(1, "a")]}
+    assert backend.delete("key", "missing") == 1
+    assert backend.get("key") is None
+
+def test_ttl(backend):
+    backend.set("key", "value", ttl=0.05)
+    assert backend.get("key") == "value"
+    time.sleep(0.06)
+    assert backend.get("key") is None
+
+def test_add(backend):
+    assert backend.add("lock", "first", ttl=10) is True
+    assert backend.add("lock", "second", ttl=10) is False
+    assert backend.get("lock") == "first"
+
+def test_incr(backend):
+    assert backend.get_counter("counter") == 0
+    assert backend.incr("counter", 5, ttl=10) == 5
+    assert backend.incr("counter", 2, ttl=10) == 7
+    assert backend.get_counter("counter") == 7
+
+def test_members(backend):
+    backend.add_member("tag", "a")
+    backend.add_member("tag", "b")
+    assert backend.members("tag") == {"a", "b"}
+    assert backend.members("missing") == set()
+    backend.remove_members("tag", "a", "missing")
+    assert backend.members("tag") == {"b"}
+
+def test_members_expire(backend):
+    backend.add_member("tag", "old", ttl=0.05)
+    backend.add_member("tag", "forever")
+    time.sleep(0.06)
+    assert backend.members("tag") == {"forever"}
+
+    # Expired members are pruned on write, the set does not grow with every key ever added
+    for index in range(3):
+        backend.add_member("requests", f"request {index}", ttl=0.05)
+    time.sleep(0.06)
+    backend.add_member("requests", "request 3", ttl=0.05)
+    stored = backend.client.data["test:requests"] if isinstance(backend, RedisBackend) else backend.entries["requests"][1]
+    assert len(stored) == 1
+
+def test_shared_between_workers():
+    # Two workers talking to the same server see each other's state
+    server = FakeRedis()
+    first, second = RedisBackend(server, "test:"), RedisBackend(server, "test:")
+    first.set("key", "value")
+    assert second.get("key") == "value"
+    assert first.shared is True and InProcessBackend.shared is False
+
+def test_setup_state():
+    with patch.object(RedisBackend, "from_url", return_value=RedisBackend(FakeRedis())) as MockFromUrl:
+        assert isinstance(setup_state({"backend": "redis", "redis_url": "redis://localhost:6379/0", "prefix": "chatbot:"}), RedisBackend)
+        MockFromUrl.assert_called_once_with("redis://localhost:6379/0", "chatbot:")
+    assert isinstance(setup_state({"backend": "memory"}), InProcessBackend)
+    assert isinstance(get_backend(), InProcessBackend)
@@ -0,0 +1,53 @@
+import pytest
+from modules.validation import parse_schema, validate_sql, validate_code, canonicalize_sql, get_tables
+
+@pytest.fixture
+def tables():
+    return parse_schema([
+        ('dbo', 'users', 'id', 'int'),
+        ('dbo', 'users', 'name', 'nvarchar'),
+        ('dbo', 'orders', 'user_id', 'int'),
+        ('dbo', 'orders', 'total', 'money')
+    ])
+
+def test_parse_schema(tables):
+    assert tables["users"] == {"id", "name"}
+    assert tables["dbo.orders"] == {"user_id", "total"}
+
+    # The string returned by the database is parsed as well
+    assert parse_schema("[('dbo', 'users', 'id', 'int')]") == {"users": {"id"}, "dbo.users": {"id"}}
+    assert parse_schema("not a schema") == {}
+
+def test_validate_sql_valid(tables):
+    assert validate_sql("SELECT TOP(5) name FROM users;", tables) == []
+    assert validate_sql("SELECT TOP 5 u.name, SUM(o.total) AS spent FROM dbo.users u JOIN [dbo].[orders] AS o ON o.user_id = u.id GROUP BY u.name ORDER BY spent DESC", tables) == []
+    assert validate_sql("SELECT COUNT(*) AS n FROM users WHERE name LIKE 'A%' AND id IN (SELECT user_id FROM orders)", tables) == []
+
+def test_validate_sql_dialect(tables):
+    assert validate_sql("SELECT name FROM users LIMIT 5", tables) == ["use TOP instead of LIMIT to limit rows"]
+    assert validate_sql('SELECT "name" FROM users', tables) == ["quote identifiers with square brackets instead of double quotes or backticks"]
+    assert "only one statement is allowed" in validate_sql("SELECT 1; DROP TABLE users", tables)
+    assert "statements that modify the database are not allowed (DELETE)" in validate_sql("DELETE FROM users", tables)
+
+def test_validate_sql_schema(tables):
+    assert validate_sql("SELECT email FROM users", tables) == ["unknown column 'email'"]
+    assert validate_sql("SELECT u.email FROM users u", tables) == ["column 'email' does not exist in 'u'"]
+    assert validate_sql("SELECT name FROM customers", tables) == ["unknown table 'customers'"]
+
+    # Without a schema only the dialect rules are checked
+    assert validate_sql("SELECT email FROM customers", {}) == []
+
+def test_canonicalize_sql():
+    # Spacing, comments, case and brackets do not change the canonical text, string literals do
+    assert canonicalize_sql("select  top 5 name\n FROM [dbo].[Users] -- users\n where x = 'Ab';") == canonicalize_sql("SELECT TOP 5 [Name] FROM dbo.users WHERE [X] = 'Ab'")
+    assert canonicalize_sql("SELECT name FROM users WHERE x = 'Ab'") != canonicalize_sql("SELECT name FROM users WHERE x = 'ab'")
+    assert canonicalize_sql("SELECT [Order Date] FROM t") == "select [order date] from t"
+
+def test_get_tables():
+    assert get_tables("SELECT a FROM dbo.users u JOIN [Sales].[Orders] o ON o.id = u.id WHERE id IN (SELECT x FROM items)") == {"users", "orders", "items"}
+
+def test_validate_code():
+    assert validate_code("import pandas as pd\nresult = pd.DataFrame()") == []
+    assert validate_code("import os\nvalue = 1") == ["import of 'os' is not allowed", "the final result must be assigned to a variable called 'result'"]
+    assert validate_code("from subprocess import run\nresult = 1", allowed_imports=("pandas",)) == ["import of 'subprocess' is not allowed"]
+    assert validate_code("result = (")[0].startswith("syntax error")